@@ -1,6 +1,6 @@
 """
 Key Ideas:
-    ( 1) A byte stream is a sequence of bytes. May be an instance of bytes, bytearray, memoryview, BytesIO, file
+    ( 1) A byte stream is a sequence of bytes. May be an instance of bytes, bytearray, memoryview, BytesIO, file, or a list of bytes-like segments that are treated as one sequence
     ( 2) A bit stream is a sequence of bits. An instance of bitarchitect.BitsIO. Every bit stream has an underlying buffer that is a byte stream.
     ( 3) A binary format specification is an interpretation of a sequence of bits that divides its regions into fields with specific interpretations.
     ( 4) A data structure is a hierarchy i.e. a list of elements which are either values or other hierarchies (lists).
@@ -62,6 +62,11 @@ Blueprint/Maker API:
         The maker.index_stream() method returns the single index number indicating where the next item will be inserted into/taken from the data stream.
             For example, if the result is 201, then the next item will be inserted/taken at maker.data_stream[201]
 
+        The maker.parallel_map(sub_blueprint,regions,*args,workers=None,**kwargs) method applies a sub-blueprint to independent regions of the byte stream.
+            regions is a list of (start_bits, num_bits) pairs in pre-extraction stream positions, e.g. the member offsets listed in a directory.
+            In extraction mode the regions are extracted in worker processes that share one copy of the input, and each region's data is appended as a sublist in order.
+            In construction mode the regions are constructed one after another at the current position.
+
     Invoking a Blueprint:
         To invoke a blueprint in extraction mode, use one of the following bitarchitect functions:
             (1) maker = extract(blueprint,byte_stream,*args,**kwargs)
@@ -70,19 +75,25 @@ Blueprint/Maker API:
                     Args and kwargs are passed into the function after the maker object.
                     The return value of the function will be stored in maker.blueprint_result
                 If the blueprint is a string:
-                    Args and kwargs are not used.
+                    Kwargs give the values of the {name} placeholders of the pattern. Args are not used.
                     maker.blueprint_result will be None
                 The data structure and data stream can be obtained from:
                     maker.data_structure
                     maker.data_stream
+                With fast=True, the bookkeeping that is only needed for construction is skipped and jumps become plain seeks (see the Extractor class).
+                With output='stream', 'structure' or 'record', only that representation is built and the others are derived when accessed (see the Extractor class).
+                With compact=True, data_stream, flat_labels and flat_pattern are stored in the compact containers of the storage module (see the Extractor class).
+                With intern=True, repeated byte, char, hex and bin values share one object and maker.interner.stats() reports the hit rates (see the Extractor class).
+                With lazy_min_bits=n, byte, char, hex and bin fields of at least n bits are left in the input as LazyValue objects and decoded when accessed (see the Extractor class).
+                With source_map=True, maker.source_map holds the original bit offset and length of every data stream item, and maker.source_map.read(index,byte_stream) reads one again.
 
             (2) data_structure = extract_data_structure(blueprint,byte_stream,*args,**kwargs)
-                Returns the data structure that has been fully extracted from the given byte stream using the blueprint.
+                Returns the data structure that has been fully extracted from the given byte stream using the blueprint. Only the data structure is built.
                 If the blueprint is a function:
                     Args and kwargs are passed into the function after the maker object.
 
             (3) data_stream = extract_data_stream(blueprint,byte_stream,*args,**kwargs)
-                Returns the data stream that has been fully extracted from the given byte stream using the blueprint.
+                Returns the data stream that has been fully extracted from the given byte stream using the blueprint. Only the data stream is built.
                 If the blueprint is a function:
                     Args and kwargs are passed into the function after the maker object.
 
@@ -90,11 +101,12 @@ Blueprint/Maker API:
             (1) maker = construct(blueprint,data_stream,*args,**kwargs)
                 Returns the maker object that has fully constructed a byte stream from the given data stream using the blueprint.
                 The data stream can be either a true data stream (flat list) or a data structure (hierarchy) without any difference assuming the two representations have the same order in traversing values.
+                It may also be any iterator or generator of values and records, e.g. rows from a database cursor. Its values are then consumed as they are needed instead of being flattened up front (see the Constructor class).
                 If the blueprint is a function:
                     Args and kwargs are passed into the function after the maker object.
                     The return value of the function will be stored in maker.blueprint_result
                 If the blueprint is a string:
-                    Args and kwargs are not used.
+                    Kwargs give the values of the {name} placeholders of the pattern. Args are not used.
                     maker.blueprint_result will be None
                 The byte stream can be obtained from:
                     maker.byte_stream
@@ -104,6 +116,37 @@ Blueprint/Maker API:
                 byte_stream will be a python bytes object.
                 If the blueprint is a function:
                     Args and kwargs are passed into the function after the maker object.
+
+        To apply a blueprint to many inputs at once, use one of the following bitarchitect functions:
+            (1) for path, data_stream, result, error in extract_many(blueprint,paths,*args,workers=None,chunksize=1,max_in_flight=None,**kwargs):
+                Extracts each file in a pool of worker processes and yields the results in the order the files finish.
+                Errors are captured per file. The blueprint must be picklable (a pattern string or a module level function).
+            (2) byte_stream = construct_parallel(blueprint,segments,*args,workers=None,fixup=None,output=None,**kwargs)
+                Constructs each segment's data stream with its own Constructor in a pool of worker processes and concatenates the bytes in order.
+                fixup(index,offset,data) may return replacement bytes for a segment once its output offset is known.
+            (3) for byte_stream in construct_many(blueprint,data_streams,*args,workers=None,backend=None,chunksize=64,**kwargs):
+                Constructs the bytes for each of many data streams in order, reusing compiled patterns and pooled output buffers.
+                backend may be None (calling thread), 'thread' or 'process'.
+
+        To apply a blueprint to each frame of a stream of length-prefixed frames, use one of the following bitarchitect functions:
+            (1) for header_record, frame in split_frames(byte_stream,header_pattern,length_label,scale=1,offset=0,include_header=False):
+                Splits the byte stream into frames whose fixed width header is described by header_pattern.
+                The payload length in bytes is the value of length_label times scale plus offset. Frames of bytes-like inputs are memoryviews into the input.
+            (2) for header_record, maker, result in extract_frames(blueprint,byte_stream,header_pattern,length_label,*args,scale=1,offset=0,reuse_maker=True,**kwargs):
+                Splits the byte stream into frames and extracts each frame with the blueprint, resetting one maker per frame unless reuse_maker is False.
+
+        To skip the python overhead of a function blueprint on many inputs of the same shape, wrap it in a TracedBlueprint:
+            traced = TracedBlueprint(blueprint_function)
+            maker = extract(traced,byte_stream)
+            The first call traces the patterns the function applies and the labels it reads. Later calls replay the patterns as a few combined maker calls,
+            checking that each label the function read has the traced value. If one differs, the maker is reset and the function is called instead.
+            Tracing is only kept if the function reads the data through maker[label] alone and returns None; otherwise traced.reason says why and the function is always called.
+
+        To change a few values of an extracted input without constructing it again, extract it with a source map and patch it:
+            maker,result = extract(blueprint,byte_stream,source_map=True)
+            patch(maker,{stream_index:new_value},target=None)
+            Each new value must have the same bit width as the one it replaces. Only the bits of the changed fields are written into the target,
+            which defaults to the input and may be a bytearray, a writable mmap or a file opened with "r+b". Reversals and inversions that applied to a field are taken into account.
 Modification operations:
     All modification operations ultimately are either bit reversals or bit inversions at specific offsets and for specific lengths.
     Both of these primitive operations are their own inverses.
@@ -246,6 +289,34 @@ Token class Specification:
     Repetition:
         {<pattern>}<n> = Repeat the pattern n times
         {<pattern>}$ = Repeat until source stream is exhausted
+        {<pattern>}..."<label>"<count_expr>; = Repeat the pattern a number of times taken from a label (see Counts)
+
+    Conditions:
+        The branch is chosen from the most recent value of the label when the token is reached, in both extraction and construction, so data dependent layouts can stay in one compiled pattern.
+        ?#"<label>"{<then_pattern>}{<else_pattern>} = Apply then_pattern if the label value is true, otherwise else_pattern. Either may be empty: {}
+        ?="<label>" <value>:{<pattern>} <value>:{<pattern>} ... *:{<default_pattern>}; = Apply the pattern of the case equal to the label value.
+            Each value is a python literal that does not contain ":", e.g. 1, 'ab' or b'PK'. The *:{...} default case is optional; without it an unmatched value raises an exception. The ";" is required.
+            e.g. u8 #"type" ?="type" 1:{u16} 2:{u32} *:{B$};
+
+    Counts:
+        The number of a value token (u s x X b B C) or of n, z and o may be given as a count that is read from a label when the token is applied, so the pattern string does not change from call to call.
+        <code>..."<label>"<count_expr>; = The number of bits is the most recent value of the label, transformed by count_expr.
+            count_expr is an optional *<k> or /<k> followed by an optional +<k> or -<k>. The ";" is required.
+            e.g. u16 #"name_len" C..."name_len"*8; reads a 16 bit byte count and then that many bytes.
+        Construction context:
+            For B, C, b, x and X tokens the count follows from the size of the value in the data stream, so the label is set to match it unless its count already fits the value.
+            If the label was set by an integer value token, that field in the output is updated as well, so length fields never have to be filled in by hand.
+            Other counts, including repetition counts, are read from the label as in extraction.
+
+    Placeholders:
+        Any number in a token or a repetition count may be written as {<name>}, whose value is given as a keyword argument when the pattern is applied.
+        The pattern is compiled once, and each call only binds the values into the few instructions that need them.
+            e.g. maker('js{offset}',offset=cd_offset*8) or maker('{u16}{n}',n=count)
+        Every placeholder must be given a value, and no other keyword arguments are accepted.
+
+    Definitions:
+        @<name> = Apply the named sub-pattern defined with pattern_define(), e.g. pattern_define('@hdr := {u16}5 {u32}3') and then maker('@hdr u8').
+        Each definition is compiled once and shared by every pattern that references it. A definition may contain placeholders, which are bound by the pattern that references it.
 
     Comments:
         ##<any string> 
@@ -396,6 +467,11 @@ from .bit_utils import *
 from .bits_io import *
 from .pattern import *
 from .maker import *
+from .batch import *
+from .framing import *
+from .trace import *
+from .storage import *
+from .patching import *
 blueprints = importlib.import_module('bitarchitect.blueprints')
 
 __version__ = '0.0.1'
@@ -0,0 +1,315 @@
+"""
+This module provides functions that apply a blueprint to many inputs, or to many regions of one input, using a pool of worker processes.
+
+Blueprints sent to worker processes must be picklable, i.e. a pattern string or a module level function.
+"""
+import os, mmap, itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+from collections import deque
+from .pattern import extract, construct, Extractor, Constructor
+
+def _extract_paths(blueprint,paths,args,kwargs):
+    """
+    Worker side of extract_many(). Extracts every path in a chunk and captures errors per path.
+    """
+    results = []
+    for path in paths:
+        try:
+            with open(path,'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    maker,result = extract(blueprint,b'',*args,**kwargs) #empty files cannot be mapped
+                elif kwargs.get('release_consumed',False):
+                    maker,result = extract(blueprint,f,*args,**kwargs) #the file is already read incrementally
+                else:
+                    with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as data:
+                        maker,result = extract(blueprint,data,*args,**kwargs)
+            results.append((path,None if maker.output == 'record' else maker.data_stream,result,None)) #a record only Extractor keeps its data in the result
+        except Exception as e:
+            results.append((path,None,None,e))
+    return results
+
+def extract_many(blueprint,paths,*args,workers=None,chunksize=1,max_in_flight=None,**kwargs):
+    """
+    Extracts every file in paths with the blueprint using a pool of worker processes.
+    Each worker memory maps the file it is given and calls extract() on it.
+    With release_consumed=True the open file is passed instead, since it is then read incrementally anyway.
+
+    Yields (path, data_stream, blueprint_result, error) tuples in the order that the files finish.
+    If extracting a file raises an exception, data_stream and blueprint_result are None and error is the exception. Otherwise error is None.
+    With output='record' there is no data stream, so data_stream is None and a pattern's data record is the blueprint_result.
+
+    workers = Number of worker processes. Defaults to the number of CPUs.
+    chunksize = Number of paths sent to a worker in one task. Larger values reduce overhead for many small files.
+    max_in_flight = Maximum number of tasks submitted but not yet collected. Defaults to twice the number of workers. Paths are consumed lazily, so paths may be a generator.
+
+    Args and kwargs are passed to extract() and from there to the blueprint if it is a function. For a pattern, kwargs give the values of its {name} placeholders.
+    lazy_min_bits is ignored, since every value is decoded anyway to be sent back from the worker, and the mapped file is closed before that.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2*workers
+    paths = iter(paths)
+    kwargs.pop('lazy_min_bits',None) #LazyValues would hold views into the worker's mapped file
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        def submit_next():
+            chunk = list(itertools.islice(paths,chunksize))
+            if len(chunk) == 0:
+                return False
+            pending.add(executor.submit(_extract_paths,blueprint,chunk,args,kwargs))
+            return True
+        while len(pending) < max_in_flight and submit_next():
+            pass
+        while len(pending) > 0:
+            done,pending = wait(pending,return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+            while len(pending) < max_in_flight and submit_next():
+                pass
+
+_region_source = None #(source, handle, view) of the buffer attached by this worker process for the pool of the current parallel_map() call
+
+def _open_region_source(source):
+    """
+    Returns (handle, view): a handle on the original input described by source and a memoryview over it. handle is None for an empty file.
+    source is ('file', path) for an input that is a file on disk or ('shm', name, size) for an input copied into shared memory.
+    """
+    if source[0] == 'file':
+        with open(source[1],'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None,memoryview(b'')
+            handle = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        return handle,memoryview(handle)
+    handle = shared_memory.SharedMemory(name=source[1])
+    return handle,handle.buf[:source[2]]
+
+def _close_region_source(handle,view):
+    view.release()
+    if handle is not None:
+        handle.close()
+
+def _attach_region_source(source):
+    """
+    Worker side of Extractor.parallel_map() with its own pool. Returns a memoryview over the original input described by source.
+    The buffer stays attached between tasks so that a worker maps the input once. The pool is shut down at the end of the call, which detaches it.
+    """
+    global _region_source
+    if _region_source is not None:
+        if _region_source[0] == source:
+            return _region_source[2]
+        _, handle, view = _region_source
+        _region_source = None
+        _close_region_source(handle,view)
+    handle,view = _open_region_source(source)
+    _region_source = (source,handle,view)
+    return view
+
+def _extract_region(blueprint,source,start_bits,num_bits,settings,args,kwargs,keep_attached=False):
+    """
+    Worker side of Extractor.parallel_map(). Extracts one region of the original input with a fresh Extractor that starts from the given settings.
+    With keep_attached the input stays attached to the worker for the next task. Otherwise it is detached before returning,
+    since the worker belongs to an executor of the caller and outlives the call, which unlinks the shared memory.
+    """
+    if keep_attached:
+        return _extract_region_view(blueprint,_attach_region_source(source),start_bits,num_bits,settings,args,kwargs)
+    handle,view = _open_region_source(source)
+    try:
+        return _extract_region_view(blueprint,view,start_bits,num_bits,settings,args,kwargs)
+    finally:
+        _close_region_source(handle,view)
+
+def _extract_region_view(blueprint,view,start_bits,num_bits,settings,args,kwargs):
+    with view[start_bits//8:(start_bits+num_bits)//8] as region:
+        maker = Extractor(region)
+        maker.reverse_all,maker.invert_all,maker.endianswap_all = settings
+        if isinstance(blueprint,(bytes,str)):
+            result = maker(blueprint,**kwargs)
+        else:
+            result = blueprint(maker,*args,**kwargs)
+        maker.finalize()
+    return maker.data_stream,maker.flat_pattern,maker.flat_labels,maker.labels,maker.data_structure,result
+
+def _extract_regions(maker,blueprint,regions,args,kwargs,workers=None,executor=None):
+    """
+    Parent side of Extractor.parallel_map(). Shares the original input of the maker with the workers and returns the region outputs in the order of regions.
+    An input that is a file on disk is memory mapped by each worker. Any other input is copied once into shared memory.
+    Workers of a pool created here keep the input attached between tasks. Workers of the caller's executor detach it after each task.
+    """
+    byte_stream = maker.byte_stream
+    shm = None
+    path = getattr(byte_stream,'name',None)
+    if isinstance(path,str) and hasattr(byte_stream,'fileno') and os.path.isfile(path):
+        source = ('file',path)
+    else:
+        if isinstance(byte_stream,(list,tuple)):
+            data = b''.join(byte_stream)
+        elif isinstance(byte_stream,(bytes,bytearray,memoryview,mmap.mmap)):
+            data = memoryview(byte_stream).cast('B')
+        else:
+            pos = byte_stream.tell()
+            byte_stream.seek(0)
+            data = byte_stream.read()
+            byte_stream.seek(pos)
+        shm = shared_memory.SharedMemory(create=True,size=max(len(data),1))
+        shm.buf[:len(data)] = data
+        source = ('shm',shm.name,len(data))
+    settings = (maker.reverse_all,maker.invert_all,maker.endianswap_all)
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(_extract_region,blueprint,source,start_bits,num_bits,settings,args,kwargs,own_executor) for start_bits,num_bits in regions]
+        return [future.result() for future in futures]
+    finally:
+        if own_executor:
+            executor.shutdown()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+def _extract_records(instructions,count,data,settings):
+    """
+    Worker side of Extractor parallel repetitions. Extracts count fixed width records from data, starting from the given settings and last value.
+    The modified bytes are only returned when the records modified the buffer.
+    """
+    maker = Extractor(data)
+    maker.reverse_all,maker.invert_all,maker.endianswap_all,maker.last_value = settings
+    maker.data_record = []
+    maker.stack_record = [maker.data_record]
+    maker._execute(itertools.chain.from_iterable(itertools.repeat(instructions,count)))
+    maker.finalize()
+    modified_bytes = bytes(maker) if len(maker.mod_operations) > 0 else None
+    last_value = (maker.last_value,) if maker.last_value is not settings[3] else None
+    return maker.data_stream,maker.flat_pattern,maker.mod_operations,modified_bytes,last_value,maker.last_index_stack
+
+def _ordered_results(executor,tasks,max_in_flight):
+    """
+    Submits the (function, *args) tuples of tasks to the executor with at most max_in_flight outstanding and yields their results in submission order.
+    Tasks are consumed lazily.
+    """
+    tasks = iter(tasks)
+    pending = deque()
+    for task in itertools.islice(tasks,max_in_flight):
+        pending.append(executor.submit(*task))
+    while len(pending) > 0:
+        result = pending.popleft().result()
+        for task in itertools.islice(tasks,1):
+            pending.append(executor.submit(*task))
+        yield result
+
+def _chunked(iterable,chunksize):
+    iterable = iter(iterable)
+    chunk = list(itertools.islice(iterable,chunksize))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(itertools.islice(iterable,chunksize))
+
+def _construct_segment(blueprint,data_stream,args,kwargs):
+    """
+    Worker side of construct_parallel(). Constructs one segment and returns its bytes.
+    """
+    maker,result = construct(blueprint,data_stream,*args,**kwargs)
+    if maker.tell_buffer() % 8 != 0:
+        raise Exception('Constructed segment is not a whole number of bytes: %d bits' % maker.tell_buffer())
+    return bytes(maker)
+
+def construct_parallel(blueprint,segments,*args,workers=None,fixup=None,output=None,max_in_flight=None,**kwargs):
+    """
+    Constructs each segment with its own Constructor in a pool of worker processes and concatenates the results in order.
+
+    segments is an iterable of data streams (or data structures), one per segment. Every segment must construct to a whole number of bytes,
+    and the modifications made by the blueprint must stay inside the segment, since each one is finalized on its own.
+
+    fixup = Optional function called as fixup(index, offset, data) for each segment in order, where offset is the byte position of the segment in the output.
+        If it returns a bytes-like object, that replaces the segment data, e.g. to patch in offsets that are only known once the earlier segments are built.
+    output = Optional binary file-like object that the segments are written to. The output is then not held in memory and the total number of bytes written is returned.
+        Otherwise the concatenated bytes are returned.
+    workers = Number of worker processes. Defaults to the number of CPUs.
+    max_in_flight = Maximum number of segments submitted but not yet written. Defaults to twice the number of workers.
+
+    Args and kwargs are passed to construct() and from there to the blueprint if it is a function. For a pattern, kwargs give the values of its {name} placeholders.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2*workers
+    if output is None:
+        parts = []
+        write = parts.append
+    else:
+        write = output.write
+    offset = 0
+    index = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = ((_construct_segment,blueprint,data_stream,args,kwargs) for data_stream in segments)
+        for data in _ordered_results(executor,tasks,max_in_flight):
+            if fixup is not None:
+                fixed = fixup(index,offset,data)
+                if fixed is not None:
+                    data = fixed
+            write(data)
+            offset += len(data)
+            index += 1
+    if output is None:
+        return b''.join(parts)
+    return offset
+
+_maker_pool = [] #Constructors reused by construct_many() in this process
+MAKER_POOL_SIZE = 64 #most Constructors kept in the pool of a process
+
+def _construct_streams(blueprint,data_streams,args,kwargs):
+    """
+    Constructs each data stream with a pooled Constructor and returns the list of constructed bytes.
+    """
+    results = []
+    try:
+        maker = _maker_pool.pop()
+    except IndexError:
+        maker = Constructor([])
+    try:
+        for data_stream in data_streams:
+            maker.reset(data_stream)
+            if isinstance(blueprint,(bytes,str)):
+                maker(blueprint,**kwargs)
+            else:
+                blueprint(maker,*args,**kwargs)
+            maker.finalize()
+            results.append(bytes(maker))
+    finally:
+        if len(_maker_pool) < MAKER_POOL_SIZE:
+            _maker_pool.append(maker)
+    return results
+
+def construct_many(blueprint,data_streams,*args,workers=None,backend=None,chunksize=64,max_in_flight=None,**kwargs):
+    """
+    Constructs bytes from each data stream in data_streams with the same blueprint and yields the bytes for each input in order.
+
+    Pattern strings are compiled once and Constructors are reset and reused from a pool along with their output buffers, so the per-input cost is just the construction itself.
+    backend = None to construct in the calling thread, 'thread' for a thread pool or 'process' for a process pool. With 'process' the blueprint must be picklable.
+    workers = Number of pool workers. Defaults to the number of CPUs.
+    chunksize = Number of data streams handled by one pool task.
+    max_in_flight = Maximum number of tasks submitted but not yet collected. Defaults to twice the number of workers.
+
+    Args and kwargs are passed to the blueprint if it is a function. For a pattern, kwargs give the values of its {name} placeholders.
+    """
+    chunks = _chunked(data_streams,chunksize)
+    if backend is None:
+        for chunk in chunks:
+            yield from _construct_streams(blueprint,chunk,args,kwargs)
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2*workers
+    if backend == 'thread':
+        executor_class = ThreadPoolExecutor
+    elif backend == 'process':
+        executor_class = ProcessPoolExecutor
+    else:
+        raise Exception('Invalid backend for construct_many: %s' % repr(backend))
+    with executor_class(max_workers=workers) as executor:
+        tasks = ((_construct_streams,blueprint,chunk,args,kwargs) for chunk in chunks)
+        for results in _ordered_results(executor,tasks,max_in_flight):
+            yield from results
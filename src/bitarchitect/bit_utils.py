@@ -152,7 +152,7 @@ def bytes_to_uint(bytes_data,lstrip=0,rstrip=0,reverse=False,invert=False):
     if rstrip > 0:
         if rstrip <= len(bytes_data)*8:
             rstrip_bytes, rstrip = divmod(rstrip, 8)
-            bytes_data = bytes_data[:-rstrip_bytes] #remove bytes from the end
+            bytes_data = bytes_data[:len(bytes_data)-rstrip_bytes] #remove bytes from the end
             if len(bytes_data) > 0:
                 bytes_data[-1] = lmask_byte(8-rstrip,bytes_data[-1]) #strip of bits in the last byte
         else:
@@ -163,7 +163,7 @@ def bytes_to_uint(bytes_data,lstrip=0,rstrip=0,reverse=False,invert=False):
     if reverse:
         #reverse the order across bytes and reverse the order of bits within bytes
         bytes_data =[reverse_byte_table[value] for value in bytes_data[::-1]]
-    result = sum((b<<(8*(n-p-1))) for p,b in enumerate(bytes_data))
+    result = int.from_bytes(bytes(bytes_data),'big') << (8*(n-len(bytes_data)))
     if not reverse:
         return (result >> rstrip,num_bits)
     else:
@@ -237,10 +237,7 @@ def uint_to_bytes(uint,num_bits=None,loffset=0,lvalue=0,rvalue=0,reverse=False,i
             roffset += 8
 
     #extract byte data from uint
-    bytes_data = []
-    for byte_i in range(num_bytes):
-        uint,value = divmod(uint,256)
-        bytes_data.append(value)
+    bytes_data = list((uint & ((1<<(8*num_bytes))-1)).to_bytes(num_bytes,'little'))
     #perform reversal if requested
     if reverse:
         bytes_data =[reverse_byte_table[value] for value in bytes_data[::-1]]
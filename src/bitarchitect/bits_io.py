@@ -3,7 +3,7 @@ The purpose of this module is to provide a file-like object called BitsIO that b
 BytesIO except that reads, writes, seeks, and other common methods operator at the bit level instead of the byte level.
 """
 
-import io
+import io, tempfile, bisect, mmap
 from enum import Enum
 from .bit_utils import *
 
@@ -11,10 +11,326 @@ SEEK_SET = io.SEEK_SET
 SEEK_CUR = io.SEEK_CUR
 SEEK_END = io.SEEK_END
 
+DEFAULT_CHUNK_BYTES = 1<<13 #size of the pieces that reverse(), invert() and find() work through when a region is larger than this
+
 class ByteSourceType(Enum):
     BUFFER = 1
     SOURCE = 2
 
+class ReleasableBytesIO(object):
+    """
+    A file-like byte source over a bytes-like object or a binary file that only keeps a window of the data in memory.
+
+    Seek and tell positions are always absolute positions in the underlying data.
+    Bytes are loaded into the window as they are read or written.
+    Calling release(byte_pos) discards the window contents before byte_pos. Released bytes can no longer be read or written.
+
+    >>> r = ReleasableBytesIO(b'hello world')
+    >>> r.read(6)
+    b'hello '
+    >>> r.release(6)
+    >>> r.tell(), len(r.window)
+    (6, 0)
+    >>> r.read()
+    b'world'
+    >>> r.seek(0)
+    0
+    >>> r.read(1)
+    Traceback (most recent call last):
+    ...
+    Exception: Position 0 has already been released (window starts at byte 6)
+    """
+    def __init__(self,byte_source,chunk_bytes=DEFAULT_CHUNK_BYTES):
+        self.original_byte_source = byte_source
+        self.chunk_bytes = chunk_bytes
+        if isinstance(byte_source,(bytes,bytearray,memoryview,mmap.mmap)):
+            self.source_view = memoryview(byte_source).cast('B')
+            self.source_file = None
+            self.source_size = len(self.source_view)
+            self.pos = 0
+        else:
+            if hasattr(byte_source,'mode') and not 'b' in byte_source.mode:
+                raise Exception('File-like object provided to ReleasableBytesIO must be opened in binary mode i.e. must have "b": mode = %s' % byte_source.mode)
+            self.source_view = None
+            self.source_file = byte_source
+            self.pos = byte_source.tell()
+            self.source_size = byte_source.seek(0,io.SEEK_END)
+            byte_source.seek(self.pos)
+        self.size = self.source_size
+        self.base = 0 #absolute position of the first byte in the window
+        self.window = bytearray()
+
+    def _load(self,end):
+        """
+        Extends the window with source data up to the absolute byte position end.
+        """
+        loaded_end = self.base + len(self.window)
+        end = min(end,self.source_size)
+        if end <= loaded_end:
+            return
+        if self.source_view is not None:
+            self.window += self.source_view[loaded_end:end]
+        else:
+            self.source_file.seek(loaded_end)
+            self.window += self.source_file.read(end-loaded_end)
+
+    def _check_released(self):
+        if self.pos < self.base:
+            raise Exception('Position %d has already been released (window starts at byte %d)' % (self.pos,self.base))
+
+    def read(self,n=-1):
+        if n is None or n < 0:
+            end = self.size
+        else:
+            end = min(self.pos + n,self.size)
+        if end <= self.pos:
+            return b''
+        self._check_released()
+        self._load(end)
+        data = bytes(self.window[self.pos-self.base:end-self.base])
+        self.pos = end
+        return data
+
+    def write(self,data):
+        n = len(data)
+        self._check_released()
+        end = self.pos + n
+        self._load(end)
+        loaded_end = self.base + len(self.window)
+        if self.pos > loaded_end:
+            self.window.extend(bytes(self.pos-loaded_end)) #writing after the end pads the gap with zeros
+        self.window[self.pos-self.base:end-self.base] = data
+        self.pos = end
+        self.size = max(self.size,end)
+        return n
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise Exception('Invalid whence: %s' % repr(whence))
+        if self.pos < 0:
+            raise Exception('Negative seek position %d' % self.pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def truncate(self,size=None):
+        if size is None:
+            size = self.pos
+        if size < self.base:
+            raise Exception('Cannot truncate to %d bytes; bytes before %d have already been released' % (size,self.base))
+        self._load(size)
+        del self.window[size-self.base:]
+        self.size = size
+        self.source_size = min(self.source_size,size)
+        return size
+
+    def release(self,byte_pos):
+        """
+        Discards all bytes before the absolute byte position byte_pos.
+        """
+        if byte_pos <= self.base:
+            return
+        del self.window[:byte_pos-self.base] #deleting from the front of a bytearray does not move the remaining bytes
+        self.base = byte_pos
+
+    def readable(self):
+        return True
+    def writable(self):
+        return True
+    def seekable(self):
+        return True
+    def flush(self):
+        pass
+    def isatty(self):
+        return False
+    def close(self):
+        self.window = bytearray()
+        self.source_view = None
+
+class SegmentedBytesIO(object):
+    """
+    A file-like byte source that presents a list of bytes-like segments as one contiguous sequence of bytes without concatenating them.
+
+    Segments larger than page_bytes are split into pages that refer to the same object.
+    Reads only copy the bytes that are requested. A page is copied into a private bytearray the first time it is written to,
+    so the provided segments are never modified unless copy_on_write is set to False (which requires writable segments).
+    Writing past the end adds a new segment.
+
+    >>> s = SegmentedBytesIO([b'hel',b'lo w',b'orld'])
+    >>> s.seek(2)
+    2
+    >>> s.read(6)
+    b'llo wo'
+    >>> s.find(b'o w',0)
+    4
+    >>> s.seek(3)
+    3
+    >>> s.write(b'LO W')
+    4
+    >>> s.seek(0)
+    0
+    >>> s.read()
+    b'helLO World'
+    >>> len(s.pieces)
+    3
+    """
+    def __init__(self,segments,page_bytes=DEFAULT_CHUNK_BYTES*8,copy_on_write=True):
+        self.page_bytes = page_bytes
+        self.copy_on_write = copy_on_write
+        self.pieces = [] #[object, start, end, owned]
+        self.offsets = [] #absolute position of the first byte of each piece
+        self.size = 0
+        for segment in segments:
+            if isinstance(segment,memoryview):
+                segment = segment.cast('B')
+            for start in range(0,len(segment),page_bytes):
+                end = min(start+page_bytes,len(segment))
+                self.offsets.append(self.size)
+                self.pieces.append([segment,start,end,not copy_on_write])
+                self.size += end-start
+        self.pos = 0
+
+    def _locate(self,pos):
+        """
+        Returns the index of the piece containing the absolute byte position pos.
+        """
+        return bisect.bisect_right(self.offsets,pos)-1
+
+    def read(self,n=-1):
+        if n is None or n < 0:
+            end = self.size
+        else:
+            end = min(self.pos+n,self.size)
+        if end <= self.pos:
+            return b''
+        parts = []
+        i = self._locate(self.pos)
+        pos = self.pos
+        while pos < end:
+            obj,start,stop,owned = self.pieces[i]
+            a = start + pos - self.offsets[i]
+            b = min(stop,start + end - self.offsets[i])
+            parts.append(obj[a:b])
+            pos += b-a
+            i += 1
+        self.pos = end
+        if len(parts) == 1:
+            return bytes(parts[0])
+        return b''.join(parts)
+
+    def write(self,data):
+        data = memoryview(data).cast('B')
+        n = len(data)
+        if n == 0:
+            return 0
+        if self.pos > self.size:
+            self._append(bytearray(self.pos-self.size)) #writing after the end pads the gap with zeros
+        written = 0
+        if self.pos < self.size:
+            i = self._locate(self.pos)
+            while written < n and i < len(self.pieces):
+                piece = self.pieces[i]
+                if not piece[3]:
+                    piece[0] = bytearray(piece[0][piece[1]:piece[2]])
+                    piece[1] = 0
+                    piece[2] = len(piece[0])
+                    piece[3] = True
+                obj,start,stop,owned = piece
+                a = start + self.pos + written - self.offsets[i]
+                b = min(stop,a + n - written)
+                obj[a:b] = data[written:written+b-a]
+                written += b-a
+                i += 1
+        if written < n:
+            self._append(bytearray(data[written:]))
+        self.pos += n
+        return n
+
+    def _append(self,segment):
+        self.offsets.append(self.size)
+        self.pieces.append([segment,0,len(segment),True])
+        self.size += len(segment)
+
+    def find(self,sub,start=0):
+        """
+        Returns the absolute byte position of the first occurrence of sub at or after start, or -1 if there is none.
+        Matches that straddle piece boundaries are found by searching the joined tail and head of neighboring pieces.
+        """
+        overlap = len(sub)-1
+        i = max(self._locate(start),0)
+        while i < len(self.pieces):
+            obj,a,b,owned = self.pieces[i]
+            offset = self.offsets[i]
+            a = max(a,a + start - offset)
+            if hasattr(obj,'find'):
+                found = obj.find(sub,a,b)
+            else:
+                found = bytes(obj[a:b]).find(sub)
+                if found >= 0:
+                    found += a
+            if found >= 0:
+                return offset + found - self.pieces[i][1]
+            if overlap > 0 and i+1 < len(self.pieces):
+                junction_start = max(offset + b - self.pieces[i][1] - overlap,start)
+                self.pos, pos = junction_start, self.pos
+                junction = self.read(2*overlap)
+                self.pos = pos
+                found = junction.find(sub)
+                if found >= 0:
+                    return junction_start + found
+            i += 1
+        return -1
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise Exception('Invalid whence: %s' % repr(whence))
+        if self.pos < 0:
+            raise Exception('Negative seek position %d' % self.pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def truncate(self,size=None):
+        if size is None:
+            size = self.pos
+        if size < self.size:
+            i = self._locate(size)
+            if i >= 0 and size > self.offsets[i]:
+                self.pieces[i][2] = self.pieces[i][1] + size - self.offsets[i]
+                i += 1
+            del self.pieces[max(i,0):]
+            del self.offsets[max(i,0):]
+            self.size = size
+        return size
+
+    def readable(self):
+        return True
+    def writable(self):
+        return True
+    def seekable(self):
+        return True
+    def flush(self):
+        pass
+    def isatty(self):
+        return False
+    def close(self):
+        self.pieces = []
+        self.offsets = []
+
 class BitsIO(object):
 
     """
@@ -48,24 +364,60 @@ class BitsIO(object):
     '0b1100000'
     >>> bin(ord('h'))
     '0b1101000'
+
+    When spill_threshold is given (in bytes), a BUFFER type BitsIO keeps its bytes in a spooled temporary file.
+    The data stays in memory until it grows past spill_threshold bytes and is then moved to a file on disk automatically.
+    Regions larger than chunk_bytes are reversed, inverted and searched piece by piece so that large buffers are never read into memory all at once.
+
+    >>> b = BitsIO(b'hello world',spill_threshold=4,chunk_bytes=2)
+    >>> b.reverse()
+    >>> bytes(b)[:3]
+    b'&6N'
+    >>> b.reverse()
+    >>> bytes(b)
+    b'hello world'
+    >>> b.find(b'world')
+    48
     """
-    def __init__(self,byte_source=None,byte_source_type = ByteSourceType.BUFFER):
+    def __init__(self,byte_source=None,byte_source_type = ByteSourceType.BUFFER,spill_threshold=None,chunk_bytes=DEFAULT_CHUNK_BYTES):
         """
         """
         self.original_byte_source = byte_source
         self.byte_source_type = byte_source_type
+        self.spill_threshold = spill_threshold
+        self.chunk_bits = chunk_bytes*8
         if byte_source_type == ByteSourceType.BUFFER:
+            if spill_threshold == 0:
+                self.byte_source = tempfile.TemporaryFile() #SpooledTemporaryFile treats a max_size of 0 as unlimited
+            elif spill_threshold is not None:
+                self.byte_source = tempfile.SpooledTemporaryFile(max_size=spill_threshold)
             if byte_source is None:
-                self.byte_source = io.BytesIO()
-            elif isinstance(byte_source,(bytes,bytearray,memoryview)):
-                self.byte_source = io.BytesIO(byte_source)
+                if spill_threshold is None:
+                    self.byte_source = io.BytesIO()
+            elif isinstance(byte_source,(list,tuple)):
+                self.byte_source = SegmentedBytesIO(byte_source)
+            elif isinstance(byte_source,(bytes,bytearray,memoryview,mmap.mmap)):
+                if spill_threshold is None:
+                    self.byte_source = io.BytesIO(byte_source)
+                else:
+                    view = memoryview(byte_source).cast('B')
+                    for i in range(0,len(view),chunk_bytes):
+                        self.byte_source.write(view[i:i+chunk_bytes])
+                    view.release()
+                    self.byte_source.seek(0)
             elif isinstance(byte_source,(io.BufferedIOBase,io.BufferedRandom,io.BufferedReader,io.BytesIO)):
                 if hasattr(byte_source,'mode'):
                     if not 'b' in byte_source.mode:
                         raise Exception('File-like object provided to BitsIO must be opened in binary mode i.e. must have "b": mode = %s' % byte_source.mode)
                 pos = byte_source.tell()
                 byte_source.seek(0)
-                self.byte_source = io.BytesIO(byte_source.read())
+                if spill_threshold is None:
+                    self.byte_source = io.BytesIO(byte_source.read())
+                else:
+                    chunk = byte_source.read(chunk_bytes)
+                    while len(chunk) > 0:
+                        self.byte_source.write(chunk)
+                        chunk = byte_source.read(chunk_bytes)
                 self.byte_source.seek(pos)
                 byte_source.seek(pos)
             else:
@@ -77,6 +429,9 @@ class BitsIO(object):
         else:
             raise Exception('Invalid object for BitsIO byte_source: %s' % repr(type(byte_source)))
         self.bit_seek_pos = self.byte_source.tell()*8
+        #the size is kept as state and updated by write() and truncate() so that len() and at_eof() do not need to seek
+        self.size_bits = self.byte_source.seek(0,io.SEEK_END)*8
+        self.byte_source.seek(self.bit_seek_pos//8)
     def close(self):
         """
         Pass through function to encapsulated file/IO close() method
@@ -123,20 +478,20 @@ class BitsIO(object):
         """
         If True, then the seek pointer is at the end of the file.
         If a file-like object has X bytes, this corresponds to the seek pointer being at bit 8*X.
-        
+
+        This compares against the tracked size, so changes made to a SOURCE type byte source other than through this object are not seen.
+
+        >>> b = BitsIO(b'\\x0f')
+        >>> b.seek(4)
+        4
+        >>> b.at_eof()
+        False
+        >>> b.seek(8)
+        8
+        >>> b.at_eof()
+        True
         """
-        if hasattr(self.byte_source,'get_buffer'):
-            size_bytes = len(self.byte_source.get_buffer())
-            return (self.bit_seek_pos//8) >= size_bytes
-        elif hasattr(self.byte_source,'peek'):
-            return len(self.byte_source.peek(1)) == 0
-        elif hasattr(self.byte_source,'read') and hasattr(self.byte_source,'seek') and hasattr(self.byte_source,'tell'):
-            tell = self.byte_source.tell()
-            result = len(self.byte_source.read(1)) == 0
-            self.byte_source.seek(tell)
-            return result
-        else:
-            raise Exception('Byte source does not support a way of determining if at EOF or not')
+        return self.bit_seek_pos >= self.size_bits
 
     def seek(self,offset_bits,whence=SEEK_SET):
         """
@@ -152,6 +507,10 @@ class BitsIO(object):
 
         """
 
+        if whence == SEEK_CUR:
+            #the byte source only knows the current byte, so resolve bit offsets from the current bit position
+            offset_bits += self.bit_seek_pos
+            whence = SEEK_SET
         #divmod handles positive and negative offsets correctly
         offset_bytes, remainder_bits = divmod(offset_bits,8)
         self.byte_source.seek(offset_bytes,whence)
@@ -190,6 +549,7 @@ class BitsIO(object):
         else:
             effective_size_bytes = size_bytes
         new_size_bytes = self.byte_source.truncate(effective_size_bytes)
+        self.size_bits = min(self.size_bits,effective_size_bytes*8)
         if remainder_bits > 0:
             self.byte_source.seek(-1,io.SEEK_END)
             byte_value = list(self.byte_source.read(1))
@@ -198,14 +558,22 @@ class BitsIO(object):
             self.byte_source.write(bytes([masked_byte_value]))
         self.seek(pos)
 
+    def release(self,pos_bits):
+        """
+        Allows the byte source to discard the bytes that lie completely before the given bit position.
+        This only has an effect for byte sources that support it (see ReleasableBytesIO). Returns the number of bits before the retained window.
+        """
+        byte_pos = pos_bits//8
+        if hasattr(self.byte_source,'release'):
+            self.byte_source.release(byte_pos)
+            return byte_pos*8
+        return 0
+
     def __len__(self):
         """
         Returns the total number of bits in the underlying object.
         """
-        pos = self.tell()
-        end = self.seek(0,io.SEEK_END)
-        self.seek(pos)
-        return end
+        return self.size_bits
 
     def read(self,n=None,reverse=False,invert=False):
         """
@@ -289,42 +657,71 @@ class BitsIO(object):
             loffset = end_remainder_bits
             self.byte_source.seek(end_byte_pos)
             reverse = not reverse
+        first_byte = 0
         if loffset > 0:
-            first_byte =  list(self.byte_source.read(1))[0]
-        else:
-            first_byte = 0
+            existing = self.byte_source.read(1)
+            if len(existing) > 0: #writing past the end has no existing byte to preserve
+                first_byte = existing[0]
         last_byte_lmask = ((loffset + n)%8)
         roffset = (8 - last_byte_lmask)%8
+        last_byte = 0
         if roffset > 0:
             self.byte_source.seek(last_byte_pos)
-            last_byte = list(self.byte_source.read(1))[0]
-        else:
-            last_byte = 0
+            existing = self.byte_source.read(1)
+            if len(existing) > 0:
+                last_byte = existing[0]
         self.byte_source.seek(first_byte_pos)
         bytes_data = uint_to_bytes(value,n,loffset,first_byte,last_byte,reverse,invert)
         self.byte_source.write(bytes_data)
+        self.size_bits = max(self.size_bits,self.byte_source.tell()*8)
         self.seek(end_pos)
     def reverse(self,n=None):
         """
         Reverses the next n bits in the byes object without changing the current seek position.
         If n is not specified, then reverse all bits from the current position to the end.
+
+        Regions larger than the chunk size are reversed by swapping reversed chunks from both ends of the region inwards.
         """
         start_pos = self.tell()
-        value,num_bits = self.read(n)
-        value = reverse_uint(value,num_bits)
-        self.seek(start_pos)
+        if n is None:
+            n = len(self) - start_pos
+        left = start_pos
+        right = start_pos + n
+        c = self.chunk_bits
+        while right - left >= 2*c:
+            self.seek(left)
+            lvalue,_ = self.read(c,reverse=True)
+            self.seek(right-c)
+            rvalue,_ = self.read(c,reverse=True)
+            self.seek(left)
+            self.write(rvalue,c)
+            self.seek(right-c)
+            self.write(lvalue,c)
+            left += c
+            right -= c
+        self.seek(left)
+        value,num_bits = self.read(right-left,reverse=True)
+        self.seek(left)
         self.write(value,num_bits)
         self.seek(start_pos)
     def invert(self,n=None):
         """
         Inverts the next n bits in the byes object without changing the current seek position.
         If n is not specified, then invert all bits from the current position to the end.
+
+        Regions larger than the chunk size are inverted one chunk at a time.
         """
         start_pos = self.tell()
-        value,num_bits = self.read(n)
-        value = invert_uint(value,num_bits)
-        self.seek(start_pos)
-        self.write(value,num_bits)
+        if n is None:
+            n = len(self) - start_pos
+        end_pos = start_pos + n
+        pos = start_pos
+        while pos < end_pos:
+            c = min(self.chunk_bits,end_pos-pos)
+            value,num_bits = self.read(c,invert=True)
+            self.seek(pos)
+            self.write(value,num_bits)
+            pos += c
         self.seek(start_pos)
     def __bytes__(self):
         if hasattr(self.byte_source,'getbuffer'):
@@ -366,6 +763,7 @@ class BitsIO(object):
             first_byte_value = 0
         self.write(first_byte_value,first_byte_bits)
         self.byte_source.write(bytes_data)
+        self.size_bits = max(self.size_bits,self.byte_source.tell()*8)
         self.seek(0,io.SEEK_END)
         
     def find(self,sub):
@@ -376,12 +774,33 @@ class BitsIO(object):
         if pos % 8 != 0:
             raise Exception('find() method requires bit position to be a multiple of 8')
         byte_pos = pos//8
-        if hasattr(self.byte_source,'getbuffer'):
+        if hasattr(self.byte_source,'find'):
+            found = self.byte_source.find(sub,byte_pos)
+            byte_offset = found - byte_pos if found >= 0 else -1
+        elif hasattr(self.byte_source,'getbuffer'):
             data = bytes(self.byte_source.getbuffer())[byte_pos:]
+            byte_offset = data.find(sub)
         else:
-            data = self.byte_source.read()
+            #search chunk by chunk, carrying over enough of the previous chunk to catch matches that straddle two chunks
+            chunk_bytes = self.chunk_bits//8
+            overlap = max(len(sub)-1,0)
+            byte_offset = -1
+            data_offset = 0
+            data = self.byte_source.read(chunk_bytes)
+            while len(data) > 0:
+                found = data.find(sub)
+                if found >= 0:
+                    byte_offset = data_offset + found
+                    break
+                chunk = self.byte_source.read(chunk_bytes)
+                if len(chunk) == 0:
+                    break
+                keep = min(overlap,len(data))
+                data_offset += len(data) - keep
+                data = data[len(data)-keep:] + chunk
             self.byte_source.seek(byte_pos)
-        byte_offset = data.find(sub)
+        if byte_offset < 0:
+            return -1
         bit_offset = byte_offset*8
         return bit_offset
 
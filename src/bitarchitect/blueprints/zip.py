@@ -51,8 +51,7 @@ def eocd_record(maker):
         u32 #"cd_offset" 
         u16 #"eocd_comment_len"
     ''')
-    comment_len = maker["eocd_comment_len"]
-    maker('B%d #"eocd_comment"]' % (comment_len*8))
+    maker('B..."eocd_comment_len"*8; #"eocd_comment"]')
 
 def central_directory(maker,cd_offset,cd_size):
     """
@@ -61,7 +60,7 @@ def central_directory(maker,cd_offset,cd_size):
     logger.debug('Parsing Central Directory')
     maker('[') #start collecting in a sublist for central directory entries
 
-    maker('js%d' % (cd_offset*8)) #jump to start of central directory
+    maker('js{offset}',offset=cd_offset*8) #jump to start of central directory
     cd_start_pos = maker.tell_buffer()
     cd_size_bits = cd_size*8
     file_data = OrderedDict()
@@ -75,12 +74,12 @@ def central_directory(maker,cd_offset,cd_size):
             m"02014b50" ##scan and "jump" to file entry marker 'PK\x02\x01'
             {u16}6 ##6 entries 2 bytes each
             {u32}3 ##3 entries 4 bytes each
-            {u16}5 ##5 entries 2 bytes each
+            u16 #"filename_len" u16 #"extra_field_len" u16 #"file_comment_len"
+            {u16}2 ##2 entries 2 bytes each
             {u32}2 ##2 entries 4 bytes each
         ''')
-        maker(']') #could have placed [ and ] inside middle call to maker, but then the following line would have to be n,m,k = record[0][10:13], which seems more confusing
-        n,m,k = record[10:13]
-        filename,extra_field,file_comment = maker('C%d C%d C%d' % (n*8, m*8, k*8))
+        maker(']') #could have placed [ and ] inside middle call to maker, but then the record would be wrapped in an extra list
+        filename,extra_field,file_comment = maker('C..."filename_len"*8; C..."extra_field_len"*8; C..."file_comment_len"*8;')
         file_data[filename] = [cd_entry_pos_orig,record,extra_field,file_comment]
 
     maker(']') #end sublist for central directory entries
@@ -116,7 +115,7 @@ def file_entries(maker,file_data,cd_offset):
         file_entry_size = (file_end_orig - file_entry_pos_orig)//8
 
 
-        maker('js%d' % (file_entry_pos_orig)) #jump to start of file entry
+        maker('js{pos}',pos=file_entry_pos_orig) #jump to start of file entry
 
 
         #parse local header
@@ -130,9 +129,9 @@ def file_entries(maker,file_data,cd_offset):
             #record1 will be surrounded by a list due to the leading [
         n,m = (maker["filename_len"],maker["extra_field_len"])
         record2 = maker('''
-            C%dC%d
+            C..."filename_len"*8; C..."extra_field_len"*8;
             ]
-        ''' % (n*8,m*8))
+        ''')
             #record2 will be surrounded by a list due to the trailing ]
             
         local_header_size = 30 + n + m
@@ -189,7 +188,7 @@ def file_entries(maker,file_data,cd_offset):
                 raise Exception('File entry sizes not lining up as expected')
 
         maker(']') #end subsubsublist for descriptor
-        compressed_data, = maker('C%d' % (compressed_size*8)) #get compressed data
+        compressed_data, = maker('C{n}',n=compressed_size*8) #get compressed data
         compressed_data = b'\x78\x9c' + compressed_data #add zlib header
         file_data[filename].append(compressed_data)
         uncompressed_data = zlib.decompressobj().decompress(compressed_data)
@@ -200,17 +199,9 @@ def file_entries(maker,file_data,cd_offset):
 class TestZipBlueprint(unittest.TestCase):
     def test_zip_extract(self):
         import zipfile, tempfile, os.path
-        #with tempfile.TemporaryDirectory() as tdir:
-        if 1:
-            tdir = '.'
-            #create an example zip file
-            zipfilepath = os.path.join(tdir,'test.zip')
-            if not os.path.exists(zipfilepath):
-                with zipfile.ZipFile(zipfilepath,mode='w',compression=zipfile.ZIP_DEFLATED) as zf:
-                    with zf.open('file1.txt',mode='w') as f:
-                        f.write(b'green eggs and ham')
-                    with zf.open('file2.txt',mode='w') as f:
-                        f.write(b'sam i am')
+        with tempfile.TemporaryDirectory() as tdir:
+            #example zip file holding file1.txt and file2.txt
+            zipfilepath = os.path.join(os.path.dirname(__file__),'..','..','..','tests','fixtures','test.zip')
             with open(zipfilepath,'rb') as f:
                 maker,file_data = bitarchitect.extract(zip_file,f)
             for filename,file_record in file_data.items():
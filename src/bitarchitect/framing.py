@@ -0,0 +1,118 @@
+"""
+This module provides functions that split a continuous stream of length-prefixed frames (e.g. TLV records or message streams) and apply a blueprint to each frame.
+
+A frame is a fixed width header, described by a header pattern, followed by a payload.
+One label of the header holds the payload length, which is converted to bytes as value*scale + offset.
+"""
+import mmap
+from .pattern import Extractor, Directive, Count, Placeholder, IncompleteDataError, pattern_compile
+
+_VARIABLE_WIDTH_DIRECTIVES = {Directive.TAKEALL,Directive.JUMP,Directive.MARKERSTART,Directive.MARKEREND,Directive.MODOFF,Directive.CONDITION,Directive.SWITCH}
+def _pattern_bits(compiled):
+    """
+    Returns the number of bits consumed by a compiled pattern of fixed width.
+    """
+    num_bits = 0
+    for item in compiled:
+        if isinstance(item,list):
+            if item[0] == float('inf') or isinstance(item[0],(Count,Placeholder)):
+                raise Exception('Header pattern must have a fixed width: repetition count is not fixed')
+            num_bits += item[0]*_pattern_bits(item[1:])
+        elif item[1] in _VARIABLE_WIDTH_DIRECTIVES or any(isinstance(arg,(Count,Placeholder)) for arg in item[2:]):
+            raise Exception('Header pattern must have a fixed width: %s' % item[0])
+        elif item[1] in (Directive.VALUE,Directive.NEXT,Directive.ZEROS,Directive.ONES):
+            num_bits += item[2]
+    return num_bits
+
+def split_frames(byte_stream,header_pattern,length_label,scale=1,offset=0,include_header=False,chunk_bytes=1<<16):
+    """
+    Splits a byte stream of length-prefixed frames and yields (header_record, frame) for each frame.
+
+    header_pattern = Pattern of the fixed width header at the start of every frame. It must be a whole number of bytes.
+    length_label = Label set by the header pattern that holds the payload length.
+    scale, offset = The payload length in bytes is maker[length_label]*scale + offset, e.g. offset=-4 if the length counts a 4 byte header too.
+    include_header = If True, each frame includes its header bytes. Otherwise it is only the payload.
+
+    header_record is the data record of the header pattern.
+    For bytes-like and mmap inputs the frames are memoryviews into the input, so nothing is copied.
+    File-like inputs are read chunk_bytes at a time and the frames are bytes objects.
+    A trailing frame that is cut short raises IncompleteDataError.
+
+    >>> [(header,bytes(frame)) for header,frame in split_frames(b'\\x02ab\\x00\\x01c','u8 #"n"','n')]
+    [([2], b'ab'), ([0], b''), ([1], b'c')]
+    """
+    header_bits = _pattern_bits(pattern_compile(header_pattern))
+    if header_bits % 8 != 0:
+        raise Exception('Header pattern must be a whole number of bytes: %d bits' % header_bits)
+    header_bytes = header_bits//8
+    header_maker = Extractor(b'')
+    if isinstance(byte_stream,(bytes,bytearray,memoryview,mmap.mmap)):
+        view = memoryview(byte_stream).cast('B')
+        pos = 0
+        while pos < len(view):
+            header,frame_end = _read_header(header_maker,view,pos,header_bytes,header_pattern,length_label,scale,offset)
+            yield header,view[pos if include_header else pos+header_bytes:frame_end]
+            pos = frame_end
+    else:
+        buffer = bytearray()
+        pos = 0
+        eof = False
+        while True:
+            try:
+                header,frame_end = _read_header(header_maker,buffer,pos,header_bytes,header_pattern,length_label,scale,offset)
+            except IncompleteDataError:
+                if eof:
+                    if pos >= len(buffer):
+                        break
+                    raise
+                del buffer[:pos]
+                pos = 0
+                chunk = byte_stream.read(chunk_bytes)
+                eof = len(chunk) == 0
+                buffer += chunk
+                continue
+            yield header,bytes(buffer[pos if include_header else pos+header_bytes:frame_end])
+            pos = frame_end
+
+def _read_header(header_maker,buffer,pos,header_bytes,header_pattern,length_label,scale,offset):
+    """
+    Extracts the header at pos and returns (header_record, end position of the frame).
+    """
+    if len(buffer) - pos < header_bytes:
+        raise IncompleteDataError('Frame header at byte %d needs %d bytes; %d available' % (pos,header_bytes,len(buffer)-pos))
+    header_maker.reset(buffer[pos:pos+header_bytes])
+    header = header_maker(header_pattern)
+    payload_bytes = header_maker[length_label]*scale + offset
+    if payload_bytes < 0:
+        raise Exception('Frame at byte %d has a negative payload length: %d' % (pos,payload_bytes))
+    frame_end = pos + header_bytes + payload_bytes
+    if frame_end > len(buffer):
+        raise IncompleteDataError('Frame at byte %d needs %d bytes; %d available' % (pos,frame_end-pos,len(buffer)-pos))
+    return header,frame_end
+
+def extract_frames(blueprint,byte_stream,header_pattern,length_label,*args,scale=1,offset=0,include_header=False,reuse_maker=True,**kwargs):
+    """
+    Splits a byte stream with split_frames() and extracts each frame with the blueprint.
+
+    Yields (header_record, maker, blueprint_result) for each frame.
+    If reuse_maker is True, one Extractor is reset for every frame, so the same maker object is yielded each time.
+    Its data stream and data structure are new lists for every frame, but anything else needed from it must be taken before the next frame.
+    If reuse_maker is False, every frame gets its own Extractor.
+
+    Args and kwargs are passed into the blueprint after the maker object if it is a function. For a pattern, kwargs give the values of its {name} placeholders.
+
+    >>> [(header,maker.data_stream) for header,maker,result in extract_frames('{u8}$',b'\\x02ab\\x01c','u8 #"n"','n')]
+    [([2], [97, 98]), ([1], [99])]
+    """
+    maker = None
+    for header,frame in split_frames(byte_stream,header_pattern,length_label,scale,offset,include_header):
+        if maker is None or not reuse_maker:
+            maker = Extractor(frame)
+        else:
+            maker.reset(frame)
+        if isinstance(blueprint,(bytes,str)):
+            result = maker(blueprint,**kwargs)
+        else:
+            result = blueprint(maker,*args,**kwargs)
+        maker.finalize()
+        yield header,maker,result
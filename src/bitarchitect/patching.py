@@ -0,0 +1,140 @@
+"""
+This module provides patch(), which writes new values of extracted fields straight into the input instead of constructing it again.
+
+A field can be patched when the new value has the same bit width as the old one. Only the bits of that field change in the input, so a large file is edited in place.
+The Extractor must have been created with source_map=True, which records where each field was read and how many modifications had been applied to the buffer at that point.
+Reversals and inversions that applied to a field are replayed on a copy of the input bytes they cover, the new value is written, and the modifications are undone again before the bytes are written back.
+"""
+from .bits_io import BitsIO
+from .bit_utils import Encoding, uint_decode, uint_encode
+from .pattern import ModType, get_structure_index, extract, _UnrecordedModOperations
+from .storage import LazyValue
+
+def _field_uint(value,num_bits,encoding):
+    """
+    Encodes the new value of a field of num_bits bits, checking that it has the same width.
+    """
+    if isinstance(value,LazyValue):
+        if value.num_bits != num_bits:
+            raise Exception('New value is %d bits; the field is %d bits' % (value.num_bits,num_bits))
+        return value.uint()
+    if encoding in (Encoding.BYTS,Encoding.CHAR,Encoding.BINS,Encoding.LHEX,Encoding.UHEX):
+        field_length = len(uint_decode(0,num_bits,encoding))
+        if len(value) != field_length:
+            raise Exception('New value %r has length %d; the field of %d bits has length %d' % (value,len(value),num_bits,field_length))
+    if encoding == Encoding.SINT and not -(1<<(num_bits-1)) <= value < (1<<(num_bits-1)):
+        raise Exception('New value %r does not fit in a signed field of %d bits' % (value,num_bits))
+    uint_value = uint_encode(value,num_bits,encoding)
+    if not 0 <= uint_value < (1<<num_bits):
+        raise Exception('New value %r does not fit in a field of %d bits' % (value,num_bits))
+    return uint_value
+
+def _field_window(maker,position,num_bits,mod_count):
+    """
+    Returns (start, end, operations): the bit span of the input that the field's bits came from, widened to cover every modification that moved them,
+    and those modifications from oldest to newest. Walking back from the newest modification stops once no older one reaches the span.
+    """
+    maker._modified_span() #brings the spans of the mod operations up to date
+    operations = maker.mod_operations
+    start,end = position,position+num_bits
+    window = []
+    for index in range(mod_count-1,-1,-1):
+        reach = maker._mod_prefix[index]
+        if end <= reach[0] or start >= reach[1]:
+            break
+        operation = operations[index]
+        tok,modtype,mod_start,offset,mod_bits = operation
+        mstart = mod_start + offset
+        mend = mstart + mod_bits
+        if start < mend and mstart < end:
+            start,end = min(start,mstart),max(end,mend)
+            window.append(operation)
+    window.reverse()
+    return start,end,window
+
+def _apply_operations(bits,base,operations):
+    for tok,modtype,mod_start,offset,mod_bits in operations:
+        bits.seek(mod_start+offset-base)
+        if modtype == ModType.REVERSE:
+            bits.reverse(mod_bits)
+        elif modtype == ModType.INVERT:
+            bits.invert(mod_bits)
+
+def _read_target(target,start_byte,end_byte):
+    if hasattr(target,'read'):
+        target.seek(start_byte)
+        return target.read(end_byte-start_byte)
+    return bytes(memoryview(target).cast('B')[start_byte:end_byte])
+
+def _write_target(target,start_byte,data):
+    if hasattr(target,'write'):
+        target.seek(start_byte)
+        target.write(data)
+        return
+    view = memoryview(target).cast('B')
+    if view.readonly:
+        raise Exception('patch target is read-only: %s. Use a bytearray, a writable mmap or a file opened with "r+b"' % type(target).__name__)
+    view[start_byte:start_byte+len(data)] = data
+
+def patch(maker,changes,target=None):
+    """
+    Writes new values for items of the data stream directly into the extracted input, without constructing it again.
+
+    maker = An Extractor created with source_map=True that has extracted the input. It cannot be in fast or release_consumed mode if the blueprint modified any bits.
+    changes = {stream_index: new_value}. Each new value must have the same bit width as the field it replaces, e.g. a bytes value of the same length.
+    target = Where to write: a bytearray, a writable memoryview or mmap, or a binary file opened with "r+b". Defaults to the maker's input, which must then be writable.
+
+    The maker's data stream and data structure, whichever of them its output setting keeps, are updated with the new values. Its working buffer is not, so bytes(maker) is unchanged.
+
+    >>> data = bytearray(b'\\x02abcd')
+    >>> maker,result = extract('u8 {B16}2',data,source_map=True)
+    >>> patch(maker,{2:b'xy'})
+    >>> data, maker.data_structure
+    (bytearray(b'\\x02abxy'), [2, b'ab', b'xy'])
+    """
+    if maker.source_map is None:
+        raise Exception('patch requires an Extractor created with source_map=True')
+    if target is None:
+        target = maker.byte_stream
+    operations = maker.mod_operations
+    if isinstance(operations,_UnrecordedModOperations) and operations.span is not None:
+        raise Exception('patch cannot undo the modifications of a fast Extractor')
+    if maker.release_consumed and len(operations) > 0:
+        raise Exception('patch cannot undo the modifications of an Extractor with release_consumed=True')
+    source_map = maker.source_map
+    for index,value in changes.items():
+        position = source_map.position(index)
+        num_bits = source_map.num_bits(index)
+        encoding = source_map.encoding(index)
+        if encoding is None:
+            raise Exception('Item %d of the data stream does not come from a field of the input' % index)
+        uint_value = _field_uint(value,num_bits,encoding)
+        if isinstance(operations,_UnrecordedModOperations):
+            start,end,window = position,position+num_bits,[]
+        else:
+            start,end,window = _field_window(maker,position,num_bits,source_map.mod_count(index))
+        start_byte = start//8
+        end_byte = -(-end//8)
+        data = _read_target(target,start_byte,end_byte)
+        if len(data) != end_byte-start_byte:
+            raise Exception('Item %d of the data stream is beyond the end of the patch target' % index)
+        base = start_byte*8
+        bits = BitsIO(bytes(data))
+        _apply_operations(bits,base,window)
+        bits.seek(position-base)
+        bits.write(uint_value,num_bits)
+        _apply_operations(bits,base,reversed(window))
+        _write_target(target,start_byte,bytes(bits))
+
+    if maker.keep_stream:
+        for index,value in changes.items():
+            maker.data_stream[index] = value
+    if maker.keep_structure:
+        flat_pattern = maker.flat_pattern
+        for index,value in changes.items():
+            *path,last = get_structure_index(flat_pattern,index)
+            target_list = maker.data_structure
+            for pos in path:
+                target_list = target_list[pos]
+            target_list[last] = value
+    maker._derived.clear()
@@ -1,11 +1,25 @@
-import re, ast, io
+import re, ast, io, mmap
+from array import array
+from bisect import bisect_right
+from itertools import islice
 from enum import Enum
 from math import ceil
-from .bits_io import SEEK_SET, SEEK_CUR, SEEK_END, uint_to_bytes, bytes_to_uint, BitsIO, reverse_bytes, invert_bytes
-from .bit_utils import Encoding
+from functools import lru_cache
+from collections.abc import Sequence
+from .bits_io import SEEK_SET, SEEK_CUR, SEEK_END, uint_to_bytes, bytes_to_uint, BitsIO, ByteSourceType, ReleasableBytesIO, reverse_bytes, invert_bytes
+from .bit_utils import Encoding, uint_decode, uint_encode
+from .storage import CompactList, SparseList, PatternBuffer, ValueInterner, LazyValue, LAZY_ENCODINGS, SourceMap
 from base64 import b16decode
 import logarhythm
 
+#loggers are shared by all makers; messages are only formatted when debug logging is enabled
+_parse_logger = logarhythm.getLogger('parse_pattern')
+_parse_logger.format = logarhythm.build_format(time=None,level=False)
+_extractor_logger = logarhythm.getLogger('Extractor')
+_extractor_logger.format = logarhythm.build_format(time=None,level=False)
+_constructor_logger = logarhythm.getLogger('Constructor')
+_constructor_logger.format = logarhythm.build_format(time=None,level=False)
+
 class Directive(Enum):
     """
     This enumeration defines the directives represented by different pattern tokens
@@ -27,6 +41,8 @@ class Directive(Enum):
     JUMP = 15 #args = (num_bits,jump_type)
     MARKERSTART = 16 #args = (byte_literal)
     MARKEREND = 17 #args = (byte_literal)
+    CONDITION = 18 #args = (label,then_pattern,else_pattern)
+    SWITCH = 19 #args = (label,cases,default_pattern)
 
 
 class ModType(Enum):
@@ -56,25 +72,226 @@ class JumpType(Enum):
     BACKWARD=3
     END=4
 
-def pattern_parse(pattern):
+class Count():
+    """
+    A number of bits or repetitions that is read from a label when the token is applied: label value * scale / divisor + offset.
+    Patterns write this as ..."label" in place of the number, followed by optional *scale or /divisor, optional +offset or -offset, and a closing ";".
+
+    >>> Count('len',scale=8,offset=-16).resolve({'len':5})
+    24
+    >>> Count('len',scale=8,offset=-16).invert(24)
+    5
+    """
+    def __init__(self,label,scale=1,divisor=1,offset=0):
+        self.label = label
+        self.scale = scale
+        self.divisor = divisor
+        self.offset = offset
+    def resolve(self,maker):
+        """
+        Returns the count for the current value of the label in the maker (or any mapping of labels to values).
+        """
+        value = maker[self.label]
+        if not isinstance(value,int):
+            raise Exception('Label "%s" must hold an integer to be used as a count: %r' % (self.label,value))
+        value *= self.scale
+        if value % self.divisor != 0:
+            raise Exception('Label "%s" value %d*%d is not divisible by %d' % (self.label,maker[self.label],self.scale,self.divisor))
+        return value//self.divisor + self.offset
+    def invert(self,count):
+        """
+        Returns the label value that resolves to the given count.
+        """
+        value = (count - self.offset)*self.divisor
+        if value % self.scale != 0:
+            raise Exception('Count %d cannot be expressed through label "%s" with scale %d' % (count,self.label,self.scale))
+        return value//self.scale
+    def __eq__(self,other):
+        return isinstance(other,Count) and (self.label,self.scale,self.divisor,self.offset) == (other.label,other.scale,other.divisor,other.offset)
+    def __hash__(self):
+        return hash((self.label,self.scale,self.divisor,self.offset))
+    def __repr__(self):
+        return 'Count(%r,scale=%d,divisor=%d,offset=%d)' % (self.label,self.scale,self.divisor,self.offset)
+
+class Placeholder():
+    """
+    A named number in a pattern, written as {name}, whose value is bound when the pattern is applied e.g. maker('js{offset}',offset=n).
+    """
+    def __init__(self,name):
+        self.name = name
+    def __eq__(self,other):
+        return isinstance(other,Placeholder) and self.name == other.name
+    def __hash__(self):
+        return hash(self.name)
+    def __repr__(self):
+        return 'Placeholder(%r)' % self.name
+
+class CompiledPattern(list):
+    """
+    The list of instructions and repetition captures returned by pattern_compile().
+    placeholders is the set of placeholder names in the pattern, and placeholder_items lists the indices of the top level items that contain them,
+    so that binding only has to copy those items.
+    """
+    def __init__(self,items=(),placeholders=frozenset(),placeholder_items=()):
+        list.__init__(self,items)
+        self.placeholders = placeholders
+        self.placeholder_items = placeholder_items
+
+def _bind_item(item,params):
+    if isinstance(item,list):
+        return [_bind_item(sub_item,params) if isinstance(sub_item,list) or isinstance(sub_item,tuple) else _bind_value(sub_item,params) for sub_item in item]
+    return tuple(_bind_value(arg,params) for arg in item)
+
+def _bind_compiled(compiled,params):
+    bound = list(compiled)
+    for index in compiled.placeholder_items:
+        bound[index] = _bind_item(bound[index],params)
+    return bound
+
+def _bind_value(value,params):
+    if isinstance(value,CompiledPattern): #branch of a CONDITION or SWITCH
+        if len(value.placeholders) == 0:
+            return value
+        return CompiledPattern(_bind_compiled(value,params))
+    if isinstance(value,dict): #cases of a SWITCH
+        return {case:_bind_value(case_pattern,params) for case,case_pattern in value.items()}
+    if not isinstance(value,Placeholder):
+        return value
+    return params[value.name]
+
+def pattern_bind(compiled,params):
+    """
+    Returns a copy of a compiled pattern with its placeholders replaced by the values in params.
+    Numbers are bound to integers.
+    Only the top level items that contain placeholders are copied.
+
+    >>> pattern_bind(pattern_compile('u8 {u4}{n} js{off}'),{'n':2,'off':16})
+    [('u8', <Directive.VALUE: 1>, 8, <Encoding.UINT: 1>), [2, ('u4', <Directive.VALUE: 1>, 4, <Encoding.UINT: 1>)], ('js{off}', <Directive.JUMP: 15>, 16, <JumpType.START: 1>)]
+    """
+    missing = compiled.placeholders.difference(params)
+    if len(missing) > 0:
+        raise Exception('No values given for pattern placeholders: %s' % ', '.join(sorted(missing)))
+    unknown = set(params).difference(compiled.placeholders)
+    if len(unknown) > 0:
+        raise Exception('Values given for names that are not pattern placeholders: %s' % ', '.join(sorted(unknown)))
+    return _bind_compiled(compiled,params)
+
+def _has_placeholder(item):
+    if isinstance(item,list):
+        return any(_has_placeholder(sub_item) if isinstance(sub_item,(list,tuple)) else isinstance(sub_item,Placeholder) for sub_item in item)
+    return any(_arg_has_placeholder(arg) for arg in item)
+
+def _arg_has_placeholder(arg):
+    if isinstance(arg,CompiledPattern):
+        return len(arg.placeholders) > 0
+    if isinstance(arg,dict):
+        return any(_arg_has_placeholder(case_pattern) for case_pattern in arg.values())
+    return isinstance(arg,Placeholder)
+
+def pattern_parse(pattern,maker=None,params=None):
     """
     Interprets the provided pattern into a sequence of directives and arguments that are provided to a maker.
 
     Yields tuples where the first element is the matched token string, the second is the directive enum value, and the rest are the arguments for that directive.
+
+    If a maker is provided, each iteration of an infinite repetition {...}$ first checks maker.at_eof() and the repetition ends cleanly once it is True.
+    An iteration that neither moves the seek position nor inserts or consumes a value raises an exception, since the repetition would never reach the end.
+    Without a maker an infinite repetition never ends on its own.
+    Conditions and switches read their label from the maker when they are reached, so they require a maker.
+
+    params is a dictionary of values for the {name} placeholders of the pattern.
+    """
+    compiled = pattern_compile(pattern)
+    if params or compiled.placeholders:
+        compiled = pattern_bind(compiled,params or {})
+    yield from _process_items(compiled,_parse_logger,maker)
+
+PATTERN_CACHE_SIZE = 256 #number of compiled patterns kept by pattern_compile()
+
+_definitions = {} #name: (repetition capture [1, ...] of the compiled definition, placeholder names, source text); the capture is shared by every pattern that references it
+_definition_parse = re.compile('^\\s*@(\\w+)\\s*:=',re.M)
+_reference_parse = re.compile('@(\\w+)')
+
+def pattern_define(definitions):
+    """
+    Defines named sub-patterns that other patterns reference as @<name>.
+
+    definitions is a string of one or more definitions, each starting on its own line as @<name> := <pattern>.
+    A definition runs until the next definition or the end of the string, so it may span several lines.
+    Each definition is compiled once, and every pattern that references it shares the same compiled instructions.
+    A definition may reference definitions made before it. Redefining a name compiles the definitions that reference it again and clears the cache of compiled patterns.
+
+    >>> pattern_define('''
+    ...     @point := [u8 u8]
+    ...     @points := u8 #"count" {@point}..."count";
+    ... ''')
+    >>> Extractor(b'\\x02\\x01\\x02\\x03\\x04')('@points')
+    [2, [1, 2], [3, 4]]
     """
-    logger = logarhythm.getLogger('parse_pattern')
-    logger.format = logarhythm.build_format(time=None,level=False)
-    logger.debug('pattern started')
+    matches = list(_definition_parse.finditer(definitions))
+    if len(matches) == 0 and definitions.strip() != '':
+        raise Exception('Definitions must start with @<name> := : %s' % (definitions.strip()[:20]+'...'))
+    stale = set()
+    for index,match in enumerate(matches):
+        name = match.group(1)
+        end = matches[index+1].start(0) if index+1 < len(matches) else len(definitions)
+        text = definitions[match.end(0):end]
+        if name in _definitions:
+            stale.add(name)
+            pattern_compile.cache_clear() #cached patterns may hold the old version
+        compiled = pattern_compile(text)
+        _definitions[name] = ([1]+compiled,compiled.placeholders,text)
+    if len(stale) > 0:
+        pattern_compile.cache_clear()
+        for name,(definition,definition_placeholders,text) in list(_definitions.items()): #a definition only references earlier ones, so dependents come later
+            if stale.intersection(_reference_parse.findall(text)):
+                compiled = pattern_compile(text)
+                _definitions[name] = ([1]+compiled,compiled.placeholders,text)
+                stale.add(name)
+        pattern_compile.cache_clear()
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def pattern_compile(pattern):
+    """
+    Parses the provided pattern into a list of instructions without expanding repetitions.
+
+    Each element is either an instruction tuple as yielded by pattern_parse() or a repetition capture.
+    A repetition capture is a list whose first element is the repetition count (float('inf') for {...}$) and whose remaining elements are the instructions and nested captures being repeated.
+    Compiled patterns are cached, so a pattern used repeatedly is only parsed once. The returned list is shared and must not be modified.
+    Numbers given as ..."label" counts are compiled to Count objects and resolved by the maker when the token is applied.
+    Numbers given as {name} placeholders are compiled to Placeholder objects and bound with pattern_bind().
+    Conditions and switches are compiled to a single instruction whose branches are compiled patterns of their own.
+
+    >>> pattern_compile('?#"f"{u8}{} ?="n"1:{u4} *:{};')[0]
+    ('?#"f"{u8}{}', <Directive.CONDITION: 18>, 'f', [('u8', <Directive.VALUE: 1>, 8, <Encoding.UINT: 1>)], [])
+
+    >>> pattern_compile('u8 {u4 [n4]}3')
+    [('u8', <Directive.VALUE: 1>, 8, <Encoding.UINT: 1>), [3, ('u4', <Directive.VALUE: 1>, 4, <Encoding.UINT: 1>), ('[', <Directive.NESTOPEN: 11>), ('n4', <Directive.NEXT: 2>, 4), (']', <Directive.NESTCLOSE: 12>)]]
+    >>> pattern_compile('u8 #"n" B..."n"*8; {u4}..."n";')
+    [('u8', <Directive.VALUE: 1>, 8, <Encoding.UINT: 1>), ('#"n"', <Directive.SETLABEL: 8>, 'n'), ('B..."n"*8;', <Directive.VALUE: 1>, Count('n',scale=8,divisor=1,offset=0), <Encoding.BYTS: 8>), [Count('n',scale=1,divisor=1,offset=0), ('u4', <Directive.VALUE: 1>, 4, <Encoding.UINT: 1>)]]
+    """
+    logger = _parse_logger
+    debugging = logger.will_log(logarhythm.DEBUG)
+    if debugging:
+        logger.debug('pattern started')
     pattern = pattern.strip()
+    compiled = []
+    placeholders = set()
+    placeholder_items = []
     pos = 0
-    tok_parse = re.compile('\\s*([rip]\\d+\\.(?:\\d+|$)|[usfxXbBnpjJrizoeC]\\d+|[RIE][ynt]|!#"|#["#]|=#"|[\\[\\]=\\{\\}]|[riBC]$|m[$^]"|j[sfbe]\\d+)')
+    num = '(?:\\d+|\\{\\w+\\})' #a number or a {name} placeholder
+    tok_parse = re.compile('\\s*([rip]'+num+'\\.(?:'+num+'|$)|[usfxXbBnpjJrizoeC]'+num+'|[usxXbBCnzo]\\.\\.\\."|[RIE][ynt]|!#"|#["#]|=#"|[\\[\\]=\\{\\}]|[riBC]$|m[$^]"|j[sfbe]'+num+'|\\?[#=]"|@\\w+)')
     label_parse = re.compile('([^"]+)"')
     space_equals_parse = re.compile('\\s*=')
     expr_parse = re.compile('([^;]+);')
     num_parse = re.compile('\\d+')
-    num_inf_parse = re.compile('\\d+|\\$')
+    num_inf_parse = re.compile('\\d+|\\$|\\.\\.\\."|\\{\\w+\\}')
+    count_expr_parse = re.compile('\\s*(?:([*/])\\s*(\\d+))?\\s*(?:([+-])\\s*(\\d+))?\\s*;')
     comment_parse = re.compile('.*?$',re.S|re.M)
     hex_parse = re.compile('([A-F0-9a-f]+)\"')
+    branch_open_parse = re.compile('\\s*\\{')
+    case_parse = re.compile('\\s*(?:(\\*)|(.+?))\\s*:\\s*\\{',re.S)
+    switch_end_parse = re.compile('\\s*;')
 
     no_arg_codes = {
             '[': Directive.NESTOPEN,
@@ -120,6 +337,38 @@ def pattern_parse(pattern):
             'e':JumpType.END,
             }
 
+    def parse_num(text):
+        #parses a number or a {name} placeholder
+        if text.startswith('{'):
+            placeholders.add(text[1:-1])
+            return Placeholder(text[1:-1])
+        return int(text)
+
+    def parse_count(pos):
+        #parses the rest of a ..."label"*scale+offset; count after the ..." that has been matched
+        labelmatch = label_parse.match(pattern,pos)
+        count_expr_match = count_expr_parse.match(pattern,labelmatch.end(0))
+        if count_expr_match is None:
+            raise Exception('Count must end with ";" after position %d: %s' % (pos,pattern[pos:pos+20]+'...'))
+        multiply,multiply_num,add,add_num = count_expr_match.groups()
+        scale = divisor = 1
+        offset = 0
+        if multiply == '*':
+            scale = int(multiply_num)
+        elif multiply == '/':
+            divisor = int(multiply_num)
+        if add is not None:
+            offset = int(add_num) if add == '+' else -int(add_num)
+        count = Count(labelmatch.group(1),scale,divisor,offset)
+        return count,pattern[pos:count_expr_match.end(0)],count_expr_match.end(0)
+
+    def parse_branch(pos):
+        #compiles the {...} branch of a condition or switch whose "{" has been matched before pos
+        end = _matching_brace(pattern,pos)
+        branch = pattern_compile(pattern[pos:end])
+        placeholders.update(branch.placeholders)
+        return branch,pattern[pos:end+1],end+1
+
     repetition_stack = []
 
     tokmatch = tok_parse.match(pattern,pos)
@@ -132,15 +381,23 @@ def pattern_parse(pattern):
 
         instruction = None
         
-        if '.' in tok: #MODOFF
+        if tok.endswith('..."'): #VALUE, NEXT, ZEROS, ONES with a count from a label
+            count,count_text,pos = parse_count(pos)
+            tok += count_text
+            if code in num_codes:
+                instruction = (tok,num_codes[code],count)
+            else:
+                directive,arg = num_and_arg_codes[code]
+                instruction = (tok,directive,count,arg)
+        elif '.' in tok: #MODOFF
             if '$' in tok: #MODOFF with $
-                m = int(tok[1:].split('.')[0])
+                m = parse_num(tok[1:].split('.')[0])
                 n = None
                 directive,modtype = modoff_codes[code]
                 instruction = (tok,directive,m,n,modtype)
 
             else: #MODOFF with numbers
-                m,n = [int(x) for x in tok[1:].split('.')]
+                m,n = [parse_num(x) for x in tok[1:].split('.')]
                 directive,modtype = modoff_codes[code]
                 instruction = (tok,directive,m,n,modtype)
         elif tok == 'B$': #TAKEALL BYTS
@@ -153,10 +410,10 @@ def pattern_parse(pattern):
             instruction = (tok,Directive.MOD,None,ModType.REVERSE)
         elif code in num_and_arg_codes: #VALUE, MOD
             directive,arg = num_and_arg_codes[code]
-            n = int(tok[1:])
+            n = parse_num(tok[1:])
             if code in negate_num_codes:
                 n = -n
-            if code == 'e':
+            if code == 'e' and isinstance(n,int):
                 if n % 8 != 0:
                     raise Exception('"e" tokens must have a size that is a multiple of 8 bits: %s' % tok)
             instruction = (tok,directive,n,arg)
@@ -169,7 +426,7 @@ def pattern_parse(pattern):
             instruction = (tok,directive,modtype,setting)
         elif code in num_codes: #ZEROS, ONES, NEXT
             directive= num_codes[code]
-            n = int(tok[1:])
+            n = parse_num(tok[1:])
             instruction = (tok,directive,n)
         elif tok == '#"': #SETLABEL
             labelmatch = label_parse.match(pattern,pos)
@@ -211,24 +468,32 @@ def pattern_parse(pattern):
             if len(repetition_stack) > 0: #if nested repetition, need to connect previous capture to this new one
                 repetition_stack[-1].append(new_capture)
             repetition_stack.append(new_capture) #new capture is focus now
-            logger.debug('Beginning "{" repetition level %d' % len(repetition_stack))
+            if debugging:
+                logger.debug('Beginning "{" repetition level %d' % len(repetition_stack))
         elif tok == '}': #REPETITION CAPTURE END
-            logger.debug('Ending "}" repetition level %d' % len(repetition_stack))
+            if debugging:
+                logger.debug('Ending "}" repetition level %d' % len(repetition_stack))
             repetition_capture = repetition_stack.pop(-1)
             num_inf_match = num_inf_parse.match(pattern,pos) #collect number
             tok += num_inf_match.group(0)
             pos = num_inf_match.end(0)
             if num_inf_match.group(0) == '$':
                 repetition_capture[0] = float('inf')
+            elif num_inf_match.group(0) == '..."':
+                repetition_capture[0],count_text,pos = parse_count(pos)
+                tok += count_text
             else:
-                repetition_capture[0] = int(num_inf_match.group(0)) #population first element with repetition number
+                repetition_capture[0] = parse_num(num_inf_match.group(0)) #population first element with repetition number
             if len(repetition_stack) == 0: #if all repetitions are done
-                yield from _process_repetition_capture(repetition_capture,logger)
+                if _has_placeholder(repetition_capture):
+                    placeholder_items.append(len(compiled))
+                compiled.append(repetition_capture)
         elif tok == '##': #COMMENT
             comment_match = comment_parse.match(pattern,pos)
             tok += comment_match.group(0)
             pos = comment_match.end(0)
-            logger.debug('Comment: %s' % tok)
+            if debugging:
+                logger.debug('Comment: %s' % tok)
         elif tok.startswith('m'): 
             if tok[1] == '^': #MARKERSTART
                 directive = Directive.MARKERSTART
@@ -240,9 +505,59 @@ def pattern_parse(pattern):
             hex_literal = hexmatch.group(1)
             byte_literal = b16decode(hex_literal,True)
             instruction = (tok,directive,byte_literal)
+        elif tok == '?#"': #CONDITION
+            labelmatch = label_parse.match(pattern,pos)
+            tok += labelmatch.group(0)
+            pos = labelmatch.end(0)
+            label = labelmatch.group(1)
+            branches = []
+            for branch_name in ('then','else'):
+                open_match = branch_open_parse.match(pattern,pos)
+                if open_match is None:
+                    raise Exception('Condition must be followed by {then}{else} after position %d: %s' % (pos,pattern[pos:pos+20]+'...'))
+                tok += open_match.group(0)
+                branch,branch_text,pos = parse_branch(open_match.end(0))
+                tok += branch_text
+                branches.append(branch)
+            instruction = (tok,Directive.CONDITION,label,branches[0],branches[1])
+        elif tok == '?="': #SWITCH
+            labelmatch = label_parse.match(pattern,pos)
+            tok += labelmatch.group(0)
+            pos = labelmatch.end(0)
+            label = labelmatch.group(1)
+            cases = {}
+            default = None
+            end_match = switch_end_parse.match(pattern,pos)
+            while end_match is None:
+                case_match = case_parse.match(pattern,pos)
+                if case_match is None:
+                    raise Exception('Switch cases must be <value>:{...} or *:{...} and end with ";" after position %d: %s' % (pos,pattern[pos:pos+20]+'...'))
+                tok += case_match.group(0)
+                branch,branch_text,pos = parse_branch(case_match.end(0))
+                tok += branch_text
+                if case_match.group(1) is not None:
+                    default = branch
+                else:
+                    cases[ast.literal_eval(case_match.group(2))] = branch
+                end_match = switch_end_parse.match(pattern,pos)
+            tok += end_match.group(0)
+            pos = end_match.end(0)
+            instruction = (tok,Directive.SWITCH,label,cases,default)
+        elif code == '@': #DEFINITION REFERENCE
+            try:
+                definition,definition_placeholders,text = _definitions[tok[1:]]
+            except KeyError:
+                raise Exception('Undefined pattern definition: %s' % tok)
+            placeholders.update(definition_placeholders)
+            if len(repetition_stack) > 0:
+                repetition_stack[-1].append(definition)
+            else:
+                if len(definition_placeholders) > 0:
+                    placeholder_items.append(len(compiled))
+                compiled.append(definition)
         elif code == 'j':
             code2 = tok[1]
-            num_bits = int(tok[2:])
+            num_bits = parse_num(tok[2:])
             jump_type = jump_codes[code2]
             instruction = (tok,Directive.JUMP,num_bits,jump_type)
         else:
@@ -250,39 +565,118 @@ def pattern_parse(pattern):
 
         if instruction is not None:
             if len(repetition_stack) > 0:
-                logger.debug('store rep level %d %s' % (len(repetition_stack),repr(instruction)))
+                if debugging:
+                    logger.debug('store rep level %d %s' % (len(repetition_stack),repr(instruction)))
                 repetition_stack[-1].append(instruction)
             else:
-                logger.debug('yield %s' % (repr(instruction)))
-                yield instruction
+                if debugging:
+                    logger.debug('compile %s' % (repr(instruction)))
+                if _has_placeholder(instruction):
+                    placeholder_items.append(len(compiled))
+                compiled.append(instruction)
         tokmatch = tok_parse.match(pattern,pos)
         if tokmatch is not None:
             pos = tokmatch.end(0)
     if pos < len(pattern):
         raise Exception('Unable to parse pattern after position %d: %s' % (pos,pattern[pos:pos+20]+'...'))
-    logger.debug('pattern completed')
-def _process_repetition_capture(repetition_capture,logger):
+    if debugging:
+        logger.debug('pattern completed')
+    return CompiledPattern(compiled,frozenset(placeholders),tuple(placeholder_items))
+
+def _matching_brace(pattern,pos):
+    """
+    Returns the position of the "}" that closes the "{" just before pos, skipping over quoted labels and literals and over comments.
+    """
+    depth = 1
+    while pos < len(pattern):
+        c = pattern[pos]
+        if c == '"':
+            pos = pattern.find('"',pos+1)
+            if pos < 0:
+                break
+        elif pattern.startswith('##',pos):
+            pos = pattern.find('\n',pos)
+            if pos < 0:
+                break
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return pos
+        pos += 1
+    raise Exception('Unable to find the "}" that ends the branch at position %d: %s' % (pos,pattern[pos:pos+20]+'...'))
+
+_BRANCH_DIRECTIVES = {Directive.CONDITION,Directive.SWITCH}
+
+def _process_items(items,logger,maker=None):
+    for item in items:
+        if isinstance(item,list):
+            yield from _process_repetition_capture(item,logger,maker)
+        elif item[1] in _BRANCH_DIRECTIVES:
+            yield from _process_branch(item,logger,maker)
+        else:
+            yield item
+
+def _process_branch(instruction,logger,maker=None):
+    tok,directive,label = instruction[:3]
+    if maker is None:
+        raise Exception('Token = %s; A branch on label "%s" requires a maker' % (tok,label))
+    value = maker[label]
+    if directive == Directive.CONDITION:
+        branch = instruction[3] if value else instruction[4]
+    else:
+        cases,default = instruction[3:]
+        try:
+            branch = cases.get(value,default)
+        except TypeError: #unhashable values match no case
+            branch = default
+        if branch is None:
+            raise Exception('Token = %s; No case for value %s of label "%s"' % (tok,repr(value),label))
+    if logger.will_log(logarhythm.DEBUG):
+        logger.debug('branch on %s = %s' % (label,repr(value)))
+    yield from _process_items(branch,logger,maker)
+
+def _process_repetition_capture(repetition_capture,logger,maker=None):
     count = repetition_capture[0]
+    if isinstance(count,Count):
+        if maker is None:
+            raise Exception('A repetition count from label "%s" requires a maker' % count.label)
+        count = count.resolve(maker)
+    debugging = logger.will_log(logarhythm.DEBUG)
     if count == float('inf'):
         iteration = 0
-        while True:
+        while maker is None or not maker.at_eof():
+            if maker is not None:
+                progress = maker._repeat_progress()
             for item in repetition_capture[1:]:
                 if isinstance(item,list):
-                    yield from _process_repetition_capture(item,logger)
+                    yield from _process_repetition_capture(item,logger,maker)
+                elif item[1] in _BRANCH_DIRECTIVES:
+                    yield from _process_branch(item,logger,maker)
                 else:
-                    logger.debug('repetition %d yield %s' % (iteration+1,repr(item)))
+                    if debugging:
+                        logger.debug('repetition %d yield %s' % (iteration+1,repr(item)))
                     yield item
+            if maker is not None and maker._repeat_progress() == progress:
+                raise Exception('Iteration %d of a {...}$ repetition made no progress towards the end, so the repetition would never end' % (iteration+1))
             iteration += 1
     else:
         for iteration in range(count):
             for item in repetition_capture[1:]:
                 if isinstance(item,list):
-                    yield from _process_repetition_capture(item,logger)
+                    yield from _process_repetition_capture(item,logger,maker)
+                elif item[1] in _BRANCH_DIRECTIVES:
+                    yield from _process_branch(item,logger,maker)
                 else:
-                    logger.debug('repetition %d yield %s' % (iteration+1,repr(item)))
+                    if debugging:
+                        logger.debug('repetition %d yield %s' % (iteration+1,repr(item)))
                     yield item
 
 
+RELEASE_PAGE_BYTES = 1<<16 #how far the seek position moves past the retained window before an Extractor with release_consumed=True releases it
+PARALLEL_MIN_BYTES = 1<<16 #smallest run of fixed width records that an Extractor with parallel_workers splits across its pool
+
 class ZerosError(Exception):pass
 class OnesError(Exception):pass
 class AssertionError(Exception):pass
@@ -290,9 +684,16 @@ class IncompleteDataError(Exception):pass
 class MatchLabelError(Exception):pass
 class NestingError(Exception):pass
 
+_BULK_RUN = 8 #shortest list or run of values that flatten() and deflatten() copy in bulk; shorter ones are cheaper item by item
+
+def _is_flat(target):
+    #True if target has no sublists, checked per distinct item type rather than per item
+    return not any(issubclass(item_type,(list,tuple)) for item_type in set(map(type,target)))
+
 def flatten(data_structure):
     """
     The flatten function takes a nested data structure (list of lists of lists etc) and returns a flattened version of it (list of values) as well as a flatten pattern that stores the nesting information.
+    Lists without sublists are copied in bulk.
 
     >>> flatten([1,'abc',[0,[1,1,[5]],'def'],9,10,11])
     ([1, 'abc', 0, 1, 1, 5, 'def', 9, 10, 11], '..[.[..[.]].]...')
@@ -302,6 +703,10 @@ def flatten(data_structure):
     stack = [[data_structure,0]]
     while len(stack) > 0:
         target,pos = stack[-1]
+        if pos == 0 and len(target) >= _BULK_RUN and _is_flat(target):
+            data_stream.extend(target)
+            structure_pattern.append('.'*len(target))
+            pos = stack[-1][1] = len(target)
         if pos >= len(target):
             stack.pop(-1)
             structure_pattern.append(']')
@@ -316,33 +721,157 @@ def flatten(data_structure):
                 structure_pattern.append('.')
     structure_pattern.pop(-1) #remove trailing ]
     return data_stream,''.join(structure_pattern)
+def iter_flatten(data_structure):
+    """
+    Yields the values of a nested data structure in the same order as flatten(), without building the data stream.
+    data_structure may be any iterable, including an iterator or generator, and its sublists are walked as they are reached.
+
+    >>> list(iter_flatten(iter([1,'abc',(0,[1,1,[5]],'def'),9])))
+    [1, 'abc', 0, 1, 1, 5, 'def', 9]
+    """
+    stack = [iter(data_structure)]
+    while len(stack) > 0:
+        for item in stack[-1]:
+            if isinstance(item,(list,tuple)):
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop(-1)
+
+_structure_token = re.compile(r'\.+|.',re.S) #a run of values or a single other character
+_structure_split = re.compile(r'([\[\]])')
+
 def deflatten(structure_pattern,data_stream):
     """
     The deflatten function takes a structure pattern flat and a data stream (list of values), and produces a nested data structure according to those inputs.
-    This is the inverse function of flatten()
+    This is the inverse function of flatten(). When the runs of values are long on average, each run is copied into its list in bulk.
     >>> deflatten('..[.[..[.]].]...',[1, 'abc', 0, 1, 1, 5, 'def', 9, 10, 11])
     [1, 'abc', [0, [1, 1, [5]], 'def'], 9, 10, 11]
     """
+    if not isinstance(structure_pattern,str):
+        structure_pattern = ''.join(structure_pattern)
     data_structure = []
     stack = [data_structure]
-    pos = 0
-    for token in structure_pattern:
-        if token == '[':
+    target = data_structure
+    values = iter(data_stream)
+    num_nests = structure_pattern.count('[')
+    if len(structure_pattern) - 2*num_nests >= _BULK_RUN*(num_nests+1): #long runs of values on average
+        tokens = _structure_split.split(structure_pattern)
+    else:
+        tokens = structure_pattern
+    for token in tokens:
+        if token == '.':
+            target.append(next(values))
+        elif token == '[':
             new_sublist = []
-            stack[-1].append(new_sublist)
+            target.append(new_sublist)
             stack.append(new_sublist)
+            target = new_sublist
         elif token == ']':
             stack.pop(-1)
-        elif token == '.':
-            stack[-1].append(data_stream[pos])
-            pos += 1
+            target = stack[-1]
+        elif token:
+            target.extend(islice(values,token.count('.')))
     return data_structure
 
+class StructureIndex():
+    """
+    Translates between stream indices and structure indices of one structure pattern without scanning the pattern for every lookup.
+    It is built once in a single pass and holds, for every list in the structure, the stream index at which each of its items starts and which of its items are sublists.
+    stream_index() then takes O(depth) steps and structure_index() takes O(depth*log(n)) steps.
+
+    >>> index = StructureIndex('..[[[.]..].].')
+    >>> index.stream_index([2,1]), index.structure_index(3), len(index)
+    (5, [2, 0, 1], 7)
+    """
+    def __init__(self,structure_pattern):
+        if not isinstance(structure_pattern,str):
+            structure_pattern = ''.join(structure_pattern)
+        self.structure_pattern = structure_pattern
+        self.starts = [array('q')] #per list: stream index at which each item starts
+        self.sublists = [{}] #per list: item position -> list number of the items that are sublists
+        self.invalid = None #first invalid character; the index stops there, so only lookups past it fail
+        stack = [0]
+        stream_index = 0
+        for match in _structure_token.finditer(structure_pattern):
+            token = match.group()
+            node = stack[-1]
+            if token == '[':
+                self.sublists[node][len(self.starts[node])] = len(self.starts)
+                self.starts[node].append(stream_index)
+                stack.append(len(self.starts))
+                self.starts.append(array('q'))
+                self.sublists.append({})
+            elif token == ']':
+                if len(stack) == 1:
+                    raise NestingError('There exists a "]" with no matching "["')
+                stack.pop(-1)
+            elif token[0] == '.':
+                self.starts[node].extend(range(stream_index,stream_index+len(token)))
+                stream_index += len(token)
+            else:
+                self.invalid = token
+                break
+        self.length = stream_index
+
+    def __len__(self):
+        return self.length
+
+    def _not_found(self,message):
+        if self.invalid is not None:
+            return Exception('Invalid character in structure pattern: %s' % repr(self.invalid))
+        return Exception(message)
+
+    def stream_index(self,structure_index):
+        """
+        Returns the stream index of the value that the sequence of structure indices points to.
+        """
+        structure_index = list(structure_index)
+        node = 0
+        for depth,pos in enumerate(structure_index):
+            if not 0 <= pos < len(self.starts[node]):
+                raise self._not_found('Provided structure_index does not exist in the provided structure pattern')
+            if pos in self.sublists[node]:
+                node = self.sublists[node][pos]
+            elif depth == len(structure_index)-1:
+                return self.starts[node][pos]
+            else:
+                raise Exception('Provided structure_index does not exist in the provided structure pattern')
+        raise Exception('Provided structure_index does not point to a non-list element')
+
+    def structure_index(self,stream_index):
+        """
+        Returns the sequence of structure indices identifying the value at the stream index.
+        """
+        if not 0 <= stream_index < self.length:
+            raise self._not_found('Provided stream index does not exist in the provided structure pattern')
+        structure_index = []
+        node = 0
+        while True:
+            #the last item starting at or before the stream index holds it, since an empty sublist is followed by an item with the same start
+            pos = bisect_right(self.starts[node],stream_index)-1
+            structure_index.append(pos)
+            if not pos in self.sublists[node]:
+                return structure_index
+            node = self.sublists[node][pos]
+
+@lru_cache(maxsize=4)
+def _cached_structure_index(structure_pattern):
+    return StructureIndex(structure_pattern)
+
+def _structure_index_of(structure_pattern):
+    #string patterns are cached, so repeated lookups in the same flat_pattern build its index once
+    if isinstance(structure_pattern,str):
+        return _cached_structure_index(structure_pattern)
+    return StructureIndex(structure_pattern)
+
 def get_stream_index(structure_pattern,structure_index):
     """
     Translates the sequence of indices identifying an item  in a hierarchy
     to the index identifying the same item in the flattened data stream.
     The structure indices must point to a value, not a list.
+    The StructureIndex of the last few structure patterns is cached, so repeated lookups only scan the pattern once.
     >>> get_stream_index('..[[[.]..].].',[0])
     0
     >>> get_stream_index('..[[[.]..].].',[2,0,0,0])
@@ -350,30 +879,12 @@ def get_stream_index(structure_pattern,structure_index):
     >>> get_stream_index('..[[[.]..].].',[2,1])
     5
     """
-    structure_index = list(structure_index)
-    stream_index = 0 
-    current_structure_index  = [0] 
-    for p in structure_pattern:
-        if p == '[':
-            if current_structure_index >= structure_index:
-                raise Exception('Provided structure_index does not point to a non-list element')
-            current_structure_index.append(0)
-        elif p == ']':
-            if current_structure_index >= structure_index:
-                raise Exception('Provided structure_index does not point to a non-list element')
-            current_structure_index.pop(-1)
-            current_structure_index[-1] += 1
-        elif p == '.':
-            if current_structure_index == structure_index:
-                return stream_index
-            stream_index += 1
-            current_structure_index[-1] += 1
-        else:
-            raise Exception('Invalid character in structure pattern: %s' % repr(p))
+    return _structure_index_of(structure_pattern).stream_index(structure_index)
 
 def get_structure_index(structure_pattern,stream_index):
     """
     Translates the stream index into a sequence of structure indices identifying an item in a hierarchy whose structure is specified by the provided structure pattern.
+    The StructureIndex of the last few structure patterns is cached, so repeated lookups only scan the pattern once.
     >>> get_structure_index('...',1)
     [1]
     >>> get_structure_index('.[.].',1)
@@ -393,22 +904,58 @@ def get_structure_index(structure_pattern,stream_index):
     >>> get_structure_index('.[[...]...].',7)
     [2]
     """
-    structure_index = [0]
-    current_stream_index = 0
-    for p in structure_pattern:
-        if p == '[':
-            structure_index.append(0)
-        elif p == '.':
-            if current_stream_index == stream_index:
-                return structure_index
-            structure_index[-1] += 1
-            current_stream_index += 1
-        elif p == ']':
-            structure_index.pop(-1)
-            structure_index[-1] += 1
-        else:
-            raise Exception('Invalid character in structure pattern: %s' % repr(p))
-    raise Exception('Provided stream index does not exist in the provided structure pattern')
+    return _structure_index_of(structure_pattern).structure_index(stream_index)
+
+_FIXED_RECORD_DIRECTIVES = {Directive.VALUE,Directive.NEXT,Directive.ZEROS,Directive.ONES,Directive.MOD,Directive.NESTOPEN,Directive.NESTCLOSE,Directive.ASSERTION}
+def _fixed_record(repetition_capture):
+    """
+    Determines whether one iteration of a repetition capture is a fixed width record.
+
+    Returns (num_bits, instructions) with nested finite repetitions expanded, or None if the record width depends on the data
+    or if the record uses labels, settings, jumps, markers or modifications that reach outside of the record.
+    The nesting of "[" and "]" must be balanced within the record.
+    """
+    instructions = []
+    def expand(capture):
+        for item in capture[1:]:
+            if isinstance(item,list):
+                if item[0] == float('inf') or isinstance(item[0],Count):
+                    return False
+                for iteration in range(item[0]):
+                    if not expand(item):
+                        return False
+            else:
+                instructions.append(item)
+        return True
+    if not expand(repetition_capture):
+        return None
+    if any(isinstance(arg,Count) for instruction in instructions for arg in instruction[2:]):
+        return None
+    num_bits = sum(_record_bits(instruction) for instruction in instructions)
+    pos = 0
+    depth = 0
+    for instruction in instructions:
+        directive = instruction[1]
+        if not directive in _FIXED_RECORD_DIRECTIVES:
+            return None
+        if directive == Directive.MOD:
+            if instruction[2] is None or pos + instruction[2] > num_bits:
+                return None
+        elif directive == Directive.NESTOPEN:
+            depth += 1
+        elif directive == Directive.NESTCLOSE:
+            depth -= 1
+            if depth < 0:
+                return None
+        pos += _record_bits(instruction)
+    if depth != 0:
+        return None
+    return num_bits,instructions
+
+def _record_bits(instruction):
+    if instruction[1] in (Directive.VALUE,Directive.NEXT,Directive.ZEROS,Directive.ONES):
+        return instruction[2]
+    return 0
 
 class Maker():
     """
@@ -421,9 +968,10 @@ class Maker():
         """
         raise NotImplementedError
         self.labels = {}
-    def __call__(self,pattern):
+    def __call__(self,pattern,**params):
         """
         Apply the maker against the data source according to the provided pattern.
+        Keyword arguments give the values of the {name} placeholders in the pattern.
         Return the data record consisting of the values corresponding to the pattern data.
         """
         raise NotImplementedError
@@ -435,10 +983,16 @@ class Maker():
     def __delitem__(self,label):
         del self.labels[label]
 
+    def _execute(self,instructions):
+        for instruction in instructions:
+            self.tok = instruction[0]
+            method = getattr(self,'handle_'+instruction[1].name.lower())
+            method(*instruction[2:])
+
     def tell_buffer(self):
         return self.bit_stream.tell()
     def tell_stream(self):
-        return self._translate_to_original(self.tell())
+        return self._translate_to_original(self.tell_buffer())
     def index_structure(self):
         return list(self.index_stack)
     def index_stream(self):
@@ -447,7 +1001,10 @@ class Maker():
         raise NotImplementedError
 
     def at_eof(self):
-        return self.bits.at_eof()
+        return self.bit_stream.at_eof()
+    def _repeat_progress(self):
+        #changes whenever an iteration of a {...}$ repetition gets closer to at_eof()
+        return self.tell_buffer(),self.flat_pos
 
     def __bytes__(self):
         return bytes(self.bit_stream)
@@ -479,14 +1036,170 @@ class Maker():
                 raise Exception('Invalid modtype for _translate_to_original: %s' % modtype)
         return pos
 
+    def _prune_mod_operations(self,pos):
+        """
+        Removes mod operations that can no longer change the translation of any buffer position at or after pos.
+
+        _translate_to_original() applies the operations from newest to oldest. A reversal that moves a position leaves it inside that reversal's range,
+        so a position that starts at or after pos never drops below the lowest start of the reversals that could have moved it.
+        Any older operation that ends before that bound can never apply. _translate_from_original() is the inverse mapping, so its results at or after pos are unchanged as well.
+        """
+        bound = pos
+        kept = []
+        for operation in reversed(self.mod_operations):
+            tok, modtype, start, offset, num_bits = operation
+            mstart = start + offset
+            if mstart + num_bits < bound:
+                continue
+            kept.append(operation)
+            if modtype == ModType.REVERSE and mstart < bound:
+                bound = mstart
+        kept.reverse()
+        self.mod_operations = kept
+        self._mods_scanned = 0
+        self._mod_span = None
+        self._mod_prefix = []
+
+class _UnrecordedModOperations(list):
+    """
+    Stands in for the mod operations list of a fast Extractor. Modifications are still applied to the buffer but are not recorded.
+    Only the span of bits that they cover is kept, so lazy values can tell whether their bits are still those of the input.
+    """
+    span = None
+    def append(self,operation):
+        tok,modtype,start,offset,num_bits = operation
+        self.span = _span_union(self.span,start+offset,start+offset+num_bits)
+    def extend(self,operations):
+        for operation in operations:
+            self.append(operation)
+    def clear(self):
+        self.span = None
+
+def _span_union(span,start,end):
+    if start > end:
+        start,end = end,start
+    if span is None:
+        return (start,end)
+    return (min(span[0],start),max(span[1],end))
 
 class Extractor(Maker):
     """
     The Extractor takes binary bytes data and extracts data values out of it.
+
+    If spill_threshold is given (in bytes), the working buffer moves to a temporary file on disk once it grows past that size.
+
+    If release_consumed is True, the input is read into the working buffer as extraction moves forward and the bytes before the seek position are released in pages of release_page_bytes.
+    This relies on extraction never touching bits before the seek position. The mod operations are pruned to the ones that still affect positions ahead, so tell_stream() and jumps keep resolving.
+    The released part of the buffer can no longer be read, so bytes(maker) is not available in this mode.
+
+    If parallel_workers is given, a top level repetition {...}N or {...}$ whose body is a fixed width record is split into record aligned chunks that are decoded in a pool of that many workers.
+    A record qualifies when its width is a whole number of bytes, it starts on a byte boundary and it contains only values, skips, zeros, ones, nesting, assertions and modifications that stay inside the record.
+    Labels, setting changes, jumps and markers make the repetition run sequentially as usual. Runs shorter than parallel_min_bytes are not worth the overhead and also run sequentially.
+    parallel_backend is 'process' or 'thread'. Decoding is pure Python, so threads only help when the GIL is not the bottleneck.
+
+    If fast is True, the extraction is read-only and skips the bookkeeping that only construction needs:
+    mod_operations and the index stack are not recorded, flat_labels and flat_pattern are derived only when accessed, and labels do not record where their values are in the data structure.
+    Reversals and inversions are still applied to the bits they cover, but jumps and tell_stream() use buffer positions, so they do not account for reversals that moved bits.
+    Jumps are plain seeks, so they may also go back to data that was already extracted, and they add nothing to the data.
+
+    output selects which representations of the extracted data are built as extraction goes:
+        'all' = The data stream and the data structure, along with flat_pattern and flat_labels. This is the default.
+        'stream' = The data stream and flat_pattern only. data_structure is derived from them with deflatten() when it is accessed.
+        'structure' = The data structure only. data_stream and flat_pattern are derived from it with flatten() when they are accessed.
+        'record' = Only the data records returned by maker(...). data_stream and data_structure are not available.
+    flat_labels and, in fast mode, flat_pattern are likewise derived when accessed. A derived attribute is kept until the next value, nesting level or label is added,
+    so accessing it repeatedly between inserts is cheap. Changes made to it are not seen by the maker.
+    If records is False, maker(...) returns an empty data record. extract() uses this for pattern blueprints, whose single data record would be a copy of the data structure.
+
+    If compact is True, the flat outputs use the list-like containers of the storage module instead of lists:
+    data_stream is a CompactList, which keeps integers in typed arrays of one to eight bytes per value instead of a pointer to an int object each. Streams of bytes or strings do not get smaller,
+    flat_labels is a SparseList that only stores the positions with a label, and flat_pattern is a PatternBuffer of one byte per character until finalize() turns it into a string.
+    They index, slice, iterate and compare like lists, so blueprint code can use them as before, but appending to them is slower.
+    The data structure still holds its values in lists, so combine compact with output='stream' when the data stream is large.
+
+    If intern is given, extracted values are decoded through a ValueInterner, so repeated byte, char, hex and bin values share one object instead of each being a new one.
+    intern may be True for a ValueInterner with the default size, the maximum number of distinct values to keep per encoding, or a ValueInterner to share between makers.
+    The interner is kept across reset(), and maker.interner.stats() reports its hit rates. Records decoded by parallel workers are not interned.
+
+    If lazy_min_bits is given, byte, char, hex and bin fields of at least that many bits are inserted as LazyValue objects that refer to the input and are decoded only when accessed.
+    A field stays lazy only if the input is bytes-like and no setting or modification has changed its bits, otherwise it is decoded as usual.
+    LazyValue.view() gives a byte aligned field as a memoryview of the input without copying it, and a Constructor writes its bits back without encoding a value.
+    The LazyValue objects keep the whole input alive, and a bytearray input cannot be resized while they exist. Records decoded by parallel workers are not lazy.
+
+    If source_map is True, maker.source_map is a SourceMap of the original bit offset and length of every item in the data stream, so a field can be read again from the input by its index.
+    Offsets account for reversals, except in fast mode where they are buffer positions. Repetitions are not decoded in parallel while a source map is kept,
+    and the values added by parallel_map() and by jumps are not mapped.
     """
-    def __init__(self,byte_stream):
+    def __init__(self,byte_stream,spill_threshold=None,release_consumed=False,release_page_bytes=RELEASE_PAGE_BYTES,parallel_workers=None,parallel_backend='process',parallel_min_bytes=PARALLEL_MIN_BYTES,fast=False,output='all',records=True,compact=False,intern=False,lazy_min_bits=None,source_map=False):
+        if not output in ('all','stream','structure','record'):
+            raise Exception('Invalid output for Extractor: %s' % repr(output))
+        self.fast = fast
+        self.output = output
+        self.records = records
+        self.compact = compact
+        if isinstance(intern,ValueInterner):
+            self.interner = intern
+        elif intern is True:
+            self.interner = ValueInterner()
+        elif intern:
+            self.interner = ValueInterner(intern)
+        else:
+            self.interner = None
+        self._decode_value = uint_decode if self.interner is None else self.interner.decode
+        self.lazy_min_bits = lazy_min_bits
+        self.keep_stream = output in ('all','stream')
+        self.keep_structure = output in ('all','structure')
+        self.keep_pattern = output == 'stream' or (output == 'all' and not fast)
+        self.keep_labels = output == 'all' and not fast
+        if fast or output != 'all':
+            self._insert_data = self._insert_data_selective
+            self._insert_data_record = self._insert_data_record_selective
+            self.handle_setlabel = self._handle_setlabel_selective
+            self.handle_nestopen = self._handle_nestopen_selective
+            self.handle_nestclose = self._handle_nestclose_selective
+        if fast:
+            self.handle_jump = self._handle_jump_fast
+        self.map_sources = source_map
+        if source_map:
+            self._insert_data_unmapped = self._insert_data
+            self._insert_data_record_unmapped = self._insert_data_record
+            self._insert_data = self._insert_data_mapped
+            self._insert_data_record = self._insert_data_record_mapped
+            self.handle_value = self._handle_value_mapped
+            self.handle_takeall = self._handle_takeall_mapped
+        self.spill_threshold = spill_threshold
+        self.release_consumed = release_consumed
+        self.parallel_workers = parallel_workers
+        self.parallel_backend = parallel_backend
+        self.parallel_min_bytes = parallel_min_bytes
+        self.release_page_bits = release_page_bytes*8
+        self.labels = {}
+        self.index_stack = [0]
+        self.mod_operations = _UnrecordedModOperations() if fast else [] # tok, modtype, start, offset, num_bits
+        self.logger = _extractor_logger
+        self._derived = {} #attributes derived by __getattr__, dropped whenever the data changes
+        self.reset(byte_stream)
+
+    def reset(self,byte_stream):
+        """
+        Prepares the maker to extract a new byte stream with the same options, so one maker can be reused for many small inputs.
+        Labels and the internal bookkeeping lists are cleared in place. The data stream and data structure start out as new lists, so results taken from the previous input stay valid.
+        """
         self.byte_stream = byte_stream
-        self.bit_stream = BitsIO(byte_stream)
+        self.released_bits = 0
+        if self.lazy_min_bits is not None and not self.release_consumed and isinstance(byte_stream,(bytes,bytearray,memoryview,mmap.mmap)):
+            self.lazy_source = memoryview(byte_stream).cast('B')
+        else:
+            self.lazy_source = None
+        self._mods_scanned = 0
+        self._mod_span = None
+        self._mod_prefix = [] #span of the first i+1 mod operations, kept for the source map
+        self._field_start = None
+        self.source_map = SourceMap() if self.map_sources else None
+        if self.release_consumed:
+            self.bit_stream = BitsIO(ReleasableBytesIO(byte_stream),ByteSourceType.SOURCE)
+        else:
+            self.bit_stream = BitsIO(byte_stream,spill_threshold=self.spill_threshold)
 
         #Initialize settings
         self.reverse_all = False
@@ -496,25 +1209,69 @@ class Extractor(Maker):
         self.last_value = None
         self.last_index_stack = None
 
-        self.labels = {}
+        self.labels.clear()
+        self._derived.clear()
 
-        self.data_stream = []
-        self.flat_labels = []
-        self.flat_pattern = [] #list of characters
+        if self.keep_stream:
+            self.data_stream = CompactList() if self.compact else []
+        if self.keep_labels:
+            self.flat_labels = SparseList() if self.compact else []
+        if self.keep_pattern:
+            self.flat_pattern = PatternBuffer() if self.compact else [] #list of characters
         self.flat_pos = 0
-        self.index_stack = [0]
+        self.index_stack.clear()
+        self.index_stack.append(0)
 
-        self.data_structure = []
-        self.stack_data = [self.data_structure]
-        self.mod_operations = [] # tok, modtype, start, offset, num_bits
-        self.logger = logarhythm.getLogger('Extractor')
-        self.logger.format = logarhythm.build_format(time=None,level=False)
+        if self.keep_structure:
+            self.data_structure = []
+            self.stack_data = [self.data_structure]
+        else:
+            self.stack_data = [[]] #only tracks the nesting depth
+        self.mod_operations.clear()
+        self.debugging = self.logger.will_log(logarhythm.DEBUG)
+
+    def __getattr__(self,name):
+        #derives the representations that the output setting does not build; only called for attributes that are not set
+        if not 'output' in self.__dict__:
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__,name))
+        derived = self._derived
+        if name in derived:
+            return derived[name]
+        if name == 'data_structure' and self.output == 'stream':
+            derived[name] = deflatten(self.flat_pattern,self.data_stream)
+        elif name in ('data_stream','flat_pattern') and self.keep_structure:
+            derived['data_stream'],derived['flat_pattern'] = flatten(self.data_structure)
+        elif name == 'flat_labels' and self.output != 'record':
+            if self.compact:
+                flat_labels = SparseList()
+                flat_labels.length = self.flat_pos
+            else:
+                flat_labels = [None]*self.flat_pos
+            for label,entries in self.labels.items():
+                for value,index_stack,flat_pos in entries:
+                    if flat_pos is not None and 0 <= flat_pos < self.flat_pos:
+                        flat_labels[flat_pos] = label
+            derived[name] = flat_labels
+        elif name in ('data_stream','data_structure','flat_pattern','flat_labels'):
+            raise AttributeError('%s is not available from an Extractor with output=%s' % (name,repr(self.output)))
+        else:
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__,name))
+        return derived[name]
+
+    def __delitem__(self,label):
+        del self.labels[label]
+        self._derived.clear()
 
-    def __call__(self,pattern):
+    def __call__(self,pattern,**params):
         self.data_record = []
         self.stack_record = [self.data_record]
+        self.debugging = self.logger.will_log(logarhythm.DEBUG)
 
-        for instruction in pattern_parse(pattern):
+        if self.parallel_workers and not self.map_sources:
+            instructions = self._parallel_parse(pattern,params)
+        else:
+            instructions = pattern_parse(pattern,self,params)
+        for instruction in instructions:
             tok = instruction[0]
             self.tok = tok
             directive = instruction[1]
@@ -522,14 +1279,191 @@ class Extractor(Maker):
             method_name = 'handle_'+directive.name.lower()
             method = getattr(self,method_name)
             method(*args)
+            if self.release_consumed and self.bit_stream.tell() - self.released_bits >= self.release_page_bits:
+                self._release()
         return self.data_record
 
+    def _parallel_parse(self,pattern,params):
+        """
+        Variant of pattern_parse() that extracts qualifying top level repetitions in parallel and yields the rest of the instructions.
+        Whatever part of a repetition is not covered by whole records in the buffer continues sequentially.
+        """
+        compiled = pattern_compile(pattern)
+        if params or compiled.placeholders:
+            compiled = pattern_bind(compiled,params)
+        for item in compiled:
+            if isinstance(item,list):
+                if isinstance(item[0],Count):
+                    item = [item[0].resolve(self)] + item[1:]
+                count = item[0] - self._extract_records_parallel(item)
+                if count > 0:
+                    yield from _process_repetition_capture([count]+item[1:],_parse_logger,self)
+            elif item[1] in _BRANCH_DIRECTIVES:
+                yield from _process_branch(item,_parse_logger,self)
+            else:
+                yield item
+
+    def _extract_records_parallel(self,repetition_capture):
+        """
+        Extracts as many whole records of the repetition capture as possible in the worker pool and returns how many were extracted.
+        """
+        from .batch import _extract_records
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        from collections import deque
+        record = _fixed_record(repetition_capture)
+        if record is None:
+            return 0
+        record_bits,instructions = record
+        pos = self.tell_buffer()
+        if record_bits == 0 or record_bits % 8 != 0 or pos % 8 != 0:
+            return 0
+        count = min(repetition_capture[0],(len(self.bit_stream) - pos)//record_bits)
+        record_bytes = record_bits//8
+        if count*record_bytes < self.parallel_min_bytes:
+            return 0
+
+        records_per_chunk = ceil(count/(self.parallel_workers*4))
+        settings = (self.reverse_all,self.invert_all,self.endianswap_all,self.last_value)
+        byte_source = self.bit_stream.byte_source
+        start_byte = pos//8
+        executor_class = ThreadPoolExecutor if self.parallel_backend == 'thread' else ProcessPoolExecutor
+        with executor_class(max_workers=self.parallel_workers) as executor:
+            pending = deque()
+            chunk_starts = iter(range(0,count,records_per_chunk))
+            def submit_next():
+                for first in chunk_starts:
+                    n = min(records_per_chunk,count-first)
+                    byte_source.seek(start_byte+first*record_bytes)
+                    data = byte_source.read(n*record_bytes)
+                    pending.append((first,executor.submit(_extract_records,instructions,n,data,settings)))
+                    return True
+                return False
+            while len(pending) < 2*self.parallel_workers and submit_next():
+                pass
+            while len(pending) > 0:
+                first,future = pending.popleft()
+                self._merge_records(start_byte+first*record_bytes,*future.result())
+                submit_next()
+        self.bit_stream.seek(pos+count*record_bits)
+        if self.debugging:
+            self.logger.debug('Extracted %d records of %d bits in parallel' % (count,record_bits))
+        return count
+
+    def _merge_records(self,chunk_byte,data_stream,flat_pattern,mod_operations,modified_bytes,last_value,last_index_stack):
+        """
+        Appends the output of one chunk of records as if the records had been extracted in place.
+        """
+        if modified_bytes is not None:
+            byte_source = self.bit_stream.byte_source
+            byte_source.seek(chunk_byte)
+            byte_source.write(modified_bytes)
+        self._derived.clear()
+        chunk_bit = chunk_byte*8
+        for tok,modtype,start,offset,num_bits in mod_operations:
+            self.mod_operations.append((tok,modtype,start+chunk_bit,offset,num_bits))
+        records = deflatten(flat_pattern,data_stream) if '[' in flat_pattern else data_stream #the data structure and data record share the record sublists
+        if self.keep_structure:
+            self.stack_data[-1].extend(records)
+        if self.records:
+            self.stack_record[-1].extend(records)
+        if self.keep_stream:
+            self.data_stream.extend(data_stream)
+        if self.keep_pattern:
+            self.flat_pattern.extend(flat_pattern)
+        if self.keep_labels:
+            self.flat_labels.extend([None]*len(data_stream))
+        self.flat_pos += len(data_stream)
+        base_index = self.index_stack[-1]
+        if not self.fast:
+            self.index_stack[-1] += len(records)
+        if last_index_stack is not None and not self.fast:
+            self.last_index_stack = tuple(self.index_stack[:-1]) + (base_index+last_index_stack[0],) + tuple(last_index_stack[1:])
+        if last_value is not None: #one element tuple when the records changed the last value
+            if isinstance(last_value[0],list):
+                self.last_value = (self.stack_record if self.records else self.stack_data)[-1][-1] if self.records or self.keep_structure else last_value[0] #the sublist closed last, as handle_nestclose() would have set it
+            else:
+                self.last_value = last_value[0]
+
+    def _release(self):
+        """
+        Releases the consumed part of the buffer and the mod operations that only applied to it.
+        """
+        pos = self.tell_buffer()
+        self.released_bits = self.bit_stream.release(pos)
+        if not self.fast:
+            self._prune_mod_operations(pos)
+        if self.debugging:
+            self.logger.debug('Released buffer before bit %d; %d mod operations retained' % (self.released_bits,len(self.mod_operations)))
+
     def finalize(self):
         if len(self.stack_data) > 1:
             raise NestingError('There exists a "[" with no matching "]"')
         elif len(self.stack_data) < 1:
             raise NestingError('There exists a "]" with no matching "["')
-        self.flat_pattern = ''.join(self.flat_pattern)
+        if self.keep_pattern:
+            self.flat_pattern = ''.join(self.flat_pattern)
+
+    def parallel_map(self,blueprint,regions,*args,workers=None,executor=None,**kwargs):
+        """
+        Extracts independent regions of the original byte stream with a sub-blueprint in worker processes.
+
+        regions is a sequence of (start_bits, num_bits) pairs in original stream positions, e.g. member offsets taken from a directory.
+        The regions must be byte aligned and must not overlap. Each one is extracted by a fresh Extractor starting from the current reverse/invert/endian-swap settings.
+        An input that is a file on disk is memory mapped by the workers, any other input is copied once into shared memory.
+        The sub-blueprint must be picklable, i.e. a pattern string or a module level function. Args and kwargs are passed into it after the maker object, or kwargs give the {name} placeholder values of a pattern.
+        workers = Number of worker processes of the pool created for the call. Defaults to the number of CPUs.
+        executor = An existing concurrent.futures executor to use instead of creating a pool. Its workers attach the input for each task and detach it again, since they outlive the call.
+
+        The data of each region is appended as one sublist at the current position of the data structure, in the order of regions, and the labels of each region are merged.
+        The seek position does not move. Returns the list of sub-blueprint results.
+        """
+        from .batch import _extract_regions
+        regions = [(int(start_bits),int(num_bits)) for start_bits,num_bits in regions]
+        L = len(self.bit_stream)
+        prev_end = None
+        for start_bits,num_bits in sorted(regions):
+            if start_bits % 8 != 0 or num_bits % 8 != 0:
+                raise Exception('parallel_map regions must be byte aligned: (%d, %d)' % (start_bits,num_bits))
+            if start_bits < 0 or num_bits < 0 or start_bits + num_bits > L:
+                raise Exception('parallel_map region is out of range: (%d, %d)' % (start_bits,num_bits))
+            if prev_end is not None and start_bits < prev_end:
+                raise Exception('parallel_map regions overlap at bit %d' % start_bits)
+            prev_end = start_bits + num_bits
+
+        results = []
+        self._derived.clear()
+        for data_stream,flat_pattern,flat_labels,labels,data_structure,result in _extract_regions(self,blueprint,regions,args,kwargs,workers,executor):
+            index_prefix = tuple(self.index_stack)
+            for label,entries in labels.items():
+                if not label in self.labels:
+                    self.labels[label] = []
+                for value,index_stack,flat_pos in entries:
+                    if index_stack is not None:
+                        index_stack = index_prefix + tuple(index_stack)
+                    if flat_pos is not None:
+                        flat_pos += self.flat_pos
+                    self.labels[label].append((value,index_stack,flat_pos))
+            if self.keep_structure:
+                self.stack_data[-1].append(data_structure)
+            if self.keep_pattern:
+                self.flat_pattern.append('[')
+                self.flat_pattern.extend(flat_pattern)
+                self.flat_pattern.append(']')
+            if self.keep_stream:
+                self.data_stream.extend(data_stream)
+            if self.keep_labels:
+                self.flat_labels.extend(flat_labels)
+            if self.map_sources:
+                self.source_map.append_unmapped(len(data_stream))
+            self.flat_pos += len(data_stream)
+            self.last_value = data_structure
+            if not self.fast:
+                self.last_index_stack = index_prefix
+                self.index_stack[-1] += 1
+            results.append(result)
+        if self.debugging:
+            self.logger.debug('Extracted %d regions in parallel' % len(regions))
+        return results
 
     def _apply_settings(self,num_bits,encoding):
         pos = self.tell_buffer()
@@ -542,13 +1476,12 @@ class Extractor(Maker):
         if self.endianswap_all and encoding != Encoding.CHAR:
             self._endianswap(num_bits)
 
-    def _consume_bits(self,num_bits=None,encoding=Encoding.UINT):
+    def _consume_bits(self,num_bits=None,encoding=Encoding.UINT,decode=uint_decode):
         self._apply_settings(num_bits,encoding)
         uint_value,num_extracted = self.bit_stream.read(num_bits)
         if num_extracted != num_bits:
-            import pdb; pdb.set_trace()
             raise IncompleteDataError('Token = %s; Expected bits = %d; Extracted bits = %d' % (self.tok,num_bits,num_extracted))
-        value = uint_decode(uint_value,num_bits,encoding)
+        value = decode(uint_value,num_bits,encoding)
         return value
 
     def _insert_data(self,value):
@@ -573,6 +1506,129 @@ class Extractor(Maker):
         self.last_index_stack = tuple(self.index_stack)
         self.index_stack[-1] += 1
 
+    #variants used with source_map=True, which map each item to the field it was read from; _field_start is only set while a field is inserted
+    def _handle_value_mapped(self,num_bits,encoding):
+        self._field_start = self.tell_buffer()
+        self._field_encoding = encoding
+        try:
+            return Extractor.handle_value(self,num_bits,encoding)
+        finally:
+            self._field_start = None
+    def _handle_takeall_mapped(self,encoding):
+        self._field_start = self.tell_buffer()
+        self._field_encoding = encoding
+        try:
+            return Extractor.handle_takeall(self,encoding)
+        finally:
+            self._field_start = None
+    def _insert_data_mapped(self,value):
+        if self._field_start is None:
+            self.source_map.append_unmapped()
+        else:
+            position = self._field_start
+            end_position = self.tell_buffer()
+            start,end = self._original_span(position,end_position)
+            self.source_map.append(start,end_position-position,self._field_encoding,position,len(self.mod_operations),end-start)
+        self._insert_data_unmapped(value)
+    def _insert_data_record_mapped(self,record):
+        self.source_map.append_unmapped(len(record))
+        self._insert_data_record_unmapped(record)
+
+    #variants used by fast extraction and by the output settings other than 'all', which only build what was asked for
+    def _insert_data_selective(self,value):
+        if self._derived:
+            self._derived.clear()
+        if self.records:
+            self.stack_record[-1].append(value)
+        if self.keep_structure:
+            self.stack_data[-1].append(value)
+        if self.keep_stream:
+            self.data_stream.append(value)
+        if self.keep_pattern:
+            self.flat_pattern.append('.')
+        if self.keep_labels:
+            self.flat_labels.append(None)
+        self.last_value = value
+        self.flat_pos += 1
+        if not self.fast:
+            self.last_index_stack = tuple(self.index_stack)
+            self.index_stack[-1] += 1
+    def _insert_data_record_selective(self,record):
+        if self._derived:
+            self._derived.clear()
+        l = len(record)
+        if self.records:
+            self.stack_record[-1].append(record)
+        if self.keep_structure:
+            self.stack_data[-1].append(record)
+        if self.keep_stream:
+            self.data_stream.extend(record)
+        if self.keep_pattern:
+            self.flat_pattern.extend('['+'.'*l+']')
+        if self.keep_labels:
+            self.flat_labels.extend([None]*l)
+        self.last_value = record[-1]
+        self.flat_pos += l
+        if not self.fast:
+            self.last_index_stack = tuple(self.index_stack)
+            self.index_stack[-1] += 1
+    def _handle_setlabel_selective(self,label):
+        if self._derived:
+            self._derived.clear()
+        if not label in self.labels:
+            self.labels[label] = []
+        self.labels[label].append((self.last_value,None if self.fast else self.last_index_stack,self.flat_pos-1))
+        if self.keep_labels:
+            self.flat_labels[-1] = label
+    def _handle_nestopen_selective(self):
+        if self._derived:
+            self._derived.clear()
+        if self.records:
+            new_record = []
+            self.stack_record[-1].append(new_record)
+            self.stack_record.append(new_record)
+        new_record = []
+        if self.keep_structure:
+            self.stack_data[-1].append(new_record)
+        self.stack_data.append(new_record)
+        if self.keep_pattern:
+            self.flat_pattern.append('[')
+        if not self.fast:
+            self.index_stack.append(0)
+    def _handle_nestclose_selective(self):
+        if len(self.stack_data) == 1:
+            raise NestingError('there exists a "]" with no matching "["')
+        if self._derived:
+            self._derived.clear()
+        if self.records:
+            self.last_value = self.stack_record[-1]
+            if len(self.stack_record) == 1:
+                self.data_record = [self.data_record]
+                self.stack_record = [self.data_record]
+            else:
+                self.stack_record.pop(-1)
+        else:
+            self.last_value = self.stack_data[-1]
+        self.stack_data.pop(-1)
+        if self.keep_pattern:
+            self.flat_pattern.append(']')
+        if not self.fast:
+            self.index_stack.pop(-1)
+            self.index_stack[-1] += 1
+    def _handle_jump_fast(self,num_bits,jump_type):
+        pos = self.tell_buffer()
+        if jump_type == JumpType.START:
+            target = num_bits
+        elif jump_type == JumpType.FORWARD:
+            target = pos + num_bits
+        elif jump_type == JumpType.BACKWARD:
+            target = pos - num_bits
+        else:
+            target = len(self.bit_stream) - num_bits
+        if target < self.released_bits or target > len(self.bit_stream):
+            raise Exception('Jump target %d is out of range: %s' % (target,self.tok))
+        self.bit_stream.seek(target)
+
     def _endianswap(self,n):
         if n % 8 != 0:
             raise Exception('Endian swap must be performed on a multiple of 8 bits: %s' % self.tok)
@@ -602,10 +1658,68 @@ class Extractor(Maker):
         return n
 
 
+    def _modified_span(self):
+        #(start, end) bits of the buffer that modifications have covered so far, or None
+        operations = self.mod_operations
+        if isinstance(operations,_UnrecordedModOperations):
+            return operations.span
+        for tok,modtype,start,offset,num_bits in operations[self._mods_scanned:]:
+            self._mod_span = _span_union(self._mod_span,start+offset,start+offset+num_bits)
+            if self.map_sources:
+                self._mod_prefix.append(self._mod_span)
+        self._mods_scanned = len(operations)
+        return self._mod_span
+
+    def _original_span(self,start,end):
+        """
+        Translates the buffer span of a field to the span of the original bits it came from.
+        Like _translate_to_original() it undoes the reversals from newest to oldest, but it stops once no older operation reaches the span.
+        A reversal that only partly covers the span widens it to cover both.
+        """
+        if self._modified_span() is None or isinstance(self.mod_operations,_UnrecordedModOperations):
+            return start,end
+        operations = self.mod_operations
+        for index in range(len(operations)-1,-1,-1):
+            reach = self._mod_prefix[index]
+            if end <= reach[0] or start >= reach[1]:
+                break
+            tok,modtype,mod_start,offset,num_bits = operations[index]
+            if modtype == ModType.REVERSE:
+                mstart = mod_start + offset
+                mend = mstart + num_bits
+                if mstart <= start and end <= mend:
+                    start,end = mstart + mend - end,mstart + mend - start
+                elif start < mend and mstart < end:
+                    start,end = min(start,mstart),max(end,mend)
+        return start,end
+
+    def _lazy_value(self,num_bits,encoding):
+        """
+        Skips past the field at the seek position and returns it as a LazyValue, or returns None if it has to be decoded now because its bits may differ from the input.
+        """
+        if self.reverse_all or self.invert_all or (self.endianswap_all and encoding != Encoding.CHAR):
+            return None
+        start = self.tell_buffer()
+        end = start + num_bits
+        if end > len(self.bit_stream):
+            return None #decoding raises the IncompleteDataError
+        span = self._modified_span()
+        if span is not None and span[0] < end and start < span[1]:
+            return None
+        self.bit_stream.seek(end)
+        return LazyValue(self.lazy_source,start,num_bits,encoding)
+
     def handle_value(self,num_bits,encoding):
-        value = self._consume_bits(num_bits,encoding)
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
+        value = None
+        if self.lazy_source is not None and num_bits >= self.lazy_min_bits and encoding in LAZY_ENCODINGS:
+            value = self._lazy_value(num_bits,encoding)
+        if value is None:
+            value = self._consume_bits(num_bits,encoding,self._decode_value)
         self._insert_data(value)
-        self.logger.debug('%s = %r' % (self.tok,value))
+        if self.debugging:
+            self.logger.debug('%s = %r' % (self.tok,value))
         return value
 
     def handle_takeall(self,encoding):
@@ -622,14 +1736,20 @@ class Extractor(Maker):
         return value
 
     def handle_next(self,num_bits):
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
         self.bit_stream.seek(num_bits,SEEK_CUR) #these bits are don't cares
 
     def handle_zeros(self,num_bits):
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
         value = self._consume_bits(num_bits)
         if value != 0:
             raise ZerosError('Token = %s; Expected all zeros; Extracted value = %d' % (self.tok,value))
 
     def handle_ones(self,num_bits):
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
         value = self._consume_bits(num_bits)
         all_ones = (1<<num_bits)-1
         if value != all_ones:
@@ -668,7 +1788,8 @@ class Extractor(Maker):
         marker = self._consume_bits(len(bytes_literal)*8,Encoding.BYTS) #skip past the marker itself, applying any needed mod_operations
         if marker != orig_bytes_literal:
             raise Exception('Marker scan consumption did not match expected bytes literal')
-        self.logger.debug('Scan for %s: offset = %d, pulled bits = %d' % (repr(orig_bytes_literal),m,n))
+        if self.debugging:
+            self.logger.debug('Scan for %s: offset = %d, pulled bits = %d' % (repr(orig_bytes_literal),m,n))
 
 
     def handle_modoff(self,offset_bits,num_bits,modtype):
@@ -736,7 +1857,7 @@ class Extractor(Maker):
     def handle_deflabel(self,label,value):
         if not label in self.labels:
             self.labels[label] = []
-        self.labels[label].append((self.last_value,None,None))
+        self.labels[label].append((value,None,None))
 
     def handle_matchlabel(self,label):
         if not label in self.labels:
@@ -777,45 +1898,93 @@ class Extractor(Maker):
         pos = self.tell_buffer()
         L = len(self.bit_stream)
         if jump_type in [JumpType.FORWARD,JumpType.BACKWARD]:
-            self.logger.debug('Jump relative pos -> orig = %d -> %d' % (pos,target_orig))
             target_orig = self._translate_to_original(pos)
+            if self.debugging:
+                self.logger.debug('Jump relative pos -> orig = %d -> %d' % (pos,target_orig))
         elif jump_type == JumpType.END:
-            self.logger.debug('Jump relative to end: %d' % L)
+            if self.debugging:
+                self.logger.debug('Jump relative to end: %d' % L)
             target_orig = L
         else:
-            self.logger.debug('Jump relative to beginning')
+            if self.debugging:
+                self.logger.debug('Jump relative to beginning')
             target_orig = 0
         if jump_type in [JumpType.START, JumpType.FORWARD]:
-            self.logger.debug('Jump forward offset: %d + %d = %d' % (target_orig,num_bits,target_orig+num_bits))
+            if self.debugging:
+                self.logger.debug('Jump forward offset: %d + %d = %d' % (target_orig,num_bits,target_orig+num_bits))
             target_orig += num_bits
 
         else:
-            self.logger.debug('Jump backward offset: %d - %d = %d' % (target_orig,num_bits,target_orig-num_bits))
+            if self.debugging:
+                self.logger.debug('Jump backward offset: %d - %d = %d' % (target_orig,num_bits,target_orig-num_bits))
             target_orig -= num_bits
 
         target = self._translate_from_original(target_orig)
-        self.logger.debug('Jump target translation: orig -> pos = %d -> %d' % (target_orig,target))
+        if self.debugging:
+            self.logger.debug('Jump target translation: orig -> pos = %d -> %d' % (target_orig,target))
         offset = target - pos
-        self.logger.debug('Jump actual buffer offset = %d - %d = %d' % (target,pos,offset))
+        if self.debugging:
+            self.logger.debug('Jump actual buffer offset = %d - %d = %d' % (target,pos,offset))
         if offset < 0:
             raise Exception('Jump is to already parsed location: %s' % self.tok)
         if offset > 0:
             #num_bits = L - (pos + offset) #by providing a value, that makes it not get put into the data structure - it needs to be put into the data structure though
             num_bits = self._pull(offset,None)
-            self.logger.debug('Jump pull offset = %d, num_bits = %d' % (offset,num_bits))
+            if self.debugging:
+                self.logger.debug('Jump pull offset = %d, num_bits = %d' % (offset,num_bits))
+
+_NO_VALUE = object() #marks that a lazy Constructor has no lookahead value, or that its values are used up
+
+def _is_eager_input(data_structure):
+    #sequences, including the compact containers of an Extractor with compact=True, are flattened up front
+    return isinstance(data_structure,(list,tuple,CompactList,SparseList,Sequence)) and not isinstance(data_structure,(str,bytes,bytearray))
 
 class Constructor(Maker):
     """
     The Constructor class takes a sequence of values (nested or not), and constructs a byte sequence according to provided patterns.
+
+    If spill_threshold is given (in bytes), the buffer being constructed moves to a temporary file on disk once it grows past that size.
+    Modifications that are held until finalize() are then replayed against the file chunk by chunk.
+
+    If byte_stream is given and spill_threshold is not, it is emptied and the bytes are constructed into it instead of a new BytesIO, so that buffers can be reused.
+
+    If lazy is True, or if lazy is None and the data structure is not a sequence such as a list, tuple or CompactList (e.g. a generator of records from a database cursor),
+    the values are taken from the data structure with iter_flatten() as they are consumed instead of flattening it up front.
+    Only the value being consumed and one value of lookahead are held, and labels only keep their latest value. data_stream, flat_pattern and flat_labels are then None,
+    and a count label that is updated to match a value's size is only updated in the output, since there is no data stream to update.
+    If records is False, maker(...) returns data records without the values, so that a lazy data stream is not collected into them.
     """
-    def __init__(self,data_structure):
+    def __init__(self,data_structure,spill_threshold=None,byte_stream=None,lazy=None,records=True):
+        self.lazy = lazy
+        self.records = records
+        self.spill_threshold = spill_threshold
+        self.byte_stream = byte_stream
+        self.labels = {}
+        self.label_fields = {} #label -> (buffer position, num_bits, encoding, data stream index) of the value field that set it
+        self.index_stack = [0]
+        self.mod_operations = []
+        self.logger = _constructor_logger
+        self.reset(data_structure)
+
+    def reset(self,data_structure):
+        """
+        Prepares the maker to construct from a new data structure with the same options, so one maker can be reused for many small outputs.
+        Labels and the internal bookkeeping lists are cleared in place and the output buffer is emptied and reused, so take bytes(maker) before resetting.
+        """
         self.data_structure = data_structure
 
         #Simply flatten the data obj. The order of traversal is what is important, not the structure.
-        self.data_stream,self.flat_pattern = flatten(data_structure)
-        self.flat_labels = [None]*len(self.data_stream)
+        if self.lazy or (self.lazy is None and not _is_eager_input(data_structure)):
+            self.data_stream = self.flat_pattern = self.flat_labels = None
+            self.values = iter_flatten(data_structure)
+            self.lookahead = _NO_VALUE
+        else:
+            self.data_stream,self.flat_pattern = flatten(data_structure)
+            self.flat_labels = [None]*len(self.data_stream)
+            self.values = None
         self.flat_pos = 0
-        self.index_stack = [0]
+        self.index_stack.clear()
+        self.index_stack.append(0)
 
         
         #initialize settings
@@ -825,26 +1994,57 @@ class Constructor(Maker):
         
         self.last_value = None
         self.last_index_stack = None
-        self.byte_stream = io.BytesIO()
-        self.bit_stream = BitsIO(self.byte_stream)
-        self.labels = {}
-        self.mod_operations = []
-        self.logger = logarhythm.getLogger('Constructor')
-        self.logger.format = logarhythm.build_format(time=None,level=False)
-
-    def __call__(self,pattern):
+        if self.spill_threshold is not None:
+            self.byte_stream = io.BytesIO()
+            self.bit_stream = BitsIO(self.byte_stream,spill_threshold=self.spill_threshold)
+        else:
+            if self.byte_stream is None:
+                self.byte_stream = io.BytesIO()
+            else:
+                self.byte_stream.seek(0)
+                self.byte_stream.truncate(0)
+            self.bit_stream = BitsIO(self.byte_stream,ByteSourceType.SOURCE)
+        self.labels.clear()
+        self.label_fields.clear()
+        self.last_field = None
+        self.mod_operations.clear()
+        self.debugging = self.logger.will_log(logarhythm.DEBUG)
+
+    def __call__(self,pattern,**params):
         self.data_record = []
         self.stack = [self.data_record]
-        for instruction in pattern_parse(pattern):
-            tok = instruction[0]
-            self.tok = tok
-            directive = instruction[1]
-            args = instruction[2:]
-            method_name = 'handle_'+directive.name.lower()
-            method = getattr(self,method_name)
-            method(*args)
+        self.debugging = self.logger.will_log(logarhythm.DEBUG)
+        self._execute(pattern_parse(pattern,self,params))
         return self.data_record
 
+    def at_eof(self):
+        """
+        In construction context, the end is reached when every value of the data stream has been consumed.
+        """
+        if self.data_stream is None:
+            return self._peek_value() is _NO_VALUE
+        return self.flat_pos >= len(self.data_stream)
+    def _repeat_progress(self):
+        #only consuming values gets a Constructor closer to at_eof()
+        return self.flat_pos
+
+    def _peek_value(self):
+        #lazy data streams only; returns the next value without consuming it, or _NO_VALUE at the end
+        if self.lookahead is _NO_VALUE:
+            self.lookahead = next(self.values,_NO_VALUE)
+        return self.lookahead
+
+    def _next_value(self):
+        #lazy data streams only; consumes the next value
+        value = self.lookahead
+        if value is _NO_VALUE:
+            value = next(self.values,_NO_VALUE)
+            if value is _NO_VALUE:
+                raise IndexError('Token = %s; The data stream has no more values' % self.tok)
+        else:
+            self.lookahead = _NO_VALUE
+        return value
+
     def finalize(self):
         if len(self.stack) > 1:
             raise NestingError('There exists a "[" with no matching "]"')
@@ -881,6 +2081,25 @@ class Constructor(Maker):
                 raise Exception('Token = %s; Invalid modtype: %s' % (tok,repr(modtype)))
         self.bit_stream.seek(pos)
 
+    def parallel_map(self,blueprint,regions,*args,workers=None,executor=None,**kwargs):
+        """
+        Construction counterpart of Extractor.parallel_map(). Each region consumes the next sublist of the data stream with the sub-blueprint.
+
+        The regions are constructed one after another at the current position, so only the number of regions is used.
+        This reproduces the original byte stream when the extracted regions were contiguous and started at the seek position.
+        workers and executor are accepted for symmetry with extraction and are not used.
+        Returns the list of sub-blueprint results.
+        """
+        results = []
+        for region in regions:
+            self('[')
+            if isinstance(blueprint,(bytes,str)):
+                results.append(self(blueprint,**kwargs))
+            else:
+                results.append(blueprint(self,*args,**kwargs))
+            self(']')
+        return results
+
     def _pull(self,m,n):
         if n is None:
             n,_ = self._consume_data()
@@ -891,7 +2110,7 @@ class Constructor(Maker):
         return n
 
     def _endianswap(self,n):
-        pos = self.tell()
+        pos = self.tell_buffer()
         self.mod_operations.append((self.tok,ModType.REVERSE,pos,0,n))
         for i in range(0,n,8):
             self.mod_operations.append((self.tok,ModType.REVERSE,pos,i,8))
@@ -907,11 +2126,57 @@ class Constructor(Maker):
             self._endianswap(num_bits)
 
 
+    def _fill_count(self,count,value,encoding):
+        """
+        Returns the number of bits of a value whose size is given by a count.
+        When the size follows from the value itself (bytes, char, bin and hex strings) and the label's count does not fit it, the label is updated to match the value,
+        including the label's field in the buffer if it was set by a value token, so counts do not have to be kept in sync by hand.
+        A count that fits the value is kept even if it is not a whole number of characters, e.g. 12 bits for a 2 byte value, so extracted data constructs the same bytes again.
+        """
+        if encoding in (Encoding.BYTS,Encoding.CHAR):
+            unit = 8
+        elif encoding == Encoding.BINS:
+            unit = 1
+        elif encoding in (Encoding.LHEX,Encoding.UHEX):
+            unit = 4
+        else:
+            return count.resolve(self)
+        current = count.resolve(self)
+        if current >= 0 and -(-current//unit) == len(value):
+            return current
+        num_bits = len(value)*unit
+        label_value = count.invert(num_bits)
+        if label_value != self[count.label]:
+            if not count.label in self.label_fields:
+                raise Exception('Token = %s; Label "%s" = %r does not match the size of the value and has no field to update' % (self.tok,count.label,self[count.label]))
+            pos,field_bits,field_encoding,flat_index = self.label_fields[count.label]
+            if not field_encoding in (Encoding.UINT,Encoding.SINT):
+                raise Exception('Token = %s; Label "%s" must be an integer field to be updated' % (self.tok,count.label))
+            current = self.tell_buffer()
+            self.bit_stream.seek(pos)
+            self.bit_stream.write(uint_encode(label_value,field_bits,field_encoding),field_bits)
+            self.bit_stream.seek(current)
+            if self.data_stream is not None:
+                self.data_stream[flat_index] = label_value
+            old_value,index_stack,flat_pos = self.labels[count.label][-1]
+            self.labels[count.label][-1] = (label_value,index_stack,flat_pos)
+            if self.debugging:
+                self.logger.debug('%s: updated label "%s" from %r to %r' % (self.tok,count.label,old_value,label_value))
+        return num_bits
+
     def _consume_data(self,num_bits=None,encoding=Encoding.UINT):
-        value = self.data_stream[self.flat_pos]
+        self.last_field = None
+        if self.data_stream is None:
+            value = self._next_value()
+        else:
+            value = self.data_stream[self.flat_pos]
         self.flat_pos += 1
-        self.stack[-1].append(value)
-        uint_value = uint_encode(value,num_bits,encoding)
+        if self.records:
+            self.stack[-1].append(value)
+        if isinstance(value,LazyValue):
+            uint_value = value.uint() if value.num_bits == num_bits else uint_encode(value.value,num_bits,encoding)
+        else:
+            uint_value = uint_encode(value,num_bits,encoding)
         self.last_value = value
         self.last_index_stack = tuple(self.index_stack)
         self.index_stack[-1] += 1
@@ -923,14 +2188,22 @@ class Constructor(Maker):
 
             
     def handle_value(self,num_bits,encoding):
+        if isinstance(num_bits,Count):
+            num_bits = self._fill_count(num_bits,self._peek_value() if self.data_stream is None else self.data_stream[self.flat_pos],encoding)
         uint_value,value = self._consume_data(num_bits,encoding)
+        self.last_field = (self.tell_buffer(),num_bits,encoding)
         self._insert_bits(uint_value,num_bits,encoding)
-        self.logger.debug('%s = %r' % (self.tok,value))
+        if self.debugging:
+            self.logger.debug('%s = %r' % (self.tok,value))
 
     def handle_takeall(self,encoding):
-        first_byte_value,first_byte_bits,bytes_data = self.data_stream[self.flat_pos]
+        if self.data_stream is None:
+            first_byte_value,first_byte_bits,bytes_data = self._next_value()
+        else:
+            first_byte_value,first_byte_bits,bytes_data = self.data_stream[self.flat_pos]
         self.flat_pos += 1
-        self.stack[-1].append(bytes_data)
+        if self.records:
+            self.stack[-1].append(bytes_data)
         self.last_value = bytes_data
         self.last_index_stack = tuple(self.index_stack)
         self.index_stack[-1] += 1
@@ -940,12 +2213,18 @@ class Constructor(Maker):
 
     def handle_next(self,num_bits):
         #bits are don't care - no reversals or inversions
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
         self.bit_stream.write(0,num_bits)
 
     def handle_zeros(self,num_bits):
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
         self._insert_bits(0,num_bits)
 
     def handle_ones(self,num_bits):
+        if isinstance(num_bits,Count):
+            num_bits = num_bits.resolve(self)
         all_ones = (1<<num_bits)-1
         self._insert_bits(all_ones,num_bits)
 
@@ -954,7 +2233,7 @@ class Constructor(Maker):
         if modtype == ModType.ENDIANSWAP:
             self._endianswap(num_bits)
         else:
-            self.mod_operations.append((self.tok,mod_type,self.tell_buffer(),0,num_bits))
+            self.mod_operations.append((self.tok,modtype,self.tell_buffer(),0,num_bits))
 
     def handle_marker(self,bytes_literal):
         num_bits = len(bytes_literal)*8
@@ -967,7 +2246,8 @@ class Constructor(Maker):
         self.handle_nestclose()
         self._pull(m,n)
         self._insert_bits(uint_encode(bytes_literal,num_bits,Encoding.BYTS),num_bits,Encoding.BYTS)
-        self.logger.debug('Scan for %s: offset = %d, pulled bits = %d' % (repr(bytes_literal),m,n))
+        if self.debugging:
+            self.logger.debug('Scan for %s: offset = %d, pulled bits = %d' % (repr(bytes_literal),m,n))
 
     def handle_modoff(self,offset_bits,num_bits,modtype):
         #the bit stream does not fully exist yet, so store all reversals and inversions, then apply them at the end
@@ -977,7 +2257,7 @@ class Constructor(Maker):
         if modtype == ModType.PULL:
             self._pull(offset_bits,num_bits)
         else:
-            self.mod_operations.append((self.tok,mod_type,pos,offset_bits,num_bits))
+            self.mod_operations.append((self.tok,modtype,pos,offset_bits,num_bits))
 
     def handle_modset(self,modtype,setting):
         if modtype == ModType.REVERSE:
@@ -1011,12 +2291,22 @@ class Constructor(Maker):
             raise Exception('Token = %s; Invalid modtype: %s' % (self.tok,repr(modtype)))
 
     def handle_setlabel(self,label):
-        if not label in self.labels:
-            self.labels[label] = []
-        self.labels[label].append((self.last_value,self.last_index_stack,self.flat_pos-1))
+        if self.data_stream is None: #a lazy data stream only keeps the latest value of each label
+            self.labels[label] = [(self.last_value,self.last_index_stack,self.flat_pos-1)]
+        else:
+            if not label in self.labels:
+                self.labels[label] = []
+            self.labels[label].append((self.last_value,self.last_index_stack,self.flat_pos-1))
+        if self.last_field is not None:
+            self.label_fields[label] = self.last_field + (self.flat_pos-1,)
+        else:
+            self.label_fields.pop(label,None)
 
     def handle_deflabel(self,label,value):
+        if not label in self.labels:
+            self.labels[label] = []
         self.labels[label].append((value,None,None))
+        self.label_fields.pop(label,None)
 
     def handle_matchlabel(self,label):
         if not label in self.labels:
@@ -1026,7 +2316,8 @@ class Constructor(Maker):
 
     def handle_nestopen(self):
         new_record = []
-        self.stack[-1].append(new_record) #embed new record into the previous record
+        if self.records:
+            self.stack[-1].append(new_record) #embed new record into the previous record
         self.stack.append(new_record) #make the new record the active record being worked on
         self.index_stack.append(0)
 
@@ -1045,54 +2336,71 @@ class Constructor(Maker):
             raise AssertionError('Token = %s; Expected value = %s; Extracted value = %s' % (self.tok,repr(value),repr(self.last_value)))
 
     def handle_jump(self,num_bits,jump_type):
-        pos = self.tell()
+        pos = self.tell_buffer()
         L = len(self.bit_stream)
         if jump_type in [JumpType.FORWARD,JumpType.BACKWARD]:
-            self.logger.debug('Jump relative pos -> orig = %d -> %d' % (pos,target_orig))
             target_orig = self._translate_to_original(pos)
+            if self.debugging:
+                self.logger.debug('Jump relative pos -> orig = %d -> %d' % (pos,target_orig))
         elif jump_type == JumpType.END:
-            self.logger.debug('Jump relative to end: %d' % L)
+            if self.debugging:
+                self.logger.debug('Jump relative to end: %d' % L)
             target_orig = L
         else:
-            self.logger.debug('Jump relative to beginning')
+            if self.debugging:
+                self.logger.debug('Jump relative to beginning')
             target_orig = 0
         if jump_type in [JumpType.START, JumpType.FORWARD]:
-            self.logger.debug('Jump forward offset: %d + %d = %d' % (target_orig,num_bits,target_orig+num_bits))
+            if self.debugging:
+                self.logger.debug('Jump forward offset: %d + %d = %d' % (target_orig,num_bits,target_orig+num_bits))
             target_orig += num_bits
         else:
-            self.logger.debug('Jump backward offset: %d - %d = %d' % (target_orig,num_bits,target_orig-num_bits))
+            if self.debugging:
+                self.logger.debug('Jump backward offset: %d - %d = %d' % (target_orig,num_bits,target_orig-num_bits))
             target_orig -= num_bits
         target = self._translate_from_original(target_orig)
-        self.logger.debug('Jump target translation: orig -> pos = %d -> %d' % (target_orig,target))
+        if self.debugging:
+            self.logger.debug('Jump target translation: orig -> pos = %d -> %d' % (target_orig,target))
         offset = target - pos
-        self.logger.debug('Jump actual buffer offset = %d - %d = %d' % (target,pos,offset))
+        if self.debugging:
+            self.logger.debug('Jump actual buffer offset = %d - %d = %d' % (target,pos,offset))
         if offset < 0:
             raise Exception('Jump is to already parsed location: %s' % self.tok)
         if offset > 0:
             self._pull(offset,None)
-            self.logger.debug('Jump pull offset = %d, num_bits = %d' % (offset,num_bits))
-
-def extract(blueprint,byte_stream,*args,**kwargs):
-    maker = Extractor(byte_stream)
-    if isinstance(blueprint,(bytes,str)):
-        result = maker(blueprint)
+            if self.debugging:
+                self.logger.debug('Jump pull offset = %d, num_bits = %d' % (offset,num_bits))
+
+def extract(blueprint,byte_stream,*args,spill_threshold=None,release_consumed=False,parallel_workers=None,parallel_backend='process',fast=False,output='all',compact=False,intern=False,lazy_min_bits=None,source_map=False,**kwargs):
+    is_pattern = isinstance(blueprint,(bytes,str))
+    records = not is_pattern or output == 'record' or (output == 'all' and not fast)
+    maker = Extractor(byte_stream,spill_threshold=spill_threshold,release_consumed=release_consumed,parallel_workers=parallel_workers,parallel_backend=parallel_backend,fast=fast,output=output,records=records,compact=compact,intern=intern,lazy_min_bits=lazy_min_bits,source_map=source_map)
+    if is_pattern:
+        result = maker(blueprint,**kwargs)
+        if not records: #the data record of a single call would be a copy of the data structure, so return what was built instead
+            result = maker.data_stream if output == 'stream' else maker.data_structure
     else:
         result = blueprint(maker,*args,**kwargs)
     maker.finalize()
     return maker, result
 
 def extract_data_structure(blueprint,byte_stream,*args,**kwargs):
-    maker,result = extract(blueprint,byte_stream,*args,**kwargs)
+    maker,result = extract(blueprint,byte_stream,*args,output='structure',**kwargs)
     return maker.data_structure
 
 def extract_data_stream(blueprint,byte_stream,*args,**kwargs):
-    maker,result = extract(blueprint,byte_stream,*args,**kwargs)
+    maker,result = extract(blueprint,byte_stream,*args,output='stream',**kwargs)
     return maker.data_stream
 
-def construct(blueprint,data_stream,*args,**kwargs):
-    maker = Constructor(data_stream)
-    if isinstance(blueprint,(bytes,str)):
-        result = maker(blueprint)
+def construct(blueprint,data_stream,*args,spill_threshold=None,byte_stream=None,lazy=None,**kwargs):
+    is_pattern = isinstance(blueprint,(bytes,str))
+    maker = Constructor(data_stream,spill_threshold=spill_threshold,byte_stream=byte_stream,lazy=lazy)
+    if is_pattern and maker.data_stream is None: #the data record would hold every value of the lazy data stream
+        maker.records = False
+        maker(blueprint,**kwargs)
+        result = None
+    elif is_pattern:
+        result = maker(blueprint,**kwargs)
     else:
         result = blueprint(maker,*args,**kwargs)
     maker.finalize()
@@ -0,0 +1,534 @@
+"""
+This module provides compact list-like containers for the flat outputs of an Extractor with compact=True, the ValueInterner of an Extractor with intern=True,
+the LazyValue fields of an Extractor with lazy_min_bits set, and the SourceMap of an Extractor with source_map=True.
+
+CompactList stores a data stream in chunks that are typed arrays for as long as their values are integers, SparseList stores flat labels by position,
+and PatternBuffer stores the characters of a flat pattern one byte each. All of them support the list operations that blueprint code uses.
+"""
+from array import array
+import bisect
+from collections import Counter
+from collections.abc import MutableSequence
+import itertools
+from .bit_utils import Encoding, uint_decode
+
+COMPACT_CHUNK_BITS = 16 #a CompactList chunk holds 1<<COMPACT_CHUNK_BITS values
+_CHUNK_SIZE = 1<<COMPACT_CHUNK_BITS
+_CHUNK_MASK = _CHUNK_SIZE-1
+_TYPECODES = ('b','h','i','q') #signed array typecodes from narrowest to widest
+
+def _widen(chunk,value):
+    """
+    Returns a copy of chunk that can also hold value: the narrowest wider typed array, or a list if no typed array can hold it.
+    """
+    if type(value) is int and not isinstance(chunk,list):
+        for typecode in _TYPECODES[_TYPECODES.index(chunk.typecode)+1:]:
+            try:
+                array(typecode,[value])
+            except OverflowError:
+                continue
+            return array(typecode,chunk)
+    return list(chunk)
+
+class CompactList(MutableSequence):
+    """
+    A list of values stored in chunks that are signed typed arrays, one to eight bytes per value, as long as they only hold integers.
+    A chunk is widened when a value does not fit and becomes a plain list when a value is not an integer, so any values can be stored.
+    It only saves memory for integers. Once a value that is not an integer has been appended, later chunks start out as plain lists,
+    so a stream of bytes or strings is stored as lists without checking each value again, but also without any saving.
+    Indexing, slicing (which returns a list), len(), iteration, append(), extend(), assignment and comparison with lists work as they do for a list.
+    Insertion and deletion rebuild the chunks after the position and are slow.
+
+    >>> data_stream = CompactList([1,2,300])
+    >>> data_stream.append(b'ab')
+    >>> data_stream[-2:], len(data_stream), data_stream == [1,2,300,b'ab']
+    ([300, b'ab'], 4, True)
+    """
+    def __init__(self,iterable=()):
+        self.chunks = []
+        self.length = 0
+        self.typed = True #False once a value that is not an integer was appended, so that new chunks start as lists
+        self.extend(iterable)
+
+    def __len__(self):
+        return self.length
+
+    def _index(self,index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('CompactList index out of range')
+        return index
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        index = self._index(index)
+        return self.chunks[index>>COMPACT_CHUNK_BITS][index&_CHUNK_MASK]
+
+    def __setitem__(self,index,value):
+        if isinstance(index,slice):
+            values = list(self)
+            values[index] = value
+            self.chunks = []
+            self.length = 0
+            self.typed = True
+            self.extend(values)
+            return
+        index = self._index(index)
+        chunk_index = index>>COMPACT_CHUNK_BITS
+        try:
+            self.chunks[chunk_index][index&_CHUNK_MASK] = value
+        except (OverflowError,TypeError):
+            chunk = _widen(self.chunks[chunk_index],value)
+            chunk[index&_CHUNK_MASK] = value
+            self.chunks[chunk_index] = chunk
+
+    def __delitem__(self,index):
+        values = list(self)
+        del values[index]
+        self.chunks = []
+        self.length = 0
+        self.typed = True
+        self.extend(values)
+
+    def insert(self,index,value):
+        values = list(self)
+        values.insert(index,value)
+        self.chunks = []
+        self.length = 0
+        self.typed = True
+        self.extend(values)
+
+    def append(self,value):
+        if self.length & _CHUNK_MASK == 0:
+            self.chunks.append(array(_TYPECODES[0]) if self.typed else [])
+        chunk = self.chunks[-1]
+        if chunk.__class__ is list:
+            chunk.append(value)
+        else:
+            try:
+                chunk.append(value)
+            except (OverflowError,TypeError):
+                chunk = _widen(chunk,value)
+                chunk.append(value)
+                self.chunks[-1] = chunk
+                self.typed = not isinstance(chunk,list)
+        self.length += 1
+
+    def extend(self,values):
+        for value in values:
+            self.append(value)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.chunks)
+
+    def __eq__(self,other):
+        if isinstance(other,(CompactList,list,tuple)):
+            return len(self) == len(other) and all(a == b for a,b in zip(self,other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CompactList(%s)' % repr(list(self))
+
+class SparseList(MutableSequence):
+    """
+    A list whose items are mostly None, stored as a dictionary of the positions that are not None.
+
+    >>> flat_labels = SparseList()
+    >>> flat_labels.extend([None]*3)
+    >>> flat_labels[-1] = 'length'
+    >>> flat_labels, flat_labels.items
+    ([None, None, 'length'], {2: 'length'})
+    """
+    def __init__(self,iterable=()):
+        self.items = {}
+        self.length = 0
+        self.extend(iterable)
+
+    def __len__(self):
+        return self.length
+
+    def _index(self,index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('SparseList index out of range')
+        return index
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        return self.items.get(self._index(index))
+
+    def __setitem__(self,index,value):
+        if isinstance(index,slice):
+            values = list(self)
+            values[index] = value
+            self.items = {}
+            self.length = 0
+            self.extend(values)
+            return
+        index = self._index(index)
+        if value is None:
+            self.items.pop(index,None)
+        else:
+            self.items[index] = value
+
+    def __delitem__(self,index):
+        values = list(self)
+        del values[index]
+        self.items = {}
+        self.length = 0
+        self.extend(values)
+
+    def insert(self,index,value):
+        values = list(self)
+        values.insert(index,value)
+        self.items = {}
+        self.length = 0
+        self.extend(values)
+
+    def append(self,value):
+        if value is not None:
+            self.items[self.length] = value
+        self.length += 1
+
+    def extend(self,values):
+        if isinstance(values,SparseList):
+            for index,value in values.items.items():
+                self.items[self.length+index] = value
+            self.length += values.length
+        else:
+            for value in values:
+                self.append(value)
+
+    def __iter__(self):
+        items = self.items
+        return (items.get(index) for index in range(self.length))
+
+    def __eq__(self,other):
+        if isinstance(other,(SparseList,list,tuple)):
+            return len(self) == len(other) and all(a == b for a,b in zip(self,other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+class PatternBuffer():
+    """
+    The characters of a flat pattern ('.', '[' and ']') stored one byte each. Iterating it gives the characters, so ''.join() and deflatten() accept it.
+
+    >>> flat_pattern = PatternBuffer()
+    >>> flat_pattern.append('[')
+    >>> flat_pattern.extend('..]')
+    >>> ''.join(flat_pattern), len(flat_pattern)
+    ('[..]', 4)
+    """
+    def __init__(self,chars=''):
+        self.data = bytearray(chars.encode('ascii'))
+    def append(self,char):
+        self.data.append(ord(char))
+    def extend(self,chars):
+        self.data += ''.join(chars).encode('ascii')
+    def __len__(self):
+        return len(self.data)
+    def __iter__(self):
+        return iter(self.data.decode('ascii'))
+    def __str__(self):
+        return self.data.decode('ascii')
+    def __repr__(self):
+        return 'PatternBuffer(%s)' % repr(str(self))
+
+INTERN_MAX_ENTRIES = 1<<16 #default number of distinct values a ValueInterner keeps per encoding
+INTERN_ENCODINGS = frozenset((Encoding.BYTS,Encoding.CHAR,Encoding.BINS,Encoding.LHEX,Encoding.UHEX)) #encodings a ValueInterner keeps, the ones that decode to new str/bytes objects
+
+class ValueInterner():
+    """
+    Decodes values like uint_decode() but returns the same object every time the same bits are decoded with the same encoding and width,
+    so repeated hex strings, bin strings and byte strings in the extracted data share one instance.
+    The decoded values are looked up by their raw bits, which also skips decoding them again.
+    Only the encodings in INTERN_ENCODINGS are kept. Integers and floats are decoded as usual and not counted, since keeping them saves nothing.
+    At most max_entries distinct values are kept per encoding. Once an encoding is full, new values are decoded as usual and not kept.
+    hits and misses count the lookups per encoding, and stats() summarizes them.
+
+    >>> from .bit_utils import Encoding
+    >>> interner = ValueInterner()
+    >>> values = [interner.decode(0xabcd,16,Encoding.LHEX) for i in range(4)]
+    >>> values[0] is values[3], interner.stats()['LHEX']
+    (True, {'hits': 3, 'misses': 1, 'entries': 1, 'hit_rate': 0.75})
+    >>> interner.decode(7,8,Encoding.UINT), 'UINT' in interner.stats()
+    (7, False)
+    """
+    def __init__(self,max_entries=INTERN_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.tables = {} #(encoding, num_bits) -> {uint_value: value}
+        self.entries = Counter() #encoding -> number of values kept
+        self.hits = Counter() #encoding -> number of lookups that returned a kept value
+        self.misses = Counter() #encoding -> number of lookups that decoded a new value
+
+    def decode(self,uint_value,num_bits,encoding):
+        if encoding not in INTERN_ENCODINGS:
+            return uint_decode(uint_value,num_bits,encoding)
+        table = self.tables.get((encoding,num_bits))
+        if table is None:
+            table = self.tables[(encoding,num_bits)] = {}
+        value = table.get(uint_value) #decoded values are never None
+        if value is not None:
+            self.hits[encoding] += 1
+            return value
+        self.misses[encoding] += 1
+        value = uint_decode(uint_value,num_bits,encoding)
+        if self.entries[encoding] < self.max_entries:
+            table[uint_value] = value
+            self.entries[encoding] += 1
+        return value
+
+    @property
+    def hit_rate(self):
+        """
+        The fraction of all lookups that returned a kept value.
+        """
+        lookups = sum(self.hits.values()) + sum(self.misses.values())
+        return sum(self.hits.values())/lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Returns {encoding name: {'hits':..., 'misses':..., 'entries':..., 'hit_rate':...}} for every encoding that was looked up.
+        """
+        stats = {}
+        for encoding in self.hits.keys() | self.misses.keys():
+            hits,misses = self.hits[encoding],self.misses[encoding]
+            stats[encoding.name] = {'hits':hits,'misses':misses,'entries':self.entries[encoding],'hit_rate':hits/(hits+misses)}
+        return stats
+
+    def clear(self):
+        """
+        Drops the kept values and resets the counts.
+        """
+        self.tables.clear()
+        self.entries.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+LAZY_ENCODINGS = (Encoding.BYTS,Encoding.CHAR,Encoding.LHEX,Encoding.UHEX,Encoding.BINS) #encodings whose fields an Extractor can leave undecoded
+
+class LazyValue():
+    """
+    A field of the input that is decoded only when it is accessed. It holds the input buffer, the bit position and width of the field, and its encoding.
+    value decodes it, uint() returns its bits as an unsigned integer, and view() returns a memoryview of its bytes without copying them if it is byte aligned.
+    It compares equal to its decoded value, and bytes(), str() and len() work on the decoded value, so most code can treat it as the value itself.
+    The value is decoded again on every access, so keep it if it is needed repeatedly. A Constructor writes the bits of a LazyValue of the same width without encoding a value.
+
+    >>> field = LazyValue(b'\\x00abc',8,24,Encoding.BYTS)
+    >>> field == b'abc', bytes(field.view()), field
+    (True, b'abc', LazyValue(BYTS,8,24))
+    """
+    __slots__ = ('source','start','num_bits','encoding')
+    def __init__(self,source,start,num_bits,encoding):
+        self.source = source #bytes-like object of the input
+        self.start = start #bit position of the field in source
+        self.num_bits = num_bits
+        self.encoding = encoding
+
+    def _byte_range(self):
+        start_byte = self.start//8
+        end_byte = -(-(self.start+self.num_bits)//8)
+        return start_byte,end_byte
+
+    def view(self):
+        """
+        Returns a memoryview of the bytes of the field. The field must start and end on byte boundaries.
+        """
+        if self.start % 8 != 0 or self.num_bits % 8 != 0:
+            raise Exception('LazyValue of %d bits at bit %d is not byte aligned' % (self.num_bits,self.start))
+        return memoryview(self.source)[self.start//8:(self.start+self.num_bits)//8]
+
+    def uint(self):
+        """
+        Returns the bits of the field as an unsigned integer.
+        """
+        start_byte,end_byte = self._byte_range()
+        rstrip = end_byte*8 - (self.start+self.num_bits)
+        return (int.from_bytes(self.source[start_byte:end_byte],'big') >> rstrip) & ((1<<self.num_bits)-1)
+
+    @property
+    def value(self):
+        if self.encoding in (Encoding.BYTS,Encoding.CHAR) and self.start % 8 == 0 and self.num_bits % 8 == 0:
+            return bytes(self.view())
+        return uint_decode(self.uint(),self.num_bits,self.encoding)
+
+    def __len__(self):
+        if self.encoding in (Encoding.BYTS,Encoding.CHAR) and self.num_bits % 8 == 0:
+            return self.num_bits//8
+        return len(self.value)
+
+    def __bytes__(self):
+        return bytes(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __eq__(self,other):
+        if isinstance(other,LazyValue):
+            other = other.value
+        return self.value == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return 'LazyValue(%s,%d,%d)' % (self.encoding.name,self.start,self.num_bits)
+
+    def __reduce__(self):
+        #pickles only the bytes of the field rather than the whole input
+        start_byte,end_byte = self._byte_range()
+        return (LazyValue,(bytes(self.source[start_byte:end_byte]),self.start-start_byte*8,self.num_bits,self.encoding))
+
+SOURCE_MAP_CHECKPOINT_BITS = 6 #a SourceMap keeps the absolute buffer position of every 1<<SOURCE_MAP_CHECKPOINT_BITS items
+
+class SourceMap():
+    """
+    The original bit offset, bit length and encoding of every item of a data stream, so any single field can be read again from the input by its stream index.
+    Items that do not come from a field of the input, such as the values that jumps insert, have an offset of -1 and a length of 0.
+    The bits at the offset are those of the input before any modifications, e.g. a field that was read with an endian swap is stored swapped there.
+    A reversal that only partly covers a field scatters its bits, so its offset and length are then those of the span holding all of them and num_bits() gives the field's own width.
+    For patch(), it also keeps the buffer position of each field and the number of mod operations that had been applied when it was read.
+
+    Fields usually follow each other in the buffer, so the positions are stored as the gaps between fields in the narrowest typed array that holds them,
+    with the absolute position of every 1<<SOURCE_MAP_CHECKPOINT_BITS items to look one up from. Offsets are only stored for the fields that reversals moved,
+    and the mod operation counts as runs. An item then takes about three bytes.
+
+    >>> source_map = SourceMap()
+    >>> source_map.append(8,16,Encoding.UINT)
+    >>> source_map.append_unmapped()
+    >>> source_map[0], source_map[-1], source_map.read(0,b'\\x00\\x01\\x02')
+    ((8, 16), (-1, 0), 258)
+    """
+    def __init__(self):
+        self.encodings = array('b') #Encoding values, 0 for items that are not mapped
+        self.lengths = array('b') #bit width of each field, widened as needed
+        self.gaps = array('b') #buffer position of each field minus the end of the previous field, widened as needed
+        self.checkpoints = array('q') #buffer position after the fields before each 1<<SOURCE_MAP_CHECKPOINT_BITS items
+        self.moved = {} #stream index -> (offset, span bits) of the fields whose original span is not their buffer span
+        self.mod_starts = array('q') #stream index where each run of equal mod operation counts starts
+        self.mod_values = array('q') #mod operation count of each run
+        self.end = 0 #buffer position after the last field
+
+    def _add(self,encoding,num_bits,gap):
+        if len(self.encodings) & ((1<<SOURCE_MAP_CHECKPOINT_BITS)-1) == 0:
+            self.checkpoints.append(self.end)
+        self.encodings.append(encoding)
+        for name,value in (('lengths',num_bits),('gaps',gap)):
+            column = getattr(self,name)
+            try:
+                column.append(value)
+            except OverflowError:
+                column = _widen(column,value)
+                column.append(value)
+                setattr(self,name,column)
+
+    def append(self,offset,num_bits,encoding,position=None,mod_count=0,span_bits=None):
+        """
+        Maps the next item to a field of num_bits bits at the buffer position, whose bits came from span_bits bits at offset in the original input.
+        position defaults to offset and span_bits to num_bits.
+        """
+        if position is None:
+            position = offset
+        if span_bits is None:
+            span_bits = num_bits
+        if offset != position or span_bits != num_bits:
+            self.moved[len(self.encodings)] = (offset,span_bits)
+        if len(self.mod_values) == 0 or self.mod_values[-1] != mod_count:
+            self.mod_starts.append(len(self.encodings))
+            self.mod_values.append(mod_count)
+        self._add(encoding.value,num_bits,position-self.end)
+        self.end = position+num_bits
+
+    def append_unmapped(self,count=1):
+        for i in range(count):
+            self._add(0,0,0)
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def _index(self,index):
+        if index < 0:
+            index += len(self.encodings)
+        if not 0 <= index < len(self.encodings):
+            raise IndexError('SourceMap index out of range')
+        return index
+
+    def __getitem__(self,index):
+        index = self._index(index)
+        if not self.encodings[index]:
+            return -1,0
+        if index in self.moved:
+            return self.moved[index]
+        return self.position(index),self.lengths[index]
+
+    def encoding(self,index):
+        """
+        Returns the Encoding the item at the stream index was extracted with, or None if it is not mapped.
+        """
+        value = self.encodings[index]
+        return Encoding(value) if value else None
+
+    def num_bits(self,index):
+        """
+        Returns the bit width of the field of the item at the stream index, or 0 if it is not mapped.
+        """
+        return self.lengths[self._index(index)]
+
+    def position(self,index):
+        """
+        Returns the buffer bit position the item at the stream index was read from, or -1 if it is not mapped.
+        """
+        index = self._index(index)
+        if not self.encodings[index]:
+            return -1
+        first = index >> SOURCE_MAP_CHECKPOINT_BITS << SOURCE_MAP_CHECKPOINT_BITS
+        position = self.checkpoints[index >> SOURCE_MAP_CHECKPOINT_BITS]
+        gaps,lengths,encodings = self.gaps,self.lengths,self.encodings
+        for i in range(first,index):
+            if encodings[i]:
+                position += gaps[i] + lengths[i]
+        return position + gaps[index]
+
+    def mod_count(self,index):
+        """
+        Returns the number of mod operations that had been applied when the item at the stream index was read.
+        """
+        index = self._index(index)
+        run = bisect.bisect_right(self.mod_starts,index)-1
+        return self.mod_values[run] if run >= 0 else 0
+
+    def read(self,index,source,encoding=None):
+        """
+        Reads the item at the stream index again from source and decodes it, without running the blueprint.
+        source is the original input: a bytes-like object, or a seekable binary file.
+        encoding defaults to the one the item was extracted with.
+        A field whose bits a partial reversal scattered cannot be read this way.
+        """
+        offset,span_bits = self[index]
+        if offset < 0:
+            raise Exception('Item %d of the data stream does not come from a field of the input' % index)
+        num_bits = self.num_bits(index)
+        if span_bits != num_bits:
+            raise Exception('Item %d of the data stream is a field of %d bits scattered over %d bits of the source by a partial reversal' % (index,num_bits,span_bits))
+        start_byte = offset//8
+        end_byte = -(-(offset+num_bits)//8)
+        if hasattr(source,'read'):
+            source.seek(start_byte)
+            data = source.read(end_byte-start_byte)
+        else:
+            data = memoryview(source).cast('B')[start_byte:end_byte]
+        if len(data) != end_byte-start_byte:
+            raise Exception('Item %d of the data stream is beyond the end of the source' % index)
+        rstrip = end_byte*8 - (offset+num_bits)
+        uint_value = (int.from_bytes(data,'big') >> rstrip) & ((1<<num_bits)-1)
+        return uint_decode(uint_value,num_bits,self.encoding(index) if encoding is None else encoding)
@@ -0,0 +1,178 @@
+"""
+This module provides TracedBlueprint, which records the patterns that a function blueprint applies to one input and replays them for later inputs of the same shape.
+
+A function blueprint mixes maker(...) calls with Python code that decides what to apply next.
+If that code only looks at the data through maker[label], a trace of the calls is valid for any input whose labels have the same values at the same points.
+The trace is replayed as a few combined pattern calls with a guard check on each label the function read. When a guard fails, the maker is reset and the function runs as usual.
+"""
+from .pattern import Extractor, Constructor, extract
+
+_RECORD_READ_METHODS = ('__getitem__','__iter__','__len__','__contains__','__eq__','__ne__','__reversed__','__repr__','__str__','__add__','__mul__','__reduce_ex__','index','count','copy')
+
+class _TracedRecord(list):
+    """
+    Data record returned to the blueprint while tracing. Reading it marks the trace as data dependent.
+    """
+    __slots__ = ('tracer',)
+
+def _record_read(name):
+    method = getattr(list,name)
+    def read(self,*args,**kwargs):
+        self.tracer._data_dependent('reads the data record of %s' % repr(self.tracer.steps[-1][0]))
+        return method(self,*args,**kwargs)
+    read.__name__ = name
+    return read
+
+for _name in _RECORD_READ_METHODS:
+    setattr(_TracedRecord,_name,_record_read(_name))
+
+class _TracingMaker():
+    """
+    Stands in for the maker while a blueprint is traced. Pattern calls and label reads are recorded and passed through to the maker.
+    Anything else makes the trace data dependent, but is still passed through so the blueprint runs normally.
+    """
+    def __init__(self,maker):
+        self._maker = maker
+        self.steps = [] #(pattern, params)
+        self.guards = [] #(number of steps before the read, label, value)
+        self.reason = None #why the trace cannot be replayed
+    def _data_dependent(self,reason):
+        if self.reason is None:
+            self.reason = reason
+    def __call__(self,pattern,**params):
+        self.steps.append((pattern,dict(params)))
+        record = _TracedRecord(self._maker(pattern,**params))
+        record.tracer = self
+        return record
+    def __getitem__(self,label):
+        value = self._maker[label]
+        self.guards.append((len(self.steps),label,value))
+        return value
+    def __setitem__(self,label,value):
+        self._data_dependent('assigns label "%s"' % label)
+        self._maker[label] = value
+    def __delitem__(self,label):
+        self._data_dependent('deletes label "%s"' % label)
+        del self._maker[label]
+    def __getattr__(self,name):
+        self._data_dependent('uses maker.%s' % name)
+        return getattr(self._maker,name)
+
+class BlueprintProgram():
+    """
+    A traced blueprint compiled to segments of (pattern, params, guards).
+    Consecutive pattern calls with no label read between them are joined into one pattern, so each segment is a single maker call.
+    The guards of a segment are (label, value) pairs that are checked after the segment is applied.
+    """
+    def __init__(self,steps,guards):
+        guards_after = {}
+        for num_steps,label,value in guards:
+            guards_after.setdefault(num_steps,[]).append((label,value))
+        self.initial_guards = guards_after.pop(0,[])
+        self.segments = []
+        patterns = []
+        params = {}
+        for index,(pattern,step_params) in enumerate(steps):
+            if any(name in params and params[name] != value for name,value in step_params.items()):
+                self.segments.append(('\n'.join(patterns),params,[]))
+                patterns = []
+                params = {}
+            patterns.append(pattern)
+            params.update(step_params)
+            if index+1 in guards_after or index+1 == len(steps):
+                self.segments.append(('\n'.join(patterns),params,guards_after.get(index+1,[])))
+                patterns = []
+                params = {}
+
+    def replay(self,maker):
+        """
+        Applies the program to the maker. Returns False as soon as a guard fails, and True if every guard passed.
+        """
+        if not _guards_pass(maker,self.initial_guards):
+            return False
+        for pattern,params,guards in self.segments:
+            maker(pattern,**params)
+            if not _guards_pass(maker,guards):
+                return False
+        return True
+
+def _guards_pass(maker,guards):
+    for label,value in guards:
+        try:
+            if maker[label] != value:
+                return False
+        except KeyError:
+            return False
+    return True
+
+class TracedBlueprint():
+    """
+    Wraps a function blueprint so that it is traced on its first input and replayed as a BlueprintProgram on later inputs.
+    Use it wherever the function would be used, e.g. extract(TracedBlueprint(blueprint),byte_stream).
+
+    A trace can only be replayed if the function reads the data through maker[label] alone, returns None, and does not depend on anything other than its arguments.
+    If the function reads a data record returned by maker(...), uses other maker attributes or methods, assigns labels, or returns a value,
+    it is called directly from then on and reason says why.
+    A replay is only attempted on a maker that has not been applied yet, with the same extra arguments as the trace.
+    If a guard fails, the maker is reset and the function is called, so the result is always the same as calling the function.
+    Makers that release consumed input and Constructors that take their data lazily from an iterator cannot be reset, so they always call the function.
+
+    >>> def message(maker):
+    ...     maker('u8 #"type"')
+    ...     if maker['type'] == 1:
+    ...         maker('u16')
+    ...     else:
+    ...         maker('u8 u8')
+    >>> traced = TracedBlueprint(message)
+    >>> extract(traced,b'\\x01\\x00\\x02')[0].data_stream
+    [1, 2]
+    >>> extract(traced,b'\\x01\\x00\\x03')[0].data_stream, traced.replays
+    ([1, 3], 1)
+    >>> extract(traced,b'\\x02\\x05\\x06')[0].data_stream, traced.fallbacks
+    ([2, 5, 6], 1)
+    """
+    def __init__(self,blueprint):
+        self.blueprint = blueprint
+        self.program = None
+        self.reason = None #why the blueprint cannot be replayed, once it has been traced
+        self.args = None
+        self.replays = 0
+        self.fallbacks = 0
+
+    def __call__(self,maker,*args,**kwargs):
+        if self.reason is not None or not _is_fresh(maker):
+            return self.blueprint(maker,*args,**kwargs)
+        if self.program is None:
+            return self.trace(maker,*args,**kwargs)
+        if (args,kwargs) != self.args:
+            self.fallbacks += 1
+            return self.blueprint(maker,*args,**kwargs)
+        if self.program.replay(maker):
+            self.replays += 1
+            return None
+        self.fallbacks += 1
+        if isinstance(maker,Extractor):
+            maker.reset(maker.byte_stream)
+        else:
+            maker.reset(maker.data_structure)
+        return self.blueprint(maker,*args,**kwargs)
+
+    def trace(self,maker,*args,**kwargs):
+        """
+        Calls the blueprint with maker and records a program from it. Returns the result of the blueprint.
+        """
+        tracer = _TracingMaker(maker)
+        result = self.blueprint(tracer,*args,**kwargs)
+        if result is not None:
+            tracer._data_dependent('returns a value')
+        if tracer.reason is not None:
+            self.reason = tracer.reason
+        else:
+            self.args = (args,kwargs)
+            self.program = BlueprintProgram(tracer.steps,tracer.guards)
+        return result
+
+def _is_fresh(maker):
+    if isinstance(maker,Constructor) and maker.data_stream is None: #lazy input cannot be rewound after a failed replay
+        return False
+    return maker.flat_pos == 0 and maker.tell_buffer() == 0 and not getattr(maker,'release_consumed',False)
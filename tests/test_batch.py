@@ -0,0 +1,238 @@
+import io, os, random, shutil, tempfile, unittest
+from bitarchitect import *
+
+def _random_bytes(n,seed=0):
+    return bytes(random.Random(seed).getrandbits(8) for i in range(n))
+
+def length_prefixed(maker):
+    #module level so that it can be sent to worker processes
+    n = maker('u8')[0]
+    return maker('B%d' % (8*n))[0]
+
+class TestExtractMany(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        self.expected = {}
+        for i in range(6):
+            data = bytes([i]) + _random_bytes(i,i)
+            path = os.path.join(self.directory,'%d.bin' % i)
+            with open(path,'wb') as f:
+                f.write(data)
+            self.paths.append(path)
+            self.expected[path] = data[1:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_per_path(self):
+        results = list(extract_many(length_prefixed,iter(self.paths),workers=2,chunksize=2,max_in_flight=1))
+        self.assertEqual(sorted(path for path,data_stream,result,error in results),sorted(self.paths))
+        for path,data_stream,result,error in results:
+            self.assertIsNone(error)
+            self.assertEqual(result,self.expected[path])
+            self.assertEqual(data_stream,[len(result),result])
+
+    def test_pattern_and_release_consumed(self):
+        results = list(extract_many('u8 {u8}$',self.paths,workers=2,release_consumed=True))
+        for path,data_stream,result,error in results:
+            self.assertIsNone(error)
+            self.assertEqual(bytes(data_stream[1:]),self.expected[path])
+
+    def test_output_settings(self):
+        for output in ('stream','structure','record'):
+            results = list(extract_many('u8 {B8}$',self.paths,workers=2,output=output))
+            for path,data_stream,result,error in results:
+                self.assertIsNone(error)
+                expected = [len(self.expected[path])] + [bytes([byte]) for byte in self.expected[path]]
+                if output == 'record':
+                    self.assertIsNone(data_stream)
+                    self.assertEqual(result,expected)
+                else:
+                    self.assertEqual(data_stream,expected)
+
+    def test_pattern_placeholders(self):
+        results = list(extract_many('u{width} {u8}$',self.paths,workers=2,width=8))
+        for path,data_stream,result,error in results:
+            self.assertIsNone(error)
+            self.assertEqual(bytes(data_stream[1:]),self.expected[path])
+
+    def test_lazy_values_are_decoded(self):
+        results = list(extract_many('u8 {B8}$',self.paths,workers=2,lazy_min_bits=8))
+        for path,data_stream,result,error in results:
+            self.assertIsNone(error)
+            self.assertEqual(b''.join(data_stream[1:]),self.expected[path])
+            self.assertNotIn(LazyValue,set(map(type,data_stream)))
+
+    def test_errors_are_captured_per_path(self):
+        empty = os.path.join(self.directory,'empty.bin')
+        open(empty,'wb').close()
+        missing = os.path.join(self.directory,'missing.bin')
+        results = {path:(data_stream,error) for path,data_stream,result,error in extract_many('u16',[empty,missing,self.paths[3]],workers=2)}
+        self.assertIsInstance(results[empty][1],IncompleteDataError)
+        self.assertIsInstance(results[missing][1],FileNotFoundError)
+        self.assertIsNone(results[missing][0])
+        self.assertEqual(results[self.paths[3]],([3<<8 | self.expected[self.paths[3]][0]],None))
+
+def labeled_record(maker,width):
+    maker('u8 #"kind" B%d' % width)
+    return maker['kind']
+
+def region_attached():
+    from bitarchitect import batch
+    return batch._region_source is not None
+
+class TestParallelMap(unittest.TestCase):
+    data = _random_bytes(64,3)
+    regions = [(64,64),(0,32),(256,128)]
+
+    def expected_structure(self,width):
+        structure = []
+        for start_bits,num_bits in self.regions:
+            maker,result = extract('u8 B%d' % width,self.data[start_bits//8:(start_bits+num_bits)//8])
+            structure.append(maker.data_structure)
+        return structure
+
+    def test_matches_sequential_extraction(self):
+        maker = Extractor(self.data)
+        maker('u8')
+        results = maker.parallel_map(labeled_record,self.regions,24,workers=2)
+        maker.finalize()
+        self.assertEqual(results,[self.data[8],self.data[0],self.data[32]])
+        self.assertEqual(maker.data_structure,[self.data[0]]+self.expected_structure(24))
+        self.assertEqual(maker.tell_buffer(),8)
+        self.assertEqual([value for value,index_stack,flat_pos in maker.labels['kind']],results)
+        self.assertEqual([maker.data_stream[flat_pos] for value,index_stack,flat_pos in maker.labels['kind']],results)
+        self.assertEqual(maker.flat_labels.count('kind'),3)
+
+    def test_file_input(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory,'input.bin')
+        with open(path,'wb') as f:
+            f.write(self.data)
+        try:
+            with open(path,'rb') as f:
+                maker = Extractor(f)
+                maker.parallel_map('u8 B24',self.regions,workers=2)
+                maker.finalize()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(maker.data_structure,self.expected_structure(24))
+
+    def test_caller_executor_is_detached(self):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        for executor_class in (ProcessPoolExecutor,ThreadPoolExecutor):
+            with executor_class(max_workers=1) as executor:
+                maker = Extractor(bytearray(self.data))
+                maker.parallel_map('u8 B24',self.regions,executor=executor)
+                maker.finalize()
+                self.assertEqual(maker.data_structure,self.expected_structure(24))
+                self.assertFalse(executor.submit(region_attached).result())
+
+    def test_pattern_placeholders(self):
+        maker = Extractor(self.data)
+        maker.parallel_map('u8 B{width}',self.regions,workers=2,width=24)
+        maker.finalize()
+        self.assertEqual(maker.data_structure,self.expected_structure(24))
+        constructed = Constructor(maker.data_structure)
+        constructed.parallel_map('u8 B{width}',self.regions,width=24)
+        constructed.finalize()
+        self.assertEqual(bytes(constructed),b''.join(self.data[start_bits//8:start_bits//8+4] for start_bits,num_bits in self.regions))
+
+    def test_invalid_regions(self):
+        maker = Extractor(self.data)
+        for regions in ([(4,8)],[(0,8),(0,16)],[(0,8*65)],[(-8,8)]):
+            with self.assertRaises(Exception):
+                maker.parallel_map('u8',regions,workers=1)
+        self.assertEqual(maker.data_stream,[])
+
+class TestParallelRepetitions(unittest.TestCase):
+    data = _random_bytes(2003,4)
+
+    def assert_matches_sequential(self,pattern,**options):
+        expected,result = extract(pattern,self.data)
+        maker = Extractor(self.data,parallel_workers=2,parallel_min_bytes=16,**options)
+        maker(pattern)
+        maker.finalize()
+        self.assertEqual(maker.data_structure,expected.data_structure)
+        self.assertEqual(maker.flat_pattern,expected.flat_pattern)
+        self.assertEqual(bytes(maker),bytes(expected))
+        self.assertEqual(maker.tell_stream(),expected.tell_stream())
+        constructed,result = construct(pattern,maker.data_stream)
+        self.assertEqual(bytes(constructed),self.data)
+        return maker
+
+    def test_fixed_records(self):
+        self.assert_matches_sequential('u24 {[u4 i12 B16]}400 {u8}$')
+
+    def test_records_that_modify_bits(self):
+        self.assert_matches_sequential('u8 {[r16 u16 e32 u32]}333 {u8}$')
+        self.assert_matches_sequential('u8 {[i8 u4 r8 u12]}600 {u8}$',parallel_backend='thread')
+
+    def test_unqualified_records_run_sequentially(self):
+        self.assert_matches_sequential('{[u8 #"a" B8]}100 {[u4 B12]}300 {u8}$')
+        self.assert_matches_sequential('u4 {u16}300 {u4}$')
+
+    def test_incomplete_last_record(self):
+        with self.assertRaises(IncompleteDataError):
+            extract('{[u16 B16]}$',self.data,parallel_workers=2)
+
+def offset_fixup(index,offset,data):
+    if index > 0:
+        return data + bytes([offset])
+
+class TestConstructParallel(unittest.TestCase):
+    segments = [[i,bytes([i])*i] for i in range(1,8)]
+
+    def expected(self):
+        return b''.join(bytes([i])+bytes([i])*i for i in range(1,8))
+
+    def test_concatenates_in_order(self):
+        self.assertEqual(construct_parallel(length_prefixed_construct,iter(self.segments),workers=2,max_in_flight=1),self.expected())
+        self.assertEqual(construct_parallel('u8 B16',[[1,b'ab'],[2,b'cd']],workers=2),b'\x01ab\x02cd')
+
+    def test_fixup_and_output(self):
+        output = io.BytesIO()
+        total = construct_parallel(length_prefixed_construct,self.segments,workers=2,fixup=offset_fixup,output=output)
+        self.assertEqual(total,len(output.getvalue()))
+        expected = b''
+        for index,(n,data) in enumerate(self.segments):
+            expected += bytes([n]) + data + (bytes([len(expected)]) if index > 0 else b'')
+        self.assertEqual(output.getvalue(),expected)
+
+    def test_pattern_placeholders(self):
+        self.assertEqual(construct_parallel('u{width} #"n" B..."n"*8;',self.segments,workers=2,width=8),self.expected())
+
+    def test_partial_byte_segment(self):
+        with self.assertRaises(Exception):
+            construct_parallel('u4',[[1],[2]],workers=1)
+
+def length_prefixed_construct(maker):
+    n = maker('u8')[0]
+    maker('B%d' % (8*n))
+
+class TestConstructMany(unittest.TestCase):
+    streams = [[i,bytes([i])*i] for i in range(20)]
+
+    def test_backends_match_construct(self):
+        expected = [bytes(construct(length_prefixed_construct,stream)[0]) for stream in self.streams]
+        for backend in (None,'thread','process'):
+            results = list(construct_many(length_prefixed_construct,iter(self.streams),backend=backend,workers=2,chunksize=3))
+            self.assertEqual(results,expected)
+        streams = [[i,bytes([i])*2] for i in range(20)]
+        results = list(construct_many('u8 B16',streams,chunksize=7))
+        self.assertEqual(results,[bytes(construct('u8 B16',stream)[0]) for stream in streams])
+
+    def test_pattern_placeholders(self):
+        for backend in (None,'thread','process'):
+            self.assertEqual(list(construct_many('u{n}',[[1],[2]],backend=backend,workers=2,n=8)),[b'\x01',b'\x02'])
+        with self.assertRaises(Exception):
+            list(construct_many('u{n}',[[1]]))
+
+    def test_pooled_maker_starts_clean(self):
+        results = list(construct_many('It u8 #"x"',[[1],[2]],chunksize=2))
+        self.assertEqual(results,[b'\xfe',b'\xfd'])
+
+    def test_invalid_backend(self):
+        with self.assertRaises(Exception):
+            list(construct_many('u8',[[1]],backend='gpu'))
@@ -0,0 +1,103 @@
+import io, random, unittest
+from bitarchitect import *
+from bitarchitect.bits_io import ReleasableBytesIO, SegmentedBytesIO
+
+def _random_bytes(n,seed=0):
+    return bytes(random.Random(seed).getrandbits(8) for i in range(n))
+
+class TestSpill(unittest.TestCase):
+    def test_reverse_and_invert_in_chunks(self):
+        data = _random_bytes(101)
+        expected = BitsIO(data)
+        spilled = BitsIO(data,spill_threshold=16,chunk_bytes=3)
+        for bits in (expected,spilled):
+            bits.seek(5)
+            bits.reverse(700)
+            bits.seek(13)
+            bits.invert(555)
+        self.assertEqual(bytes(spilled),bytes(expected))
+        self.assertEqual(len(spilled),len(data)*8)
+
+    def test_writes_past_the_threshold(self):
+        values = [(i*37) % (1<<13) for i in range(200)]
+        bits = BitsIO(spill_threshold=16,chunk_bytes=3)
+        for value in values:
+            bits.write(value,13)
+        self.assertEqual(len(bits),13*len(values))
+        self.assertTrue(bits.at_eof())
+        bits.seek(0)
+        self.assertFalse(bits.at_eof())
+        self.assertEqual([bits.read(13)[0] for value in values],values)
+        self.assertTrue(bits.at_eof())
+
+    def test_find_across_chunks(self):
+        bits = BitsIO(b'x'*50+b'marker'+b'y'*50,spill_threshold=0,chunk_bytes=4)
+        self.assertEqual(bits.find(b'marker'),50*8)
+        self.assertEqual(bits.tell(),0)
+
+    def test_makers_round_trip(self):
+        data = _random_bytes(64)
+        pattern = 'r16 u16 e32 u32 i8 {u8}58'
+        maker,result = extract(pattern,data,spill_threshold=8)
+        expected,result = extract(pattern,data)
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        self.assertEqual(bytes(maker),bytes(expected))
+        maker,result = construct(pattern,maker.data_stream,spill_threshold=8)
+        self.assertEqual(bytes(maker),data)
+
+class TestReleaseConsumed(unittest.TestCase):
+    def test_window_is_released(self):
+        source = ReleasableBytesIO(b'abcdefgh',chunk_bytes=2)
+        self.assertEqual(source.read(5),b'abcde')
+        source.release(4)
+        self.assertEqual(source.base,4)
+        self.assertEqual(source.read(),b'fgh')
+        source.seek(3)
+        with self.assertRaises(Exception):
+            source.read(1)
+
+    def test_matches_normal_extraction(self):
+        data = _random_bytes(4000,1)
+        pattern = 'u8 r16 u16 e32 u32 n8 {[u8 B24]}500 jf16 u8 {u8}1991'
+        expected,result = extract(pattern,data)
+        for byte_stream in (data,io.BytesIO(data)):
+            maker = Extractor(byte_stream,release_consumed=True,release_page_bytes=64)
+            maker(pattern)
+            maker.finalize()
+            self.assertEqual(maker.data_stream,expected.data_stream)
+            self.assertEqual(maker.data_structure,expected.data_structure)
+            self.assertGreater(maker.released_bits,0)
+
+    def test_released_bits_cannot_be_read(self):
+        maker = Extractor(_random_bytes(1000),release_consumed=True,release_page_bytes=16)
+        maker('{u8}1000')
+        with self.assertRaises(Exception):
+            bytes(maker)
+
+class TestSegmented(unittest.TestCase):
+    def test_read_and_find_across_segments(self):
+        segments = [b'ab',b'cde',b'',b'fghij']
+        source = SegmentedBytesIO(segments,page_bytes=2)
+        self.assertEqual(source.read(),b'abcdefghij')
+        self.assertEqual(source.find(b'def',0),3)
+        self.assertEqual(source.find(b'ij',0),8)
+        self.assertEqual(source.find(b'x',0),-1)
+
+    def test_copy_on_write(self):
+        segment = bytearray(b'abcd')
+        source = SegmentedBytesIO([segment,b'efgh'])
+        source.seek(3)
+        source.write(b'XYZ')
+        source.write(b'!!!')
+        source.seek(0)
+        self.assertEqual(source.read(),b'abcXYZ!!!')
+        self.assertEqual(segment,bytearray(b'abcd'))
+
+    def test_extract_segments(self):
+        data = _random_bytes(300,2)
+        segments = [data[i:i+7] for i in range(0,len(data),7)]
+        pattern = 'r12 u12 {[u3 B16]}20 e32 u32 {u8}247'
+        maker,result = extract(pattern,segments)
+        expected,result = extract(pattern,data)
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        self.assertEqual(bytes(maker),bytes(expected))
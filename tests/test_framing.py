@@ -0,0 +1,68 @@
+import io, unittest
+from bitarchitect import *
+
+def _frames(payloads):
+    #4 byte header: u16 type, u16 length that counts the header too
+    return b''.join((i).to_bytes(2,'big') + (len(payload)+4).to_bytes(2,'big') + payload for i,payload in enumerate(payloads))
+
+class TestSplitFrames(unittest.TestCase):
+    payloads = [b'abc',b'',b'\x00'*300,b'xyz!']
+
+    def test_buffer_and_file_inputs(self):
+        data = _frames(self.payloads)
+        for byte_stream in (data,bytearray(data),io.BytesIO(data)):
+            if isinstance(byte_stream,io.BytesIO):
+                frames = list(split_frames(byte_stream,'u16 u16 #"length"','length',offset=-4,chunk_bytes=5))
+            else:
+                frames = list(split_frames(byte_stream,'u16 u16 #"length"','length',offset=-4))
+            self.assertEqual([header for header,frame in frames],[[i,len(payload)+4] for i,payload in enumerate(self.payloads)])
+            self.assertEqual([bytes(frame) for header,frame in frames],self.payloads)
+
+    def test_memoryview_frames_are_not_copied(self):
+        data = bytearray(_frames(self.payloads))
+        header,frame = next(split_frames(data,'u16 u16 #"length"','length',offset=-4,include_header=True))
+        self.assertIsInstance(frame,memoryview)
+        self.assertEqual(bytes(frame),data[:7])
+        frame.release()
+
+    def test_scale(self):
+        frames = list(split_frames(b'\x01abcd\x00','u8 #"words"','words',scale=4))
+        self.assertEqual([bytes(frame) for header,frame in frames],[b'abcd',b''])
+
+    def test_truncated_frame(self):
+        data = _frames(self.payloads)[:-1]
+        for byte_stream in (data,io.BytesIO(data)):
+            with self.assertRaises(IncompleteDataError):
+                list(split_frames(byte_stream,'u16 u16 #"length"','length',offset=-4))
+        with self.assertRaises(IncompleteDataError):
+            list(split_frames(b'\x00\x05\x00','u16 #"n"','n'))
+
+    def test_invalid_headers(self):
+        for header_pattern in ('u4 #"n"','u8 #"n" {u8}$','u8 #"n" B..."n";'):
+            with self.assertRaises(Exception):
+                list(split_frames(b'\x00',header_pattern,'n'))
+        with self.assertRaises(Exception):
+            list(split_frames(b'\x00\x00','u16 #"n"','n',offset=-4))
+
+class TestExtractFrames(unittest.TestCase):
+    def test_reuse_maker(self):
+        data = _frames([b'\x01\x02',b'\x03'])
+        for reuse_maker in (True,False):
+            results = [(header,maker.data_stream,result) for header,maker,result in extract_frames('{u8}$',data,'u16 u16 #"length"','length',offset=-4,reuse_maker=reuse_maker)]
+            self.assertEqual(results,[([0,6],[1,2],[1,2]),([1,5],[3],[3])])
+
+    def test_pattern_placeholders(self):
+        data = _frames([b'\x01\x02',b'\x03'])
+        for reuse_maker in (True,False):
+            results = [maker.data_stream for header,maker,result in extract_frames('{u{width}}$',data,'u16 u16 #"length"','length',offset=-4,reuse_maker=reuse_maker,width=8)]
+            self.assertEqual(results,[[1,2],[3]])
+
+    def test_function_blueprint_round_trip(self):
+        payloads = [b'\x02ab',b'\x01c']
+        def blueprint(maker,prefix):
+            n = maker('u8')[0]
+            return prefix + bytes(maker('B%d' % (8*n))[0])
+        results = [result for header,maker,result in extract_frames(blueprint,_frames(payloads),'u16 u16 #"length"','length',b'>',offset=-4)]
+        self.assertEqual(results,[b'>ab',b'>c'])
+        for (header,maker,result),payload in zip(extract_frames(blueprint,_frames(payloads),'u16 u16 #"length"','length',b'',offset=-4,reuse_maker=False),payloads):
+            self.assertEqual(bytes(construct(blueprint,maker.data_stream,b'')[0]),payload)
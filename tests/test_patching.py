@@ -0,0 +1,91 @@
+import os, random, shutil, tempfile, unittest
+from bitarchitect import *
+
+def _random_pattern(rng):
+    #fields and modifications that may partly overlap each other, padded to a whole number of bytes
+    tokens = []
+    pos = 0
+    for i in range(rng.randrange(4,12)):
+        kind = rng.choice('uusBxri')
+        if kind in 'ri':
+            tokens.append('%s%d' % (kind,rng.randrange(1,25)))
+            continue
+        num_bits = rng.choice((8,16,24)) if kind in 'Bx' else rng.randrange(1,25)
+        tokens.append('%s%d' % (kind,num_bits))
+        pos += num_bits
+    if pos % 8:
+        tokens.append('u%d' % (8-pos%8))
+    return ' '.join(tokens) + ' {u8}$'
+
+def _new_value(rng,value,num_bits,encoding):
+    if encoding == Encoding.UINT:
+        return rng.getrandbits(num_bits)
+    if encoding == Encoding.SINT:
+        return rng.getrandbits(num_bits) - (1<<(num_bits-1))
+    if encoding == Encoding.BYTS:
+        return bytes(rng.getrandbits(8) for i in range(len(value)))
+    return ''.join(rng.choice('0123456789abcdef') for i in range(len(value)))
+
+class TestPatch(unittest.TestCase):
+    def test_field_across_a_partial_reversal(self):
+        data = bytearray.fromhex('123456789abcde')
+        maker,result = extract('r8 r16 u8 u16 B8',bytes(data),source_map=True)
+        self.assertEqual(maker.data_stream,[44,4694,b'x'])
+        patch(maker,{1:0},target=data)
+        self.assertEqual(extract('r8 r16 u8 u16 B8',data)[0].data_stream,[44,0,b'x'])
+        self.assertEqual(data[3:],bytes.fromhex('789abcde'))
+        self.assertEqual(maker.data_stream,[44,0,b'x'])
+
+    def test_random_patterns_round_trip(self):
+        rng = random.Random(5)
+        for trial in range(300):
+            pattern = _random_pattern(rng)
+            data = bytearray(rng.getrandbits(8) for i in range(40))
+            maker,result = extract(pattern,bytes(data),source_map=True)
+            expected = list(maker.data_stream)
+            changes = {}
+            for index,value in enumerate(expected):
+                if rng.random() < 0.5:
+                    changes[index] = _new_value(rng,value,maker.source_map.num_bits(index),maker.source_map.encoding(index))
+            patch(maker,changes,target=data)
+            expected = [changes.get(index,value) for index,value in enumerate(expected)]
+            self.assertEqual(extract(pattern,data)[0].data_stream,expected,pattern)
+            self.assertEqual(maker.data_stream,expected)
+
+    def test_output_settings(self):
+        for output in ('all','stream','structure'):
+            data = bytearray(b'\x02abcd')
+            maker,result = extract('u8 {B16}2',data,source_map=True,output=output)
+            maker.data_structure
+            patch(maker,{1:b'xy',2:b'zw'})
+            self.assertEqual(data,bytearray(b'\x02xyzw'))
+            self.assertEqual(maker.data_structure,[2,b'xy',b'zw'])
+            self.assertEqual(maker.data_stream,[2,b'xy',b'zw'])
+
+    def test_file_target(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory,'input.bin')
+        with open(path,'wb') as f:
+            f.write(b'\x01\x02\x03\x04')
+        try:
+            with open(path,'r+b') as f:
+                maker,result = extract('u4 r16 u16 u12',f,source_map=True)
+                expected = maker.data_stream[:1] + [0xbeef] + maker.data_stream[2:]
+                patch(maker,{1:0xbeef},target=f)
+            with open(path,'rb') as f:
+                self.assertEqual(extract('u4 r16 u16 u12',f.read())[0].data_stream,expected)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_invalid_patches(self):
+        maker,result = extract('u8 B16 s4 u4',b'\x01ab\xf0',source_map=True)
+        for changes in ({0:256},{1:b'abc'},{2:8},{0:-1}):
+            with self.assertRaises(Exception):
+                patch(maker,changes,target=bytearray(4))
+        with self.assertRaises(Exception):
+            patch(maker,{0:1})
+        with self.assertRaises(Exception):
+            patch(extract('u8',b'\x01')[0],{0:1})
+        maker,result = extract('jf8 u8',b'\x01\x02',source_map=True)
+        with self.assertRaises(Exception):
+            patch(maker,{0:1},target=bytearray(2))
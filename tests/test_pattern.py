@@ -0,0 +1,395 @@
+import unittest
+from bitarchitect import *
+
+class TestRepeatToEnd(unittest.TestCase):
+    def test_extract_ends_at_eof(self):
+        maker,result = extract('{u8}$',b'abc')
+        self.assertEqual(maker.data_stream,[97,98,99])
+        self.assertTrue(maker.at_eof())
+
+    def test_round_trip(self):
+        maker,result = extract('u8 {[u4 u4]}$',b'\x02\x12\x34')
+        self.assertEqual(maker.data_structure,[2,[1,2],[3,4]])
+        maker,result = construct('u8 {[u4 u4]}$',maker.data_stream)
+        self.assertEqual(bytes(maker),b'\x02\x12\x34')
+
+    def test_incomplete_record_at_end(self):
+        with self.assertRaises(IncompleteDataError):
+            extract('{u16}$',b'abc')
+
+    def test_no_progress_raises(self):
+        with self.assertRaises(Exception) as context:
+            extract('{r8}$',b'abc')
+        self.assertIn('made no progress',str(context.exception))
+        with self.assertRaises(Exception) as context:
+            construct('{z8}$',[1])
+        self.assertIn('made no progress',str(context.exception))
+
+class TestBitsIOSize(unittest.TestCase):
+    def test_size_follows_writes(self):
+        bits = BitsIO(b'\x00')
+        self.assertEqual(len(bits),8)
+        bits.seek(8)
+        self.assertTrue(bits.at_eof())
+        bits.write(1,4)
+        self.assertEqual(len(bits),16) #the size is whole bytes
+        self.assertFalse(bits.at_eof())
+        bits.seek(16)
+        self.assertTrue(bits.at_eof())
+        bits.truncate(8)
+        self.assertEqual(len(bits),8)
+        self.assertEqual(bytes(bits),b'\x00')
+
+class _SilentLogger():
+    def will_log(self,level):
+        return False
+    def debug(self,message):
+        raise Exception('debug message built while debug logging is off: %s' % message)
+
+class TestReset(unittest.TestCase):
+    def test_extractor_reset(self):
+        maker = Extractor(b'\x01\x02\x03')
+        maker('r8 u8 #"a" u16')
+        first_stream = maker.data_stream
+        maker.reset(b'\x04\x05\x06')
+        maker('u8 #"b" u16')
+        maker.finalize()
+        expected,result = extract('u8 #"b" u16',b'\x04\x05\x06')
+        self.assertEqual(first_stream,[128,515])
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        self.assertEqual(bytes(maker),b'\x04\x05\x06')
+        self.assertEqual(list(maker.labels),['b'])
+
+    def test_constructor_reset(self):
+        maker = Constructor([1,2])
+        maker('It u8 #"a" u8')
+        maker.finalize()
+        first = bytes(maker)
+        maker.reset([3,4])
+        maker('u8 u8')
+        maker.finalize()
+        self.assertEqual(first,b'\xfe\xfd')
+        self.assertEqual(bytes(maker),b'\x03\x04')
+        self.assertEqual(list(maker.labels),[])
+
+    def test_no_debug_messages_when_logging_is_off(self):
+        data = bytes(range(1,9))
+        for pattern in ('u8 jf8 u8 je8 u8','u8 js32 u8 je8 u8'):
+            extractor = Extractor(data)
+            extractor.logger = _SilentLogger()
+            extractor(pattern)
+            extractor.finalize()
+            expected,result = extract(pattern,data)
+            self.assertEqual(extractor.data_stream,expected.data_stream)
+            constructor = Constructor(extractor.data_stream)
+            constructor.logger = _SilentLogger()
+            constructor(pattern)
+            constructor.finalize()
+            expected,result = construct(pattern,extractor.data_stream)
+            self.assertEqual(bytes(constructor),bytes(expected))
+
+class TestCounts(unittest.TestCase):
+    def test_round_trip_keeps_partial_byte_counts(self):
+        for pattern,data in (('u8 #"n" B..."n"; u4',b'\x0c\xab\xc5'),('u8 #"n" x..."n"; u2',b'\x06\xab'),('u4 #"n" b..."n"; u4 {u4}..."n";',b'\x3a\x00\x12')):
+            maker,result = extract(pattern,data)
+            constructed,result = construct(pattern,maker.data_stream)
+            self.assertEqual(constructed.data_stream,maker.data_stream)
+            self.assertEqual(bytes(constructed),data)
+
+    def test_construction_fills_in_the_count(self):
+        maker,result = construct('u16 #"n" B..."n"*8; u8',[0,b'abc',7])
+        self.assertEqual(bytes(maker),b'\x00\x03abc\x07')
+        self.assertEqual(maker.data_stream[0],3)
+        maker,result = construct('u8 #"n" B..."n"*8+8;',[0,b'abc'])
+        self.assertEqual(bytes(maker),b'\x02abc')
+
+    def test_count_that_cannot_be_filled_in(self):
+        with self.assertRaises(Exception):
+            construct('!#"n"=2 B..."n"*8;',[b'abc'])
+        with self.assertRaises(Exception):
+            construct('u8 #"n" B..."n"*16;',[0,b'abc'])
+
+    def test_label_must_be_an_integer(self):
+        with self.assertRaises(Exception):
+            extract('B8 #"n" u..."n";',b'ab')
+
+class TestPlaceholders(unittest.TestCase):
+    def test_bind_values(self):
+        maker = Extractor(b'\x01\x02\x03ab')
+        self.assertEqual(maker('{u8}{n}',n=2),[1,2])
+        self.assertEqual(maker('u{bits}',bits=8),[3])
+        self.assertEqual(maker('B{bits}',bits=16),[b'ab'])
+
+    def test_round_trip(self):
+        data = b'\x00\x01\x02\x03'
+        maker,result = extract('u8 {[u4 u4]}{n} js{off} u8',data,n=2,off=24)
+        self.assertEqual(maker.data_structure,[0,[0,1],[0,2],3])
+        maker,result = construct('u8 {[u4 u4]}{n} js{off} u8',maker.data_stream,n=2,off=24)
+        self.assertEqual(bytes(maker),data)
+
+    def test_missing_and_unknown_values(self):
+        with self.assertRaises(Exception):
+            Extractor(b'\x01')('u{bits}')
+        with self.assertRaises(Exception):
+            Extractor(b'\x01')('u{bits}',bits=8,other=1)
+
+class TestBranches(unittest.TestCase):
+    pattern = 'u8 #"type" ?="type" 1:{u16} 2:{[u8 u8]} *:{B8}; u8 #"flag" ?#"flag"{u8}{}'
+
+    def test_round_trip(self):
+        for data,structure in ((b'\x01\x00\x05\x00',[1,5,0]),(b'\x02\x06\x07\x01\x08',[2,[6,7],1,8]),(b'\x09z\x00',[9,b'z',0])):
+            maker,result = extract(self.pattern,data)
+            self.assertEqual(maker.data_structure,structure)
+            maker,result = construct(self.pattern,maker.data_stream)
+            self.assertEqual(bytes(maker),data)
+            maker,result = construct(self.pattern,structure)
+            self.assertEqual(bytes(maker),data)
+
+    def test_construction_follows_the_data(self):
+        maker,result = construct('u8 #"n" ?="n" 0:{} *:{u8 #"x" ?#"x"{u4}{u8}};',[1,0,255])
+        self.assertEqual(bytes(maker),b'\x01\x00\xff')
+
+    def test_no_matching_case(self):
+        with self.assertRaises(Exception):
+            extract('u8 #"type" ?="type" 1:{u8};',b'\x02\x00')
+        with self.assertRaises(Exception):
+            construct('u8 #"type" ?="type" 1:{u8};',[2,0])
+
+    def test_unhashable_value_uses_default(self):
+        maker,result = extract('[u8] #"v" ?="v" 1:{u8} *:{u16};',b'\x01\x00\x02')
+        self.assertEqual(maker.data_structure,[[1],2])
+
+class TestDefinitions(unittest.TestCase):
+    def test_nested_definitions_round_trip(self):
+        pattern_define('''
+            @test_pair := [u8 u8]
+            @test_pairs := u8 #"count" {@test_pair}..."count";
+        ''')
+        data = b'\x02\x01\x02\x03\x04\x09'
+        maker,result = extract('@test_pairs u8',data)
+        self.assertEqual(maker.data_structure,[2,[1,2],[3,4],9])
+        maker,result = construct('@test_pairs u8',maker.data_stream)
+        self.assertEqual(bytes(maker),data)
+
+    def test_placeholders_and_redefinition(self):
+        pattern_define('@test_field := u{bits}')
+        self.assertEqual(Extractor(b'\x12')('@test_field',bits=4),[1])
+        pattern_define('@test_field := B{bits}')
+        self.assertEqual(Extractor(b'\x12')('@test_field',bits=8),[b'\x12'])
+
+    def test_redefinition_updates_dependents(self):
+        pattern_define('''
+            @test_a := u8
+            @test_b := @test_a @test_a
+            @test_c := [@test_b]
+        ''')
+        self.assertEqual(extract('@test_c',b'\x12\x34')[0].data_stream,[0x12,0x34])
+        pattern_define('@test_a := u4')
+        self.assertEqual(extract('@test_b',b'\x12\x34')[0].data_stream,[1,2])
+        self.assertEqual(extract('@test_c u8',b'\x12\x34')[0].data_structure,[[1,2],0x34])
+        pattern_define('''
+            @test_d := @test_a
+            @test_a := B8
+        ''')
+        self.assertEqual(extract('@test_d @test_c',b'\x12\x34\x56')[0].data_stream,[b'\x12',b'\x34',b'\x56'])
+
+    def test_undefined_and_invalid(self):
+        with self.assertRaises(Exception):
+            Extractor(b'\x00')('@test_undefined')
+        with self.assertRaises(Exception):
+            pattern_define('u8')
+
+def _message(maker):
+    maker('u8 #"type"')
+    if maker['type'] == 1:
+        maker('u16')
+    else:
+        maker('[u8 u8]')
+
+def _reads_record(maker):
+    if maker('u8')[0] == 1:
+        maker('u8')
+
+class TestTracedBlueprint(unittest.TestCase):
+    def test_replay_matches_the_function(self):
+        traced = TracedBlueprint(_message)
+        for data in (b'\x01\x00\x02',b'\x01\x01\x03',b'\x02\x05\x06',b'\x01\x00\x04'):
+            maker,result = extract(traced,data)
+            expected,result = extract(_message,data)
+            self.assertEqual(maker.data_structure,expected.data_structure)
+            constructed,result = construct(traced,maker.data_stream)
+            self.assertEqual(bytes(constructed),data)
+        self.assertGreater(traced.replays,0)
+        self.assertGreater(traced.fallbacks,0)
+
+    def test_data_dependent_blueprint_is_called(self):
+        traced = TracedBlueprint(_reads_record)
+        self.assertEqual(extract(traced,b'\x01\x02')[0].data_stream,[1,2])
+        self.assertIsNotNone(traced.reason)
+        self.assertEqual(extract(traced,b'\x00\x02')[0].data_stream,[0])
+        self.assertEqual(traced.replays,0)
+
+    def test_lazy_input_is_not_replayed(self):
+        traced = TracedBlueprint(_message)
+        self.assertEqual(bytes(construct(traced,[1,5])[0]),b'\x01\x00\x05')
+        self.assertEqual(bytes(construct(traced,iter([2,5,6]))[0]),b'\x02\x05\x06')
+        self.assertEqual(bytes(construct(traced,iter([1,7]))[0]),b'\x01\x00\x07')
+        self.assertEqual((traced.replays,traced.fallbacks),(0,0))
+
+    def test_incomplete_data(self):
+        traced = TracedBlueprint(_message)
+        extract(traced,b'\x01\x00\x02')
+        with self.assertRaises(IncompleteDataError):
+            extract(traced,b'\x01\x00')
+
+class TestFastMode(unittest.TestCase):
+    data = bytes(range(40))
+    pattern = 'u8 #"n" r16 u16 e32 u32 Iy [u8 #"m" i8 u8] In {[u4 u4]}..."n"; {u8}$'
+
+    def test_matches_normal_extraction(self):
+        expected,expected_result = extract(self.pattern,self.data)
+        maker,result = extract(self.pattern,self.data,fast=True)
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        self.assertEqual(maker.data_structure,expected.data_structure)
+        self.assertEqual(result,expected.data_structure)
+        self.assertEqual(maker.flat_pattern,expected.flat_pattern)
+        self.assertEqual(maker.flat_labels,expected.flat_labels)
+        self.assertEqual(maker['m'],expected['m'])
+        self.assertEqual(len(maker.mod_operations),0)
+        self.assertEqual(bytes(maker),bytes(expected))
+
+    def test_jumps_are_seeks(self):
+        maker,result = extract('u8 jf8 u8 jb16 u8',b'\x01\x02\x03',fast=True)
+        self.assertEqual(maker.data_stream,[1,3,2])
+        with self.assertRaises(Exception):
+            extract('u8 js32',b'\x01',fast=True)
+
+    def test_function_blueprint(self):
+        def blueprint(maker):
+            n = maker('u8')[0]
+            return maker('{u8}%d' % n)
+        maker,result = extract(blueprint,b'\x02\x05\x06',fast=True)
+        self.assertEqual(result,[5,6])
+        self.assertEqual(maker.data_structure,[2,5,6])
+
+class TestOutputSelection(unittest.TestCase):
+    data = bytes(range(1,33))
+    pattern = 'u8 #"n" r16 u16 [u8 #"a" [u4 u4]] {[u8 B8]}..."n"; {u8}$'
+
+    def test_outputs_match_all(self):
+        expected,result = extract(self.pattern,self.data)
+        for output in ('stream','structure'):
+            for fast in (False,True):
+                maker,result = extract(self.pattern,self.data,output=output,fast=fast)
+                self.assertEqual(maker.data_stream,expected.data_stream)
+                self.assertEqual(maker.data_structure,expected.data_structure)
+                self.assertEqual(''.join(maker.flat_pattern),expected.flat_pattern)
+                self.assertEqual(maker.flat_labels,expected.flat_labels)
+                constructed,result = construct(self.pattern,maker.data_stream)
+                self.assertEqual(bytes(constructed),self.data)
+
+    def test_record_output(self):
+        maker,result = extract(self.pattern,self.data,output='record')
+        expected,expected_result = extract(self.pattern,self.data)
+        self.assertEqual(result,expected.data_structure)
+        for name in ('data_stream','data_structure','flat_pattern','flat_labels'):
+            with self.assertRaises(AttributeError):
+                getattr(maker,name)
+
+    def test_invalid_output(self):
+        with self.assertRaises(Exception):
+            Extractor(self.data,output='tree')
+
+    def test_derived_attributes_are_cached_until_the_next_insert(self):
+        for output,name in (('stream','data_structure'),('structure','data_stream'),('structure','flat_pattern'),('stream','flat_labels')):
+            maker = Extractor(self.data,output=output)
+            maker('u8 #"a" [u8')
+            derived = getattr(maker,name)
+            self.assertIs(getattr(maker,name),derived)
+            maker('u8 #"b"')
+            self.assertIsNot(getattr(maker,name),derived)
+            maker(']')
+            maker.finalize()
+            expected = Extractor(self.data)
+            expected('u8 #"a" [u8 u8 #"b" ]')
+            expected.finalize()
+            self.assertEqual(getattr(maker,name),getattr(expected,name))
+            del maker['b']
+            if name == 'flat_labels':
+                self.assertEqual(maker.flat_labels,['a',None,None])
+
+class TestLazyConstruction(unittest.TestCase):
+    pattern = 'u8 #"n" r16 u16 {[u8 B8]}..."n"; u16 #"len" B..."len"*8; {u8}$'
+    data = b'\x02\x01\x02\x03a\x04b\x00\x03xyz\x07\x08'
+
+    def test_generator_matches_list(self):
+        maker,result = extract(self.pattern,self.data)
+        structure = maker.data_structure
+        constructed,result = construct(self.pattern,(item for item in structure))
+        self.assertIsNone(constructed.data_stream)
+        self.assertEqual(bytes(constructed),self.data)
+        constructed,result = construct(self.pattern,structure,lazy=True)
+        self.assertEqual(bytes(constructed),self.data)
+
+    def test_count_is_filled_in_from_the_lookahead(self):
+        def rows():
+            yield 0
+            yield b'abcd'
+        maker,result = construct('u16 #"len" B..."len"*8;',rows())
+        self.assertEqual(bytes(maker),b'\x00\x04abcd')
+
+    def test_function_blueprint_and_records(self):
+        def blueprint(maker):
+            n = maker('u8')[0]
+            maker('{u8}%d' % n)
+        maker,result = construct(blueprint,iter([2,5,6]))
+        self.assertEqual(bytes(maker),b'\x02\x05\x06')
+        maker = Constructor(iter([1,2]),records=False)
+        self.assertEqual(maker('u8 u8'),[])
+
+    def test_too_few_values(self):
+        with self.assertRaises(IndexError):
+            construct('u8 u8',iter([1]))
+
+def _random_structure(rng,depth=0):
+    structure = []
+    for i in range(rng.randrange(0,6)):
+        if depth < 4 and rng.random() < 0.3:
+            structure.append(_random_structure(rng,depth+1))
+        else:
+            structure.append(rng.randrange(100))
+    return structure
+
+class TestStructureIndex(unittest.TestCase):
+    def test_flatten_and_index_random_structures(self):
+        import random
+        rng = random.Random(5)
+        for trial in range(200):
+            structure = _random_structure(rng) + [rng.randrange(100)]*rng.choice((0,20))
+            data_stream,flat_pattern = flatten(structure)
+            self.assertEqual(list(iter_flatten(structure)),data_stream)
+            self.assertEqual(deflatten(flat_pattern,data_stream),structure)
+            index = StructureIndex(flat_pattern)
+            self.assertEqual(len(index),len(data_stream))
+            for stream_index,value in enumerate(data_stream):
+                structure_index = index.structure_index(stream_index)
+                item = structure
+                for position in structure_index:
+                    item = item[position]
+                self.assertEqual(item,value)
+                self.assertEqual(index.stream_index(structure_index),stream_index)
+                self.assertEqual(get_stream_index(flat_pattern,structure_index),stream_index)
+
+    def test_lookup_errors(self):
+        index = StructureIndex('.[.].')
+        for structure_index in ([1],[3],[1,1],[0,0]):
+            with self.assertRaises(Exception):
+                index.stream_index(structure_index)
+        for stream_index in (-1,3):
+            with self.assertRaises(Exception):
+                index.structure_index(stream_index)
+        with self.assertRaises(NestingError):
+            StructureIndex('.].')
+        self.assertEqual(get_structure_index('.,.',0),[0])
+        with self.assertRaises(Exception):
+            get_structure_index('.,.',1)
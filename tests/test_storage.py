@@ -0,0 +1,156 @@
+import io, unittest
+from bitarchitect import *
+
+class TestCompactList(unittest.TestCase):
+    def test_list_operations(self):
+        values = [0,-1,127,128,-40000,1<<40,1<<70,b'ab',None]
+        compact = CompactList(values)
+        self.assertEqual(compact,values)
+        self.assertEqual(list(compact),values)
+        self.assertEqual(compact[-3:],values[-3:])
+        compact[1] = 'x'
+        values[1] = 'x'
+        del compact[0]
+        del values[0]
+        compact.insert(2,5)
+        values.insert(2,5)
+        self.assertEqual(compact,values)
+        with self.assertRaises(IndexError):
+            compact[len(values)]
+
+    def test_integers_are_stored_in_typed_arrays(self):
+        compact = CompactList(list(range(1<<COMPACT_CHUNK_BITS))+[1,2])
+        self.assertEqual([chunk.typecode for chunk in compact.chunks],['i','b'])
+        compact.append(1<<40)
+        self.assertEqual(compact.chunks[-1].typecode,'q')
+        self.assertEqual(compact[-1],1<<40)
+
+    def test_non_integer_runs_start_as_lists(self):
+        compact = CompactList([b'a']*((1<<COMPACT_CHUNK_BITS)+1))
+        self.assertFalse(compact.typed)
+        self.assertEqual([type(chunk) for chunk in compact.chunks],[list,list])
+        compact[:] = [1,2]
+        self.assertTrue(compact.typed)
+        self.assertEqual(compact.chunks[0].typecode,'b')
+
+    def test_compact_extraction(self):
+        data = bytes(range(256))*3
+        pattern = 'u8 #"n" r16 s16 {[u8 B8]}..."n"; {u8}$'
+        expected,result = extract(pattern,data)
+        maker,result = extract(pattern,data,compact=True)
+        self.assertIsInstance(maker.data_stream,CompactList)
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        self.assertEqual(maker.flat_labels,expected.flat_labels)
+        self.assertEqual(maker.flat_pattern,expected.flat_pattern)
+        constructed,result = construct(pattern,maker.data_stream)
+        self.assertEqual(bytes(constructed),data)
+
+def _counted_values(maker):
+    #reads ahead in the data stream while constructing, like blueprints that size a field from later values
+    n = maker('u8 #"n"')[0]
+    if isinstance(maker,Constructor) and len(maker.data_stream) != n+1:
+        raise Exception('data stream does not match the count')
+    maker('{u16}..."n";')
+
+class TestCompactConstruction(unittest.TestCase):
+    def test_function_blueprint_round_trip(self):
+        data = b'\x03' + bytes(range(6))
+        maker,result = extract(_counted_values,data,compact=True)
+        self.assertIsInstance(maker.data_stream,CompactList)
+        constructed = Constructor(maker.data_stream)
+        self.assertIsNotNone(constructed.data_stream)
+        constructed,result = construct(_counted_values,maker.data_stream)
+        self.assertEqual(bytes(constructed),data)
+        constructed,result = construct('u8 {u16}3',maker.data_stream)
+        self.assertEqual(bytes(constructed),data)
+
+class TestSparseList(unittest.TestCase):
+    def test_list_operations(self):
+        values = [None,'a',None,None,'b']
+        sparse = SparseList(values)
+        self.assertEqual(sparse.items,{1:'a',4:'b'})
+        sparse.extend(SparseList([None,'c']))
+        values.extend([None,'c'])
+        sparse[1] = None
+        values[1] = None
+        self.assertEqual(sparse,values)
+        self.assertEqual(sparse[-2:],values[-2:])
+        with self.assertRaises(IndexError):
+            sparse[-8]
+
+class TestValueInterner(unittest.TestCase):
+    def test_repeated_strings_share_one_object(self):
+        data = b'abab'*20
+        maker,result = extract('{B16 x16 X16 b8 C8}$',data,intern=True)
+        expected,result = extract('{B16 x16 X16 b8 C8}$',data)
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        for first,second in zip(maker.data_stream[:5],maker.data_stream[5:10]):
+            self.assertIs(first,second)
+        self.assertEqual(set(maker.interner.stats()),{'BYTS','LHEX','UHEX','BINS','CHAR'})
+
+    def test_numbers_are_not_kept(self):
+        interner = ValueInterner(max_entries=1)
+        maker,result = extract('{u8 s8 u16}$',bytes(range(120)),intern=interner)
+        self.assertEqual(interner.stats(),{})
+        self.assertEqual(interner.tables,{})
+        self.assertEqual(interner.decode(0x61,8,Encoding.BYTS),b'a')
+        self.assertEqual(interner.decode(0x62,8,Encoding.BYTS),b'b')
+        self.assertEqual(interner.stats()['BYTS']['entries'],1)
+
+class TestLazyValue(unittest.TestCase):
+    data = bytes(range(7,250,3))*2
+
+    def test_matches_eager_extraction(self):
+        pattern = 'u3 B16 x12 u1 X24 b8 r32 B32 C16 {B8}$'
+        expected,result = extract(pattern,self.data)
+        maker,result = extract(pattern,bytearray(self.data),lazy_min_bits=8)
+        self.assertEqual(maker.data_stream,expected.data_stream)
+        self.assertEqual([type(value) for value in maker.data_stream[:8]],[int,LazyValue,LazyValue,int,LazyValue,LazyValue,bytes,LazyValue])
+        self.assertEqual(bytes(maker.data_stream[7].view()),expected.data_stream[7])
+        with self.assertRaises(Exception):
+            maker.data_stream[1].view()
+
+    def test_construct_writes_the_bits(self):
+        pattern = 'u3 B16 x12 u1 X24 b8 B32 C16 {B8}$'
+        maker,result = extract(pattern,self.data,lazy_min_bits=8)
+        constructed,result = construct(pattern,maker.data_stream)
+        self.assertEqual(bytes(constructed),self.data)
+        constructed,result = construct('B8 B16',maker.data_stream[-2:])
+        expected,result = construct('B8 B16',[bytes(value) for value in maker.data_stream[-2:]])
+        self.assertEqual(bytes(constructed),bytes(expected))
+
+class TestSourceMap(unittest.TestCase):
+    data = bytes(range(3,256,2))*8
+
+    def assert_reads_stream(self,maker,byte_stream):
+        for index,value in enumerate(maker.data_stream):
+            if maker.source_map.position(index) >= 0:
+                encoding = Encoding.BYTS if isinstance(value,bytes) else Encoding.UINT
+                self.assertEqual(maker.source_map.read(index,byte_stream,encoding),value)
+
+    def test_reads_every_field(self):
+        pattern = 'u3 B16 u5 {[u8 u12 B4]}90 jf16 u200 {u7}30 u6 {u8}$'
+        maker,result = extract(pattern,self.data,source_map=True)
+        self.assertEqual(len(maker.source_map),len(maker.data_stream))
+        self.assertEqual(maker.source_map[0],(0,3))
+        self.assertEqual(maker.source_map[1],(3,16))
+        self.assertEqual(maker.source_map.position(-1),len(self.data)*8-8)
+        self.assertIn(-1,[maker.source_map.position(i) for i in range(len(maker.data_stream))])
+        self.assert_reads_stream(maker,self.data)
+        self.assert_reads_stream(maker,io.BytesIO(self.data))
+        self.assertEqual([maker.source_map.lengths.typecode,maker.source_map.gaps.typecode],['h','b'])
+        with self.assertRaises(IndexError):
+            maker.source_map[len(maker.data_stream)]
+
+    def test_fields_moved_by_reversals(self):
+        data = bytes.fromhex('123456789abcde')
+        maker,result = extract('r8 r16 u8 u16 B8',data,source_map=True)
+        self.assertEqual(maker.source_map[1],(0,24))
+        self.assertEqual(maker.source_map.num_bits(1),16)
+        self.assertEqual(maker.source_map.position(1),8)
+        with self.assertRaises(Exception):
+            maker.source_map.read(1,data)
+        self.assertEqual(maker.source_map.read(2,data,Encoding.BYTS),maker.data_stream[2])
+        maker,result = extract('r16 u8 u8',data,source_map=True)
+        self.assertEqual([maker.source_map[0],maker.source_map[1]],[(8,8),(0,8)])
+        self.assertEqual(maker.source_map.read(0,data),0x34)